@@ -0,0 +1,323 @@
+#! /usr/bin/env python3
+"""Benchmarks of borgit's backup, checking and listing.
+
+A synthetic source tree is generated, backed up, changed, and backed up
+again. The time taken by each phase of pre_backup_check and perform_backup,
+and by the listing APIs, is measured. This can be done against real borg
+(if installed) and against benchmarks/fake_borg, which does none of borg's
+work so measures borgit's own overhead, optionally with simulated latency.
+
+Results are output as JSON, so that runs can be compared.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir),
+)
+
+# pylint: disable=wrong-import-position
+from borgit.command import perform_backup, pre_backup_check  # noqa: E402
+from borgit.metrics import RunMetrics  # noqa: E402
+from borgit.repo import BorgRepo  # noqa: E402
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+KDB_PATH = os.path.join(BENCHMARK_DIR, os.pardir, 'tests', 'base', 'test.kdb')
+
+# Ranges of file sizes, in bytes, for each size distribution.
+SIZE_DISTRIBUTIONS = {
+    'small': [(0, 4 * 1024)],
+    'mixed': [(0, 4 * 1024), (4 * 1024, 256 * 1024),
+              (256 * 1024, 4 * 1024 * 1024)],
+    'large': [(4 * 1024 * 1024, 32 * 1024 * 1024)],
+}
+
+
+def _file_content(rand, size):
+    """Generate file content which is partly compressible."""
+    half = size // 2
+    return rand.randbytes(half) + b'borgit' * ((size - half) // 6 + 1)
+
+
+def build_source_tree(root, file_count, size_distribution, seed,
+                      check_count):
+    """Create a synthetic tree of files to back up.
+
+    :param root: Directory to create the tree in.
+    :param file_count: Number of files to create.
+    :param size_distribution: Key of SIZE_DISTRIBUTIONS to pick sizes from.
+    :param seed: Seed for the random content, so trees can be recreated.
+    :param check_count: Number of keepass DBs to add to the tree, to give
+                        the file checks something to check.
+
+    :returns: A list of the paths of the keepass DBs.
+    """
+    rand = random.Random(seed)
+    for index in range(file_count):
+        directory = os.path.join(root, 'dir{num:03d}'.format(num=index % 50))
+        os.makedirs(directory, exist_ok=True)
+        low, high = rand.choice(SIZE_DISTRIBUTIONS[size_distribution])
+        with open(os.path.join(directory, 'file{num:06d}'.format(
+                num=index)), 'wb') as output:
+            output.write(_file_content(rand, rand.randint(low, high)))
+
+    kdb_paths = []
+    os.makedirs(os.path.join(root, 'kdb'), exist_ok=True)
+    for index in range(check_count):
+        kdb_path = os.path.join(root, 'kdb', 'db{num:03d}.kdb'.format(
+            num=index,
+        ))
+        shutil.copy(KDB_PATH, kdb_path)
+        kdb_paths.append(kdb_path)
+    return kdb_paths
+
+
+def change_source_tree(root, change_rate, seed):
+    """Rewrite a proportion of the files in a synthetic tree.
+
+    :returns: The number of files changed.
+    """
+    rand = random.Random(seed)
+    changed = 0
+    for directory, _, files in os.walk(root):
+        if os.path.basename(directory) == 'kdb':
+            continue
+        for name in files:
+            if rand.random() < change_rate:
+                path = os.path.join(directory, name)
+                size = os.path.getsize(path)
+                with open(path, 'wb') as output:
+                    output.write(_file_content(rand, size))
+                changed += 1
+    return changed
+
+
+def _timed(function, *args, **kwargs):
+    """Call a function, returning its result and the time it took."""
+    start = time.monotonic()
+    result = function(*args, **kwargs)
+    return result, time.monotonic() - start
+
+
+def _phase_totals(metrics):
+    """Sum the duration of each phase in a RunMetrics, across repos.
+    Individual check timings are summed into a single checks phase."""
+    totals = {}
+    for phase in metrics.report()['phases']:
+        name = phase['phase']
+        if name.startswith('check '):
+            name = 'checks'
+        totals[name] = totals.get(name, 0) + phase['duration']
+    return totals
+
+
+def run_scenario(backend, borg_path, args, logger):
+    """Benchmark one borg backend.
+
+    :param backend: Name of the backend, for the results.
+    :param borg_path: Directory containing the borg executable to use.
+    :param args: Parsed benchmark arguments.
+    :param logger: Logger for borgit's output.
+
+    :returns: A dict of the scenario's results.
+    """
+    workdir = tempfile.mkdtemp(prefix='borgit-benchmark-')
+    original_path = os.environ['PATH']
+    os.environ['PATH'] = borg_path + os.pathsep + original_path
+    try:
+        source = os.path.join(workdir, 'source')
+        kdb_paths = build_source_tree(
+            source, args.file_count, args.size_distribution, args.seed,
+            args.check_count,
+        )
+        config = {
+            'repo_passphrase': 'benchmark',
+            'backup_source_paths': [source],
+            'check_files': [
+                {
+                    'path': path,
+                    'command': 'check_keepass',
+                    'arguments': ['--min-entries=1'],
+                }
+                for path in kdb_paths
+            ],
+            'check_concurrency': args.check_concurrency,
+            'working_directory': workdir,
+        }
+        repos = {}
+        for repo_name in 'local', 'remote':
+            repo_workdir = os.path.join(workdir, repo_name + '_work')
+            os.mkdir(repo_workdir)
+            repos[repo_name] = BorgRepo(
+                repo=os.path.join(workdir, repo_name),
+                repo_key=config['repo_passphrase'],
+                working_directory=repo_workdir,
+                logger=logger,
+            )
+            repos[repo_name].init()
+
+        runs = []
+        for run in range(args.runs):
+            if run:
+                changed = change_source_tree(source, args.change_rate,
+                                             args.seed + run)
+            else:
+                changed = args.file_count
+            archive_name = 'benchmark-{run}'.format(run=run)
+            metrics = RunMetrics(archive_name)
+            for repo in repos.values():
+                repo.metrics = metrics
+            _, duration = _timed(
+                _backup_all, repos, archive_name, config, logger, metrics,
+            )
+            runs.append({
+                'run': run,
+                'files_changed': changed,
+                'duration': duration,
+                'phases': _phase_totals(metrics),
+                'borg_commands': len(metrics.commands),
+                'backup_stats': metrics.backups[repos['local'].repo],
+            })
+
+        repo = repos['local']
+        archive_name = 'benchmark-{run}'.format(run=args.runs - 1)
+        listings = {}
+        _, listings['latest_archive'] = _timed(repo.latest_archive)
+        _, listings['list_files_in_archive'] = _timed(
+            repo.list_files_in_archive, archive_name,
+        )
+        _, listings['iter_files_in_archive'] = _timed(
+            lambda: sum(1 for _ in repo.iter_files_in_archive(archive_name)),
+        )
+        return {
+            'backend': backend,
+            'runs': runs,
+            'listings': listings,
+        }
+    finally:
+        os.environ['PATH'] = original_path
+        shutil.rmtree(workdir)
+
+
+def _backup_all(repos, archive_name, config, logger, metrics):
+    """Check both repos, then back up to and check each in turn."""
+    pre_backup_check(repos, config, logger, metrics)
+    for repo in repos.values():
+        perform_backup(repo, archive_name, config, logger, metrics=metrics)
+
+
+def _fake_borg_path(workdir, latency):
+    """Get a directory with fake_borg available as borg."""
+    os.symlink(
+        os.path.join(BENCHMARK_DIR, 'fake_borg'),
+        os.path.join(workdir, 'borg'),
+    )
+    os.environ['FAKE_BORG_LATENCY'] = str(latency)
+    return workdir
+
+
+def main(args):
+    """Run the benchmarks with provided arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark borgit backups, checks and listings.',
+    )
+    parser.add_argument(
+        '-n', '--file-count',
+        type=int,
+        default=1000,
+        help='Number of files in the synthetic source tree.',
+    )
+    parser.add_argument(
+        '-s', '--size-distribution',
+        choices=sorted(SIZE_DISTRIBUTIONS),
+        default='mixed',
+        help='Sizes of files in the synthetic source tree.',
+    )
+    parser.add_argument(
+        '-c', '--change-rate',
+        type=float,
+        default=0.05,
+        help='Proportion of files changed between runs.',
+    )
+    parser.add_argument(
+        '-r', '--runs',
+        type=int,
+        default=3,
+        help='Number of backups to take.',
+    )
+    parser.add_argument(
+        '-k', '--check-count',
+        type=int,
+        default=5,
+        help='Number of files to check after each backup.',
+    )
+    parser.add_argument(
+        '--check-concurrency',
+        type=int,
+        default=1,
+        help='Number of checks to run at once.',
+    )
+    parser.add_argument(
+        '-l', '--latency',
+        type=float,
+        default=0,
+        help='Seconds of latency the fake borg adds to each command.',
+    )
+    parser.add_argument(
+        '-b', '--backend',
+        choices=('fake', 'borg', 'all'),
+        default='all',
+        help='Which borg to benchmark. Real borg is skipped if not found.',
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='Seed for the synthetic source tree.',
+    )
+    parser.add_argument(
+        '-o', '--output',
+        help='File to write the JSON results to, instead of stdout.',
+    )
+    args = parser.parse_args(args)
+
+    logger = logging.getLogger('borgit-benchmark')
+    results = {
+        'parameters': vars(args),
+        'started': time.time(),
+        'scenarios': [],
+    }
+
+    fake_dir = tempfile.mkdtemp(prefix='borgit-benchmark-bin-')
+    try:
+        if args.backend in ('fake', 'all'):
+            results['scenarios'].append(run_scenario(
+                'fake', _fake_borg_path(fake_dir, args.latency), args,
+                logger,
+            ))
+        borg = shutil.which('borg')
+        if args.backend in ('borg', 'all') and borg:
+            results['scenarios'].append(run_scenario(
+                'borg', os.path.dirname(borg), args, logger,
+            ))
+    finally:
+        shutil.rmtree(fake_dir)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_handle:
+            output_handle.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
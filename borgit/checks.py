@@ -0,0 +1,379 @@
+"""Running of file checks against backed up data for borgit."""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+import os
+import subprocess
+
+from borgit.data import convert_duration_input, convert_size_input
+from borgit.exceptions import RunCancelled
+from borgit.plugins import get_plugin
+
+
+# Outcome of a single check.
+# passed: Whether the check passed.
+# messages: Informational output lines.
+# errors: Problem output lines. These are errors if the check failed, or
+#         warnings if it passed.
+# metrics: Dict of any measurements the check made, e.g. entry counts.
+CheckResult = namedtuple(
+    'CheckResult',
+    ['passed', 'messages', 'errors', 'metrics'],
+)
+
+# check_files options which are checked from the archive listing alone.
+METADATA_CHECK_OPTIONS = (
+    'minimum_size',
+    'maximum_age',
+    'expected_file_count',
+    'maximum_size_change',
+)
+
+
+def raise_if_cancelled(cancel_event):
+    """Stop processing a repo if a sibling repo has failed."""
+    if cancel_event is not None and cancel_event.is_set():
+        raise RunCancelled('Cancelled due to failure of another repo.')
+
+
+def _decode_lines(output):
+    """Split command output into a list of str lines."""
+    return output.decode('UTF-8', 'replace').splitlines()
+
+
+def run_check(check, path, stdin=None):
+    """Run a check against a file.
+    Checks with a plugin are run in-process, others by running their command.
+
+    :param check: The check_files entry to run.
+    :param path: The path of the file to check.
+    :param stdin: Optional pipe streaming the file, used instead of path.
+
+    :returns: A CheckResult.
+    """
+    plugin = get_plugin(check)
+    if plugin:
+        source = path if stdin is None else stdin
+        try:
+            return plugin(source, check.get('arguments') or [])
+        except Exception as err:  # pylint: disable=broad-except
+            # A broken plugin should fail its check, not the whole run.
+            return CheckResult(
+                passed=False,
+                messages=[],
+                errors=['Check plugin failed: {err}'.format(err=err)],
+                metrics={},
+            )
+
+    if stdin is not None:
+        path = '-'
+    check_command = [os.path.join('check_commands', check['command'])]
+    check_command.extend(check.get('arguments') or [])
+    check_command.append(path)
+
+    proc = subprocess.Popen(
+        check_command,
+        stdin=stdin,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    stdout, stderr = proc.communicate()
+    return CheckResult(
+        passed=proc.returncode == 0,
+        messages=_decode_lines(stdout),
+        errors=_decode_lines(stderr),
+        metrics={},
+    )
+
+
+def run_streamed_check(repo, archive_name, check):
+    """Run a check with the file streamed from the archive.
+    Nothing is written to disk, and the check starts as soon as borg starts
+    producing the file.
+
+    :raises CommandTimeout: If borg's extract timeout expired.
+
+    :returns: A CheckResult.
+    """
+    stream = repo.stream_file_from_archive(archive_name, check['path'])
+    try:
+        result = run_check(check, None, stdin=stream.stdout)
+        # borg either writes more of the file or closes the pipe once it
+        # exits, so this waits until it is known whether the check stopped
+        # reading early.
+        stopped_early = os.read(stream.stdout.fileno(), 1) != b''
+    finally:
+        # Closing our end of the pipe means borg will stop if the check
+        # finished without reading everything.
+        stream.stdout.close()
+        returncode = stream.wait()
+
+    if returncode != 0:
+        # borg's output was logged as it ran.
+        error = 'Streaming {path} from the archive exited with code {code}.'
+        if not stopped_early:
+            # The check may have passed on part of the file.
+            result = result._replace(passed=False)
+        elif result.passed:
+            # borg was stopped by the check closing the pipe, which is
+            # expected of a check needing only part of the file.
+            error = ('Streaming {path} from the archive stopped with code '
+                     '{code} as the check did not read all of it.')
+        result.errors.append(
+            error.format(path=check['path'], code=returncode)
+        )
+    return result
+
+
+def _log_result(check, result, logger):
+    """Log the output of a check, tagging each line with the check path."""
+    def tag(line):
+        return '[{path}] {line}'.format(path=check['path'], line=line)
+
+    for line in result.messages:
+        logger.info(tag(line))
+    for name, value in sorted(result.metrics.items()):
+        logger.info(tag('{name}: {value}'.format(name=name, value=value)))
+    if result.passed:
+        output = logger.warning
+    else:
+        logger.error(tag('Backup integrity check failed!'))
+        output = logger.error
+    for line in result.errors:
+        output(tag(line))
+
+
+def run_checks(repo, archive_name, checks, extract_dir, logger,
+               concurrency=1, cancel_event=None, metrics=None):
+    """Run check_files entries, with up to concurrency checks at once.
+    Output from each check is logged as soon as it completes.
+
+    :param repo: The BorgRepo the archive is in.
+    :param archive_name: The archive being checked.
+    :param checks: The check_files entries to run.
+    :param extract_dir: Where non-streamed check files were extracted.
+    :param logger: A logger to provide check output.
+    :param concurrency: The maximum number of checks to run at once.
+    :param cancel_event: Optional threading.Event which, when set, stops
+                         any checks which have not yet started.
+    :param metrics: Optional RunMetrics to record each check's timing in.
+
+    :returns: A list of (check, CheckResult) tuples.
+    """
+    def run(check):
+        raise_if_cancelled(cancel_event)
+        if metrics is None:
+            return run_one(check)
+        with metrics.phase(repo.repo, 'check ' + check['path']):
+            return run_one(check)
+
+    def run_one(check):
+        if check.get('stream'):
+            return run_streamed_check(repo, archive_name, check)
+        return run_check(
+            check,
+            os.path.join(extract_dir, check['path'].lstrip('/')),
+        )
+
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(run, check): check
+            for check in checks
+        }
+        for future in as_completed(futures):
+            result = future.result()
+            _log_result(futures[future], result, logger)
+            results.append((futures[future], result))
+    return results
+
+
+def has_content_check(check):
+    """Determine whether a check_files entry checks its files' content."""
+    return bool(check.get('command') or check.get('plugin'))
+
+
+def has_metadata_check(check):
+    """Determine whether a check_files entry has any metadata checks."""
+    return any(check.get(option) for option in METADATA_CHECK_OPTIONS)
+
+
+def _summarise_paths(records, paths):
+    """Total up the archive listing for each checked path.
+
+    :param records: FileRecords from the archive listing.
+    :param paths: The checked paths, without leading /.
+
+    :returns: A dict keyed on path of dicts with found, size, files (the
+              count of regular files) and newest (the latest file mtime).
+    """
+    summaries = {
+        path: {'found': False, 'size': 0, 'files': 0, 'newest': None}
+        for path in paths
+    }
+    for record in records:
+        for path in paths:
+            if not (record.path == path
+                    or record.path.startswith(path.rstrip('/') + '/')):
+                continue
+            summary = summaries[path]
+            summary['found'] = True
+            if record.type == '-':
+                summary['size'] += record.size
+                summary['files'] += 1
+                newest = summary['newest']
+                if newest is None or record.mtime > newest:
+                    summary['newest'] = record.mtime
+    return summaries
+
+
+def _evaluate_metadata(check, summary, previous, now):
+    """Evaluate a check_files entry's metadata checks against its listing.
+
+    :param check: The check_files entry.
+    :param summary: The path's summary, from _summarise_paths.
+    :param previous: The path's size and the archive it is from, in the
+                     previous archive of the same sources, or None if there
+                     is no previous archive.
+    :param now: The current time, as a naive local datetime like borg's.
+
+    :returns: A CheckResult.
+    """
+    if not summary['found']:
+        return CheckResult(
+            passed=False,
+            messages=[],
+            errors=['Not found in the archive.'],
+            metrics={},
+        )
+
+    size = summary['size']
+    errors = []
+    minimum_size = check.get('minimum_size')
+    if minimum_size and size < convert_size_input(minimum_size):
+        errors.append(
+            'Size of {size} bytes is below the minimum of {minimum}.'.format(
+                size=size, minimum=minimum_size,
+            )
+        )
+
+    maximum_age = check.get('maximum_age')
+    if maximum_age:
+        if summary['newest'] is None:
+            errors.append('No files found to check the age of.')
+        else:
+            age = (now - summary['newest']).total_seconds()
+            if age > convert_duration_input(maximum_age):
+                errors.append(
+                    'Last modified {age:.0f}s ago, longer ago than the '
+                    'maximum of {maximum}.'.format(
+                        age=age, maximum=maximum_age,
+                    )
+                )
+
+    expected_file_count = check.get('expected_file_count')
+    if expected_file_count and summary['files'] < expected_file_count:
+        errors.append(
+            'Found {files} files, expected at least {expected}.'.format(
+                files=summary['files'], expected=expected_file_count,
+            )
+        )
+
+    # Size changes which can't be checked are reported, but don't fail.
+    warnings = []
+    maximum_size_change = check.get('maximum_size_change')
+    if maximum_size_change and previous is None:
+        warnings.append(
+            'No earlier archive to compare the size with, so '
+            'maximum_size_change was not checked.'
+        )
+    elif maximum_size_change and not previous['size']:
+        warnings.append(
+            'Not found or empty in the previous archive {archive}, so '
+            'maximum_size_change was not checked.'.format(
+                archive=previous['archive'],
+            )
+        )
+    elif maximum_size_change:
+        change = abs(size - previous['size']) * 100 / previous['size']
+        if change > maximum_size_change:
+            errors.append(
+                'Size changed by {change:.1f}% from {previous} bytes in '
+                'archive {archive}, more than the maximum of '
+                '{maximum}%.'.format(
+                    change=change,
+                    previous=previous['size'],
+                    archive=previous['archive'],
+                    maximum=maximum_size_change,
+                )
+            )
+
+    return CheckResult(
+        passed=not errors,
+        messages=[],
+        errors=errors + warnings,
+        metrics={'size': size, 'files': summary['files']},
+    )
+
+
+def run_metadata_checks(repo, archive_name, checks, logger,
+                        previous_archive=None):
+    """Run the metadata checks of check_files entries from one listing of
+    the archive. No file content is read.
+
+    :param repo: The BorgRepo the archive is in.
+    :param archive_name: The archive being checked.
+    :param checks: The check_files entries with metadata checks.
+    :param logger: A logger to provide check output.
+    :param previous_archive: The previous archive of the same sources,
+                             which maximum_size_change compares against.
+
+    :returns: A list of (check, CheckResult) tuples.
+    """
+    paths = sorted({check['path'].lstrip('/') for check in checks})
+    now = datetime.now()
+    try:
+        summaries = _summarise_paths(
+            repo.iter_files_in_archive(archive_name, paths), paths,
+        )
+    except subprocess.CalledProcessError as err:
+        summaries = None
+        listing_error = 'Could not list the archive: {err}'.format(err=err)
+
+    size_change_paths = sorted({
+        check['path'].lstrip('/') for check in checks
+        if check.get('maximum_size_change')
+    })
+    previous_summaries = {}
+    if previous_archive and size_change_paths:
+        try:
+            previous_summaries = _summarise_paths(
+                repo.iter_files_in_archive(
+                    previous_archive, size_change_paths,
+                ),
+                size_change_paths,
+            )
+        except subprocess.CalledProcessError as err:
+            logger.warning(
+                'Could not list the previous archive {archive} to compare '
+                'sizes with: {err}'.format(archive=previous_archive, err=err)
+            )
+
+    results = []
+    for check in checks:
+        path = check['path'].lstrip('/')
+        previous = None
+        if previous_archive:
+            previous = {
+                'size': previous_summaries.get(path, {}).get('size', 0),
+                'archive': previous_archive,
+            }
+        if summaries is None:
+            result = CheckResult(
+                passed=False, messages=[], errors=[listing_error], metrics={},
+            )
+        else:
+            result = _evaluate_metadata(check, summaries[path], previous, now)
+        _log_result(check, result, logger)
+        results.append((check, result))
+    return results
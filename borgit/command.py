@@ -1,117 +1,771 @@
 #! /usr/bin/env python3
 """Script for automation of borg backups, including testing the backups.
 This wants to keep one local and remote copy."""
-import os
-import shutil
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
-import tempfile
+import threading
+import time
 
-from borgit.exceptions import CheckFailure
+from borgit.checks import (
+    CheckResult,
+    has_content_check,
+    has_metadata_check,
+    raise_if_cancelled,
+    run_checks,
+    run_metadata_checks,
+)
+from borgit.data import convert_duration_input
+from borgit.estimate import enforce_window, estimate_run
+from borgit.exceptions import (
+    CheckFailure,
+    RepositoryCorrupt,
+    RunCancelled,
+    ScratchSpaceError,
+)
+from borgit.journal import get_journal
+from borgit.ledger import filter_verified_checks, get_ledger
+from borgit.metrics import RunMetrics, write_metrics
 from borgit.repo import BorgRepo
+from borgit.retention import get_retention_policy, group_archives
+from borgit.sampling import get_sample_verifier
+from borgit.scratch import get_scratch_space, plan_restores
+from borgit.shards import (
+    get_shard_assigner,
+    shard_location,
+    ShardedBorgRepo,
+)
+from borgit.sources import get_source_paths, part_for_path, plan_backup
+from borgit.ssh import multiplex_ssh
+from borgit.verification import get_verification_policy
 
 
-def get_repos(config):
+class _RepoLogger:
+    """Wrap a logger so that every message is tagged with its repo name.
+    This keeps the output of repos processed concurrently distinguishable.
+    """
+    def __init__(self, logger, repo_name):
+        """Initialise the tagging logger."""
+        self._logger = logger
+        self.repo_name = repo_name
+
+    def _tag(self, message):
+        """Prefix the message with the repo name."""
+        if isinstance(message, bytes):
+            message = message.decode('UTF-8', 'replace')
+        return '[{repo}] {message}'.format(
+            repo=self.repo_name,
+            message=message,
+        )
+
+    def info(self, message):
+        """Emit a tagged info message."""
+        self._logger.info(self._tag(message))
+
+    def warning(self, message):
+        """Emit a tagged warning message."""
+        self._logger.warning(self._tag(message))
+
+    def error(self, message):
+        """Emit a tagged error message."""
+        self._logger.error(self._tag(message))
+
+
+class Replication:
+    """Hand an archive from the repo that backed it up to a repo copying it.
+    This lets the copy wait for the archive when repos run concurrently."""
+    def __init__(self, source):
+        """Initialise the hand over from the source BorgRepo."""
+        self.source = source
+        self._finished = threading.Event()
+        self._created = False
+
+    def archive_created(self):
+        """Signal that the source's archive exists and can be copied."""
+        self._created = True
+        self._finished.set()
+
+    def source_finished(self):
+        """Signal that the source will not create its archive if it has not
+        already done so."""
+        self._finished.set()
+
+    def wait(self, cancel_event=None):
+        """Wait until the source's archive can be copied.
+
+        :raises RunCancelled: If the source did not create the archive.
+        """
+        self._finished.wait()
+        raise_if_cancelled(cancel_event)
+        if not self._created:
+            raise RunCancelled(
+                'Cannot copy the archive as its backup did not complete.'
+            )
+
+
+def get_replication(repos, config):
+    """Get the Replication for a run, or None if each repo is to be backed
+    up from the sources."""
+    if config.get('replication_mode') == 'export_tar':
+        return Replication(repos['local'])
+    return None
+
+
+def get_repos(config, scratch, logger=None):
     """Get the local and remote repos to perform backup tasks.
 
     :param config: A valid borg config dict.
+    :param scratch: The ScratchSpace to make the repos' working directories
+                    in (see get_scratch_space). The repos can't be used
+                    after it is cleaned up.
+    :param logger: Optional logger for borg's output.
 
-    :returns: A dict containing 'local' and 'remote' keys. The value of each
-              is a BorgRepo object referring to the specified repo.
+    :returns: A dict of BorgRepo objects, keyed on name. The local repo is
+              first, under 'local', followed by the remote_destination_path
+              repo (if configured) under 'remote', then each of the
+              remote_repositories by priority. If shard_count is more than
+              one, each is a ShardedBorgRepo instead.
     """
-    local_args = {
-        'repo': config['local_destination_path'],
-        'repo_key': config['repo_passphrase'],
-        'working_directory': tempfile.mkdtemp(
-            prefix=config['working_directory'],
-        ),
-    }
-    remote_args = {
-        'repo': config['remote_destination_path'],
-        'repo_key': config['repo_passphrase'],
-        'working_directory': tempfile.mkdtemp(
-            prefix=config['working_directory'],
-        ),
-    }
-    return {
-        'local': BorgRepo(**local_args),
-        'remote': BorgRepo(**remote_args),
-    }
+    timeout = config.get('borg_timeout')
+    if timeout:
+        timeout = convert_duration_input(timeout)
+
+    targets = [('local', config['local_destination_path'], {})]
+    if config.get('remote_destination_path'):
+        targets.append(('remote', config['remote_destination_path'], {}))
+    targets.extend(
+        (target['name'], target['path'], target)
+        for target in sorted(
+            config.get('remote_repositories') or [],
+            # Unset priorities take the config default of 100.
+            key=lambda target: target.get('priority') or 100,
+        )
+    )
+
+    checkpoint_interval = config.get('checkpoint_interval')
+    if checkpoint_interval:
+        checkpoint_interval = convert_duration_input(checkpoint_interval)
+
+    shard_count = config.get('shard_count') or 1
+    if shard_count > 1:
+        assigner = get_shard_assigner(config)
+        assignments = assigner.assign(get_source_paths(config))
+
+    repos = {}
+    for repo_name, path, settings in targets:
+        lock_wait = settings.get('lock_wait')
+        shards = []
+        for index in range(shard_count):
+            shard_name = repo_name
+            if shard_count > 1:
+                shard_name += ':shard{number}'.format(number=index + 1)
+            shards.append(BorgRepo(
+                repo=shard_location(path, index),
+                repo_key=config['repo_passphrase'],
+                working_directory=scratch.directory_for('repo-'),
+                logger=logger and _RepoLogger(logger, shard_name),
+                timeout=timeout,
+                lock_wait=lock_wait and convert_duration_input(lock_wait),
+                remote_ratelimit=settings.get('upload_ratelimit'),
+                checkpoint_interval=checkpoint_interval,
+            ))
+        if shard_count > 1:
+            repos[repo_name] = ShardedBorgRepo(shards, assigner, assignments)
+        else:
+            repos[repo_name] = shards[0]
+    return repos
 
 
-def pre_backup_check(repos):
+def pre_backup_check(repos, config, logger, metrics=None, journal=None):
     """Check the repos before the backup commences.
 
     :param repos: Repos obtained via a get_repos call.
+    :param config: A valid borg config dict.
+    :param logger: A logger to provide check output.
+    :param metrics: Optional RunMetrics to record the checks' timings in.
+    :param journal: Optional RunJournal. Repos already checked in this run
+                    are skipped.
     """
-    for repo in 'local', 'remote':
-        repos[repo].check()
+    metrics = metrics or RunMetrics(None)
+    for repo_name, repo in repos.items():
+        if _completed(journal, repo, 'pre-check'):
+            continue
+        with metrics.phase(repo.repo, 'pre-check'):
+            get_verification_policy(
+                config, repo, _RepoLogger(logger, repo_name),
+            ).pre_backup()
+        _complete(journal, repo, 'pre-check')
+
 
-        # TODO: Check the ordering of this is deterministic
-        most_recent_archive = repos[repo].list_archives()[-1]
-        repos[repo].check_archive(most_recent_archive)
+def _completed(journal, repo, phase):
+    """Find whether the journal shows a phase completed for a repo."""
+    return journal is not None and journal.is_done(repo.repo, phase)
 
 
-def perform_backup(repo, archive_name, config, logger):
+def _complete(journal, repo, phase):
+    """Record in the journal, if any, that a phase completed for a repo."""
+    if journal is not None:
+        journal.mark_done(repo.repo, phase)
+
+
+def perform_backup(repo, archive_name, config, logger, cancel_event=None,
+                   metrics=None, replication=None, journal=None,
+                   scratch=None):
     """Perform a backup to the specified repo, and validate the files.
+    If source_settings split the sources between several archives, each of
+    them is created and checked (see borgit.sources).
 
     :param repo: A BorgRepo object.
     :param config: A valid borg config dict.
     :param logger: A logger to provide file validation output.
+    :param cancel_event: Optional threading.Event which, when set, stops the
+                         backup before its next phase.
+    :param metrics: Optional RunMetrics to record the backup's statistics
+                    and the timings of each phase in.
+    :param replication: Optional Replication. Unless repo is its source, the
+                        archives are copied from the source instead of
+                        backing up the sources again.
+    :param journal: Optional RunJournal. Phases it shows completed for repo
+                    are skipped, and completed phases are recorded in it.
+    :param scratch: Optional ScratchSpace to restore files for checking
+                    into. By default one is made from the config.
+
+    If keep_* settings are configured, old archives are deleted once the
+    new ones have passed all checks (see borgit.retention).
     """
-    repo.backup(archive_name, config['backup_source_paths'])
+    metrics = metrics or RunMetrics(archive_name)
+    plan = plan_backup(config, archive_name)
+    resume = bool(journal and journal.resumed)
+    raise_if_cancelled(cancel_event)
+    if _completed(journal, repo, 'backup'):
+        logger.info('Archive was already created, skipping backup.')
+        stats = []
+        if replication and repo is replication.source:
+            replication.archive_created()
+    elif replication and repo is not replication.source:
+        replication.wait(cancel_event)
+        with metrics.phase(repo.repo, 'replicate'):
+            stats = [
+                repo.import_archive(
+                    replication.source, part.archive_name,
+                    part.compression, part.chunker_params, resume,
+                )
+                for part in plan
+            ]
+    else:
+        try:
+            with metrics.phase(repo.repo, 'backup'):
+                stats = [
+                    repo.backup(
+                        part.archive_name, part.sources,
+                        part.compression, part.chunker_params, resume,
+                    )
+                    for part in plan
+                ]
+            if replication:
+                replication.archive_created()
+        finally:
+            if replication:
+                replication.source_finished()
+    _complete(journal, repo, 'backup')
+    stats = _combine_stats(stats)
+    if stats is not None:
+        metrics.record_backup(repo.repo, stats)
 
     integrity_failure = False
-    for check in config.get('check_files', []):
-        check_command = [os.path.join('check_commands', check['command'])]
-        path = os.path.join(
-            config['working_directory'],
-            check['path'].lstrip('/')
-        )
+    if not _completed(journal, repo, 'checks'):
+        own_scratch = scratch is None
+        if own_scratch:
+            scratch = get_scratch_space(config, logger)
+        try:
+            integrity_failure = _check_files(
+                repo, plan, archive_name, config, logger, cancel_event,
+                metrics, scratch,
+            )
+        finally:
+            if own_scratch:
+                scratch.cleanup()
+        if not integrity_failure:
+            _complete(journal, repo, 'checks')
+
+    # Make sure we fail noisily if for whatever reason the archive has become
+    # corrupted.
+    raise_if_cancelled(cancel_event)
+    if not _completed(journal, repo, 'post-check'):
+        with metrics.phase(repo.repo, 'post-check'):
+            get_verification_policy(config, repo, logger).post_backup(
+                *[part.archive_name for part in plan]
+            )
+        _complete(journal, repo, 'post-check')
+
+    if integrity_failure:
+        raise CheckFailure('Backup file checks failed.')
+
+    retention = get_retention_policy(config, repo, logger)
+    if retention and not _completed(journal, repo, 'retention'):
+        archive_names = [part.archive_name for part in plan]
+        retention.record_verified(archive_names)
+        raise_if_cancelled(cancel_event)
+        with metrics.phase(repo.repo, 'retention'):
+            retention.apply(archive_names)
+        _complete(journal, repo, 'retention')
+
+
+def _check_files(repo, plan, archive_name, config, logger, cancel_event,
+                 metrics, scratch):
+    """Run the configured check_files and sample verification on the
+    archives of a backup.
+
+    :returns: True if any check failed.
+    """
+    integrity_failure = False
+    checks = config.get('check_files') or []
+    check_archives = {
+        check['path']: part_for_path(plan, check['path']).archive_name
+        for check in checks
+    }
 
-        check_command.extend(check['arguments'])
-        check_command.append(path)
+    # Metadata checks only need the archive listing, so are cheap enough to
+    # run every time.
+    metadata_checks = [check for check in checks if has_metadata_check(check)]
+    previous_archives = {}
+    if any(check.get('maximum_size_change') for check in metadata_checks):
+        previous_archives = _previous_archives(
+            repo, plan, archive_name, config,
+        )
+    for archive, archive_checks in _by_archive(
+            metadata_checks, check_archives):
+        raise_if_cancelled(cancel_event)
+        with metrics.phase(repo.repo, 'metadata-check'):
+            results = run_metadata_checks(
+                repo, archive, archive_checks, logger,
+                previous_archives.get(archive),
+            )
+        if not all(result.passed for _, result in results):
+            integrity_failure = True
 
-        repo.restore_file_from_archive(archive_name, check['path'])
+    checks = [check for check in checks if has_content_check(check)]
+    ledger = get_ledger(config, repo)
+    fingerprints = {}
+    if ledger and checks:
+        known = ledger.known_fingerprints()
+        try:
+            with metrics.phase(repo.repo, 'fingerprint'):
+                for archive, archive_checks in _by_archive(
+                        checks, check_archives):
+                    fingerprints.update(repo.get_fingerprints(
+                        archive, [check['path'] for check in archive_checks],
+                        known,
+                    ))
+        except (subprocess.CalledProcessError, KeyError, ValueError) as err:
+            # Borg failed, or listed items without the keys fingerprints
+            # are made from.
+            logger.warning(
+                'Could not fingerprint checked files, all will be '
+                'checked: {err!r}'.format(err=err)
+            )
+            fingerprints = {}
+        ledger.record_fingerprints(fingerprints)
+        checks = filter_verified_checks(
+            ledger, checks, fingerprints, archive_name, logger,
+            full_verify_interval=config.get('full_verify_interval'),
+        )
 
-        proc = subprocess.Popen(
-            check_command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+    for archive, archive_checks in _by_archive(checks, check_archives):
+        results = _run_archive_checks(
+            repo, archive, archive_checks, config, logger, cancel_event,
+            metrics, scratch,
         )
-        stdout, stderr = proc.communicate()
-        for line in stdout.splitlines():
-            logger.info(line)
-        if proc.returncode != 0:
-            logger.error('Backup integrity check failed!')
-            output = logger.error
+        for check, result in results:
+            fingerprint = fingerprints.get(check['path'].lstrip('/'))
+            if not result.passed:
+                integrity_failure = True
+            elif ledger and fingerprint:
+                ledger.record_pass(check, fingerprint, archive)
+
+    sample_verifier = get_sample_verifier(config, repo, logger, scratch)
+    if sample_verifier:
+        raise_if_cancelled(cancel_event)
+        with metrics.phase(repo.repo, 'sample-verify'):
+            result = sample_verifier.verify(
+                [part.archive_name for part in plan],
+            )
+        if result.mismatched:
             integrity_failure = True
+    return integrity_failure
+
+
+def _combine_stats(stats):
+    """Combine the statistics of each archive a backup created.
+    Archives a resumed run found already created are left out, and None is
+    returned if there are no others."""
+    stats = [archive_stats for archive_stats in stats
+             if archive_stats is not None]
+    if not stats:
+        return None
+    if len(stats) == 1:
+        return stats[0]
+    combined = {}
+    for archive_stats in stats:
+        for key, value in archive_stats.items():
+            if value is not None:
+                combined[key] = combined.get(key, 0) + value
+    return combined
+
+
+def _previous_archives(repo, plan, archive_name, config):
+    """Find the archive each part of a backup was last backed up to before
+    it, e.g. to compare sizes with.
+
+    :returns: A dict of archive names keyed on the name of each part's
+              archive, omitting parts with no earlier archive.
+    """
+    groups = group_archives(repo.iter_archives(), [
+        setting['name'] for setting in config.get('source_settings') or []
+    ])
+    previous = {}
+    for part in plan:
+        group = None
+        if part.archive_name != archive_name:
+            group = part.archive_name[len(archive_name) + 1:]
+        latest = max(
+            [archive for archive in groups.get(group, [])
+             if archive.name != part.archive_name],
+            default=None,
+            key=lambda archive: archive.start,
+        )
+        if latest is not None:
+            previous[part.archive_name] = latest.name
+    return previous
+
+
+def _by_archive(checks, check_archives):
+    """Group checks by the archive their files are in."""
+    grouped = {}
+    for check in checks:
+        grouped.setdefault(check_archives[check['path']], []).append(check)
+    return grouped.items()
+
+
+def _restore_sizes(repo, archive_name, paths):
+    """Get the total size of the files at or under each path in an archive,
+    from its listing."""
+    sizes = {path: 0 for path in paths}
+    for item in repo.iter_files_in_archive(archive_name, paths):
+        item_path = '/' + item.path
+        for path in paths:
+            prefix = '/' + path.strip('/')
+            if item_path == prefix or item_path.startswith(prefix + '/'):
+                sizes[path] += item.size
+    return sizes
+
+
+def _run_archive_checks(repo, archive_name, checks, config, logger,
+                        cancel_event, metrics, scratch):
+    """Run the checks on files in one archive.
+    Files to be checked are restored in batches, sized from the archive
+    listing to fit the scratch space budget.
+
+    :returns: A list of (check, CheckResult) tuples.
+    """
+    def check_batch(batch, extract_dir):
+        return run_checks(
+            repo, archive_name, batch, extract_dir, logger,
+            concurrency=config.get('check_concurrency') or 1,
+            cancel_event=cancel_event,
+            metrics=metrics,
+        )
+
+    results = []
+    streamed = [check for check in checks if check.get('stream')]
+    if streamed:
+        results.extend(check_batch(streamed, None))
+
+    extracted = [check for check in checks if not check.get('stream')]
+    if not extracted:
+        return results
+    sizes = _restore_sizes(
+        repo, archive_name, [check['path'] for check in extracted],
+    )
+    for batch, size in plan_restores(
+            [(check, sizes[check['path']]) for check in extracted],
+            scratch.budget):
+        raise_if_cancelled(cancel_event)
+        try:
+            # Each batch is extracted by one borg call into a directory of
+            # its own, so it can all be removed in one pass.
+            with scratch.restore_directory(size) as extract_dir:
+                with metrics.phase(repo.repo, 'restore'):
+                    repo.restore_files_from_archive(
+                        archive_name,
+                        [check['path'] for check in batch],
+                        destination=extract_dir,
+                    )
+                results.extend(check_batch(batch, extract_dir))
+        except ScratchSpaceError as err:
+            for check in batch:
+                logger.error('[{path}] {err}'.format(
+                    path=check['path'], err=err,
+                ))
+                results.append((check, CheckResult(
+                    passed=False,
+                    messages=[],
+                    errors=[str(err)],
+                    metrics={},
+                )))
+    return results
+
+
+def _run_pipeline(repo_name, repo, archive_name, config, logger,
+                  cancel_event, metrics, replication=None, journal=None,
+                  scratch=None):
+    """Check, back up and verify a single repo.
+
+    :returns: The time taken, in seconds.
+    """
+    start = time.monotonic()
+    repo_logger = _RepoLogger(logger, repo_name)
+    error = None
+    try:
+        raise_if_cancelled(cancel_event)
+        if not _completed(journal, repo, 'pre-check'):
+            with metrics.phase(repo.repo, 'pre-check'):
+                get_verification_policy(
+                    config, repo, repo_logger,
+                ).pre_backup()
+            _complete(journal, repo, 'pre-check')
+        perform_backup(repo, archive_name, config, repo_logger,
+                       cancel_event=cancel_event, metrics=metrics,
+                       replication=replication, journal=journal,
+                       scratch=scratch)
+    except RepositoryCorrupt as err:
+        error = err
+        repo_logger.error(str(err))
+        cancel_event.set()
+        raise
+    except RunCancelled as err:
+        error = err
+        repo_logger.warning(str(err))
+        raise
+    except Exception as err:
+        error = err
+        raise
+    finally:
+        if replication and repo is replication.source:
+            # Don't leave a copying repo waiting if this failed early.
+            replication.source_finished()
+        duration = time.monotonic() - start
+        metrics.record_target(repo_name, repo.repo, duration, error)
+        repo_logger.info(
+            'Pipeline finished in {duration:.1f}s.'.format(duration=duration)
+        )
+    return duration
+
+
+def run_backup(repos, archive_name, config, logger, concurrent=False,
+               scratch=None):
+    """Back up to all repos, validating them before and after the backup.
+
+    :param repos: Repos obtained via a get_repos call.
+    :param archive_name: Name of the archive to create in each repo.
+    :param config: A valid borg config dict.
+    :param logger: A logger to provide backup and validation output.
+    :param concurrent: If True, repos are processed concurrently, with up
+                       to max_concurrent_uploads remote repos at once.
+                       A corrupt repo will cancel the others, but other
+                       failures only stop the repo they happen to.
+    :param scratch: Optional ScratchSpace to restore files into, usually
+                    the one passed to get_repos. It is left for the caller
+                    to clean up. By default one is made for the run.
+
+    :raises RepositoryCorrupt: If any repo fails an integrity check. Backups
+                               will not be attempted (or will be cancelled
+                               if concurrent) once this is found.
+    :raises CheckFailure: If file checks failed for any repo. Repos which
+                          were cancelled as a result are logged separately.
+    :raises OutsideBackupWindow: If backup_window is set and the run is
+                                 forecast not to fit in it (see
+                                 borgit.estimate).
+
+    If a state_directory is configured, a run which is interrupted by any
+    other error is resumed by the next run: it uses the interrupted run's
+    archive name instead of archive_name, and skips the phases which
+    completed (see borgit.journal).
+
+    :returns: The RunMetrics for the run. These are also written to any
+              configured metrics destinations, even if the run fails.
+    """
+    if config.get('backup_window'):
+        enforce_window(estimate_run(repos, config), config, logger,
+                       concurrent)
+    journal = get_journal(config)
+    if journal:
+        archive_name = journal.begin(archive_name, logger)
+    own_scratch = scratch is None
+    if own_scratch:
+        scratch = get_scratch_space(config, logger)
+    metrics = RunMetrics(archive_name)
+    for repo in repos.values():
+        repo.metrics = metrics
+    succeeded = False
+    try:
+        if config.get('ssh_multiplex', True):
+            ssh_repos = repos
         else:
-            output = logger.warning
-        for line in stderr.splitlines():
-            output(line)
+            ssh_repos = {}
+        with multiplex_ssh(ssh_repos, logger, metrics):
+            if concurrent:
+                _run_concurrently(repos, archive_name, config, logger,
+                                  metrics, journal, scratch)
+            else:
+                _run_sequentially(repos, archive_name, config, logger,
+                                  metrics, journal, scratch)
+        succeeded = True
+        if journal:
+            journal.finish()
+    except (CheckFailure, RepositoryCorrupt):
+        # The run completed as far as it could. Running it again would not
+        # fix these, so the next run starts afresh.
+        if journal:
+            journal.finish()
+        raise
+    finally:
+        if own_scratch:
+            scratch.cleanup()
+        metrics.finish(succeeded)
+        _log_targets(metrics, logger)
+        write_metrics(metrics, config, logger)
+    return metrics
+
 
-        if os.path.isdir(path):
-            shutil.rmtree(path)
+def _log_targets(metrics, logger):
+    """Report the outcome of each repo of a run."""
+    for target in metrics.report()['targets']:
+        if target['succeeded']:
+            logger.info('{target}: succeeded in {duration:.1f}s.'.format(
+                **target
+            ))
         else:
-            os.unlink(path)
+            logger.error(
+                '{target}: failed after {duration:.1f}s: {error}'.format(
+                    **target
+                )
+            )
 
-    # Make sure we fail noisily if for whatever reason the archive has become
-    # corrupted.
-    repo.check()
-    repo.check_archive(archive_name)
 
-    if integrity_failure:
-        raise CheckFailure('Backup file checks failed.')
+def _run_sequentially(repos, archive_name, config, logger, metrics,
+                      journal=None, scratch=None):
+    """Check all repos, then back up to and verify each in turn."""
+    pre_backup_check(repos, config, logger, metrics, journal)
+    replication = get_replication(repos, config)
+    check_failures = []
+    for repo_name, repo in repos.items():
+        start = time.monotonic()
+        error = None
+        try:
+            perform_backup(repo, archive_name, config,
+                           _RepoLogger(logger, repo_name), metrics=metrics,
+                           replication=replication, journal=journal,
+                           scratch=scratch)
+        except CheckFailure as err:
+            # Repository corruption will abort, but file check failures
+            # should not prevent the other backups being taken.
+            error = err
+            check_failures.append(repo_name)
+        except Exception as err:
+            error = err
+            raise
+        finally:
+            metrics.record_target(repo_name, repo.repo,
+                                  time.monotonic() - start, error)
+    if check_failures:
+        raise CheckFailure(
+            'Backup file checks failed for: {repos}'.format(
+                repos=', '.join(check_failures),
+            )
+        )
+
+
+def _run_concurrently(repos, archive_name, config, logger, metrics,
+                      journal=None, scratch=None):
+    """Run the pipeline for each repo in a worker.
+    The local repo has a worker of its own. Remote repos share up to
+    max_concurrent_uploads workers, starting in the order of repos, so a
+    slow remote only holds up the others if all the workers are busy."""
+    cancel_event = threading.Event()
+    replication = get_replication(repos, config)
+    start = time.monotonic()
+    uploads = config.get('max_concurrent_uploads') or 2
+    # A corrupt repo stops the borg commands running for the others too,
+    # rather than waiting for them to reach their next phase.
+    for repo in repos.values():
+        repo.cancel_event = cancel_event
+    try:
+        with ThreadPoolExecutor(max_workers=1) as local_executor, \
+                ThreadPoolExecutor(max_workers=uploads) as upload_executor:
+            futures = {}
+            for repo_name, repo in repos.items():
+                if repo_name == 'local':
+                    executor = local_executor
+                else:
+                    executor = upload_executor
+                futures[repo_name] = executor.submit(
+                    _run_pipeline, repo_name, repo, archive_name, config,
+                    logger, cancel_event, metrics, replication, journal,
+                    scratch,
+                )
+    finally:
+        for repo in repos.values():
+            repo.cancel_event = None
+    wall_time = time.monotonic() - start
+
+    durations = {}
+    errors = {}
+    for repo_name, future in futures.items():
+        err = future.exception()
+        if err:
+            errors[repo_name] = err
+        else:
+            durations[repo_name] = future.result()
+
+    if not errors:
+        logger.info(
+            'Concurrent run took {wall:.1f}s, saving {saved:.1f}s compared '
+            'to processing each repo in turn.'.format(
+                wall=wall_time,
+                saved=sum(durations.values()) - wall_time,
+            )
+        )
+
+    for repo_name, err in errors.items():
+        if isinstance(err, RepositoryCorrupt):
+            raise err
+    for err in errors.values():
+        if not isinstance(err, (CheckFailure, RunCancelled)):
+            raise err
+    check_failures = sorted(
+        repo_name for repo_name, err in errors.items()
+        if isinstance(err, CheckFailure)
+    )
+    cancelled = sorted(
+        repo_name for repo_name, err in errors.items()
+        if isinstance(err, RunCancelled)
+    )
+    if cancelled:
+        logger.warning('Cancelled before finishing: {repos}'.format(
+            repos=', '.join(cancelled),
+        ))
+    if check_failures:
+        raise CheckFailure(
+            'Backup file checks failed for: {repos}'.format(
+                repos=', '.join(check_failures),
+            )
+        )
+    if cancelled:
+        raise RunCancelled('Cancelled before finishing: {repos}'.format(
+            repos=', '.join(cancelled),
+        ))
+
 
-# run_backup command:
-    #   0. Validate local and remote repositories, abort if one corrupt, but not if
-    # file check failed)
-#   1. Do backup to local location
-#   2. Validate local backup (abort if repository corrupt, but not if file check
-#   failed)
-# 3. Do backup to remote location
-# 4. Validate remote backup
-#
 # Also needed:
 #  - config_validate command
 #  - validate_backup command
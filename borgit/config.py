@@ -1,11 +1,27 @@
 """Tools for handling borgit config."""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+
+import yaml
+
 from borgit.data import(
+    validate_boolean,
+    validate_chunker_params,
+    validate_compression,
+    validate_duration_input,
     validate_local_executable,
     validate_local_file_path,
+    validate_positive_integer,
     validate_remote_borg_address,
+    validate_replication_mode,
     validate_size_input,
     validate_string,
+    validate_time_window,
+    validate_window_action,
 )
+from borgit.state import get_state_file
 
 
 CONF_STRUCTURE = {
@@ -18,10 +34,43 @@ CONF_STRUCTURE = {
     'working_directory': {
         'validate': validate_local_file_path,
         'type': 'single',
-        'description': 'Prefix for temporary files.',
+        'description': (
+            'Directory for temporary files, such as files restored from '
+            'backups to check them. They are removed when the run ends, or '
+            'by the next run if it crashed.'
+        ),
         'default': '/tmp',
         'optional': True,
     },
+    'scratch_space_budget': {
+        'validate': validate_size_input,
+        'type': 'single',
+        'description': (
+            'Most data to restore to working_directory at once for checks, '
+            'e.g. 20GiB. Sizes are found from the archive listing, and '
+            'checks wait until their files fit. A check needing more than '
+            'this is run on its own.'
+        ),
+        'optional': True,
+    },
+    'scratch_ram_directory': {
+        'validate': validate_local_file_path,
+        'type': 'single',
+        'description': (
+            'RAM backed directory, e.g. /dev/shm, to restore small files '
+            'for checks to instead of working_directory.'
+        ),
+        'optional': True,
+    },
+    'scratch_ram_limit': {
+        'validate': validate_size_input,
+        'type': 'single',
+        'description': (
+            'Most data to restore to scratch_ram_directory at once.'
+        ),
+        'default': '64MiB',
+        'optional': True,
+    },
     'local_destination_path': {
         'validate': validate_local_file_path,
         'type': 'single',
@@ -31,8 +80,114 @@ CONF_STRUCTURE = {
     'remote_destination_path': {
         'validate': validate_remote_borg_address,
         'type': 'single',
-        'description': 'Remote backup repository destination.',
-        'optional': False,
+        'description': (
+            'Remote backup repository destination. Required unless '
+            'remote_repositories is given.'
+        ),
+        'optional': True,
+    },
+    'remote_repositories': {
+        'contents': {
+            'name': {
+                'validate': validate_string,
+                'type': 'single',
+                'description': (
+                    'Name of the repository, used in output and reports. '
+                    'Must be unique, and not local or remote.'
+                ),
+                'optional': False,
+            },
+            'path': {
+                'validate': validate_remote_borg_address,
+                'type': 'single',
+                'description': 'Remote backup repository destination.',
+                'optional': False,
+            },
+            'upload_ratelimit': {
+                'validate': validate_positive_integer,
+                'type': 'single',
+                'description': (
+                    'Maximum rate to send data to this repository at, in '
+                    'KiB/s.'
+                ),
+                'optional': True,
+            },
+            'priority': {
+                'validate': validate_positive_integer,
+                'type': 'single',
+                'description': (
+                    'Repositories with lower numbers are backed up to '
+                    'first when not all can be backed up to at once.'
+                ),
+                'default': 100,
+                'optional': True,
+            },
+            'lock_wait': {
+                'validate': validate_duration_input,
+                'type': 'single',
+                'description': (
+                    'How long to wait for a lock on this repository, e.g. '
+                    'if another client is using it, e.g. 10m.'
+                ),
+                'optional': True,
+            },
+        },
+        'type': 'list_of_dicts',
+        'description': (
+            'Further remote repositories to back up to, in addition to '
+            'remote_destination_path. A failure of one repository does '
+            'not stop the others, unless it is found to be corrupt.'
+        ),
+        'optional': True,
+    },
+    'shard_count': {
+        'validate': validate_positive_integer,
+        'type': 'single',
+        'description': (
+            'Split each repository into this many repositories (shards), '
+            'each holding some of the backup_source_paths, and back up to '
+            'them in parallel to use more CPU cores. Shards after the first '
+            'are named after the repository with -shard<number> added, and '
+            'must be created with borg init. Set state_directory so that '
+            'sources stay in the same shard between runs.'
+        ),
+        'default': 1,
+        'optional': True,
+    },
+    'shard_assignments': {
+        'contents': {
+            'paths': {
+                'validate': validate_string,
+                'type': 'list',
+                'description': (
+                    'Glob patterns matching entries in backup_source_paths '
+                    'to put in this shard.'
+                ),
+                'optional': False,
+            },
+            'shard': {
+                'validate': validate_positive_integer,
+                'type': 'single',
+                'description': 'The shard number, from 1 to shard_count.',
+                'optional': False,
+            },
+        },
+        'type': 'list_of_dicts',
+        'description': (
+            'Sources to place in particular shards. Other sources are '
+            'placed by balancing the size of each shard.'
+        ),
+        'optional': True,
+    },
+    'max_concurrent_uploads': {
+        'validate': validate_positive_integer,
+        'type': 'single',
+        'description': (
+            'Maximum number of remote repositories to back up to at once, '
+            'when repositories are processed concurrently.'
+        ),
+        'default': 2,
+        'optional': True,
     },
     'backup_source_paths': {
         'validate': validate_local_file_path,
@@ -44,7 +199,7 @@ CONF_STRUCTURE = {
         'contents': {
             'path': {
                 'validate': validate_local_file_path,
-                'type': 'list',
+                'type': 'single',
                 'description': 'Path to check in backup.',
                 'optional': False,
             },
@@ -55,16 +210,25 @@ CONF_STRUCTURE = {
                     'Script to run to check. Any output will be added to '
                     'backup notifications, as INFO if the check is '
                     'successful, WARNING if it exits with a code of 1 '
-                    'or ERROR if it exits witha code of 2'
+                    'or ERROR if it exits witha code of 2. '
+                    'Required unless a plugin is given.'
                 ),
-                'optional': False,
+                'optional': True,
+            },
+            'plugin': {
+                'validate': validate_string,
+                'type': 'single',
+                'description': (
+                    'Python check to run in-process instead of command, '
+                    'given as module:callable. Built in checks such as '
+                    'check_keepass are run in-process automatically.'
+                ),
+                'optional': True,
             },
             'arguments': {
                 'validate': None,  # These could be anything, we will str them
                 'type': 'list',
-                'description': (
-                    'Arguments to run check script with.',
-                ),
+                'description': 'Arguments to run check script with.',
                 'optional': True,
             },
             'minimum_size': {
@@ -72,7 +236,49 @@ CONF_STRUCTURE = {
                 'type': 'single',
                 'description': (
                     'Notify if the specified files are below this size. '
-                    'e.g. 4M would notify if the file was smaller than 4MB.'
+                    'e.g. 4M would notify if the file was smaller than 4MB. '
+                    'For a directory, the total size of its files is used.'
+                ),
+                'optional': True,
+            },
+            'maximum_age': {
+                'validate': validate_duration_input,
+                'type': 'single',
+                'description': (
+                    'Notify if the specified file (or the newest file in '
+                    'the specified directory) was last modified longer ago '
+                    'than this, e.g. 2d.'
+                ),
+                'optional': True,
+            },
+            'expected_file_count': {
+                'validate': validate_positive_integer,
+                'type': 'single',
+                'description': (
+                    'Notify if fewer than this many files are in the '
+                    'specified directory, including its subdirectories.'
+                ),
+                'optional': True,
+            },
+            'maximum_size_change': {
+                'validate': validate_positive_integer,
+                'type': 'single',
+                'description': (
+                    'Notify if the size of the specified files changed by '
+                    'more than this percentage since the previous archive of '
+                    'the same sources. A warning is given if there is no '
+                    'earlier size to compare with.'
+                ),
+                'optional': True,
+            },
+            'stream': {
+                'validate': validate_boolean,
+                'type': 'single',
+                'description': (
+                    'Stream the file from the backup straight into the '
+                    'check script\'s stdin rather than extracting it to '
+                    'disk. The script will be given - as the path to check. '
+                    'Only suitable for single files.'
                 ),
                 'optional': True,
             },
@@ -83,72 +289,514 @@ CONF_STRUCTURE = {
             'These checks will be run after every backup is taken. '
             'You may need a lot of space as files to be checked will be '
             'extracted from the backup, checked, then removed (so large '
-            'files may cause temporary high disk and network usage).'
+            'files may cause temporary high disk and network usage), '
+            'unless they are streamed. The minimum_size, maximum_age, '
+            'expected_file_count and maximum_size_change checks only read '
+            'the archive\'s listing, so need no extraction; entries with '
+            'only these checks need no command.'
+        ),
+        'optional': True,
+    },
+    'state_directory': {
+        'validate': validate_local_file_path,
+        'type': 'single',
+        'description': (
+            'Directory to keep state between runs in, such as the record of '
+            'previously verified files. Features needing state are '
+            'disabled if this is not set.'
+        ),
+        'optional': True,
+    },
+    'daemon_socket_path': {
+        'validate': validate_string,
+        'type': 'single',
+        'description': (
+            'Path of the control socket borgit.daemon listens on. Defaults '
+            'to borgit.sock in the state_directory, or the '
+            'working_directory.'
+        ),
+        'optional': True,
+    },
+    'full_verify_interval': {
+        'validate': validate_positive_integer,
+        'type': 'single',
+        'description': (
+            'Files whose size, mtime and ctime are unchanged since they '
+            'last passed their checks will not be checked again, except on '
+            'every this many runs, when all files will be checked. '
+            'Requires state_directory.'
+        ),
+        'optional': True,
+    },
+    'sample_verify_size': {
+        'validate': validate_size_input,
+        'type': 'single',
+        'description': (
+            'Restore up to this much of each new backup, e.g. 1GiB, and '
+            'compare it with the files it was backed up from. Files which '
+            'have gone longest without being verified are chosen first. '
+            'With state_directory, every file is verified over successive '
+            'runs.'
+        ),
+        'optional': True,
+    },
+    'sample_verify_duration': {
+        'validate': validate_duration_input,
+        'type': 'single',
+        'description': (
+            'Stop restoring files for sample verification after this long, '
+            'e.g. 10m. May be used with or instead of sample_verify_size.'
+        ),
+        'optional': True,
+    },
+    'keep_within': {
+        'validate': validate_duration_input,
+        'type': 'single',
+        'description': (
+            'Keep all archives created within this long, e.g. 2d, rounded '
+            'up to whole hours. If this or any other keep_ setting is given, '
+            'archives kept by none of them are removed with borg prune after '
+            'each backup that passes its checks, and the repository is '
+            'compacted. The rules are applied separately to the archives of '
+            'each source_settings entry. The new archives and the last ones '
+            'to pass their checks are never deleted. Checkpoints of '
+            'interrupted backups are deleted once a later backup has '
+            'completed.'
+        ),
+        'optional': True,
+    },
+    'keep_last': {
+        'validate': validate_positive_integer,
+        'type': 'single',
+        'description': 'Always keep this many of the latest archives.',
+        'optional': True,
+    },
+    'keep_hourly': {
+        'validate': validate_positive_integer,
+        'type': 'single',
+        'description': 'Keep the latest archive of each of this many hours.',
+        'optional': True,
+    },
+    'keep_daily': {
+        'validate': validate_positive_integer,
+        'type': 'single',
+        'description': 'Keep the latest archive of each of this many days.',
+        'optional': True,
+    },
+    'keep_weekly': {
+        'validate': validate_positive_integer,
+        'type': 'single',
+        'description': 'Keep the latest archive of each of this many weeks.',
+        'optional': True,
+    },
+    'keep_monthly': {
+        'validate': validate_positive_integer,
+        'type': 'single',
+        'description': 'Keep the latest archive of each of this many months.',
+        'optional': True,
+    },
+    'keep_yearly': {
+        'validate': validate_positive_integer,
+        'type': 'single',
+        'description': 'Keep the latest archive of each of this many years.',
+        'optional': True,
+    },
+    'checkpoint_interval': {
+        'validate': validate_duration_input,
+        'type': 'single',
+        'description': (
+            'How often borg saves a checkpoint while creating an archive, '
+            'e.g. 10m. If a run is interrupted, the next run resumes its '
+            'phases that did not complete, and its backups continue from '
+            'their last checkpoint. Resuming requires state_directory.'
+        ),
+        'optional': True,
+    },
+    'backup_window': {
+        'validate': validate_time_window,
+        'type': 'single',
+        'description': (
+            'Daily window of local time runs must finish within, e.g. '
+            '22:00-06:00. Runs are forecast from the changed files and the '
+            'run history, which requires state_directory. Runs which are '
+            'forecast not to fit are refused.'
+        ),
+        'optional': True,
+    },
+    'backup_window_action': {
+        'validate': validate_window_action,
+        'type': 'single',
+        'description': (
+            'What to do with a run forecast not to fit the backup_window: '
+            'refuse, or defer it until the next window.'
+        ),
+        'default': 'refuse',
+        'optional': True,
+    },
+    'repository_check_duration': {
+        'validate': validate_duration_input,
+        'type': 'single',
+        'description': (
+            'Check at most this much of the repository on each run, e.g. '
+            '30m. Each check continues from where the last one stopped. '
+            'Requires state_directory, otherwise the whole repository is '
+            'checked every run.'
+        ),
+        'optional': True,
+    },
+    'full_repository_check_interval': {
+        'validate': validate_duration_input,
+        'type': 'single',
+        'description': (
+            'Check the whole repository if it was last fully checked '
+            'longer ago than this, e.g. 7d. Requires state_directory.'
+        ),
+        'optional': True,
+    },
+    'verify_data_interval': {
+        'validate': validate_duration_input,
+        'type': 'single',
+        'description': (
+            'Read and verify all backed up data if that was last done '
+            'longer ago than this, e.g. 30d. Requires state_directory.'
+        ),
+        'optional': True,
+    },
+    'borg_timeout': {
+        'validate': validate_duration_input,
+        'type': 'single',
+        'description': (
+            'Stop any borg command which runs for longer than this, e.g. '
+            '6h, so a hung connection cannot stall a run forever.'
+        ),
+        'optional': True,
+    },
+    'metrics_report_path': {
+        'validate': validate_string,
+        'type': 'single',
+        'description': (
+            'Write a JSON report of the timings and statistics of each run '
+            'to this file. If state_directory is set, every run is also '
+            'added to an SQLite history there.'
+        ),
+        'optional': True,
+    },
+    'metrics_textfile_path': {
+        'validate': validate_string,
+        'type': 'single',
+        'description': (
+            'Write the timings and statistics of each run to this file in '
+            'Prometheus text format, e.g. for the node exporter\'s textfile '
+            'collector.'
+        ),
+        'optional': True,
+    },
+    'check_concurrency': {
+        'validate': validate_positive_integer,
+        'type': 'single',
+        'description': (
+            'Maximum number of check_files checks to run at once. '
+            'Output from each check is reported as it completes.'
+        ),
+        'default': 1,
+        'optional': True,
+    },
+    'ssh_multiplex': {
+        'validate': validate_boolean,
+        'type': 'single',
+        'description': (
+            'Whether all borg commands on the remote repository should share '
+            'one SSH connection for the run, rather than each connecting '
+            'and authenticating separately.'
+        ),
+        'default': True,
+        'optional': True,
+    },
+    'replication_mode': {
+        'validate': validate_replication_mode,
+        'type': 'single',
+        'description': (
+            'How the remote archive is made. With scan, the sources are '
+            'backed up to each repository separately. With export_tar, the '
+            'sources are only read once, for the local backup, and the new '
+            'local archive is then streamed into the remote repository as '
+            'a tar file (requires borg 1.2 or later). The copy does not keep '
+            'ACLs, xattrs, BSD flags, atimes or ctimes.'
+        ),
+        'default': 'scan',
+        'optional': True,
+    },
+    'compression': {
+        'validate': validate_compression,
+        'type': 'single',
+        'description': (
+            'borg compression to use for backup_source_paths without '
+            'source_settings, e.g. lz4, zstd,3, or auto,zstd,10 to only '
+            'compress data which lz4 finds compressible.'
+        ),
+        'default': 'lz4',
+        'optional': True,
+    },
+    'chunker_params': {
+        'validate': validate_chunker_params,
+        'type': 'single',
+        'description': (
+            'borg chunker params to use for backup_source_paths without '
+            'source_settings. Defaults to borg\'s own default.'
+        ),
+        'optional': True,
+    },
+    'source_settings': {
+        'contents': {
+            'name': {
+                'validate': validate_string,
+                'type': 'single',
+                'description': (
+                    'Name for these sources. It is added to the name of '
+                    'the archive they are backed up into.'
+                ),
+                'optional': False,
+            },
+            'paths': {
+                'validate': validate_string,
+                'type': 'list',
+                'description': (
+                    'Glob patterns matching entries in backup_source_paths '
+                    'which use these settings.'
+                ),
+                'optional': False,
+            },
+            'compression': {
+                'validate': validate_compression,
+                'type': 'single',
+                'description': (
+                    'borg compression for these sources. Defaults to the '
+                    'top level compression.'
+                ),
+                'optional': True,
+            },
+            'chunker_params': {
+                'validate': validate_chunker_params,
+                'type': 'single',
+                'description': (
+                    'borg chunker params for these sources. Defaults to the '
+                    'top level chunker_params.'
+                ),
+                'optional': True,
+            },
+        },
+        'type': 'list_of_dicts',
+        'description': (
+            'Compression and chunker settings for particular sources, e.g. '
+            'no compression for already compressed media or fixed size '
+            'chunks for VM images. borg uses one setting per archive, so '
+            'each entry\'s sources are backed up into an archive of their '
+            'own, named after the run\'s archive with -<name> added. The '
+            'first matching entry applies to each source. Use '
+            'python -m borgit.profiling to compare settings on a sample of '
+            'a source.'
         ),
         'optional': True,
     },
 }
 
 
-def validate_config(config, prefix=None):
-    """Validate the provided config, based on the defined CONF_STRUCTURE."""
-    prefix = prefix or []
+# One step of the compiled validation plan.
+# keys: The keys leading to the entry, e.g. ('check_files', 'path'). All but
+#       the last are list_of_dicts entries, which come earlier in the plan.
+# schema: The entry's schema from CONF_STRUCTURE.
+PlanStep = namedtuple('PlanStep', ['keys', 'schema'])
 
-    configuration_issues = []
-    for conf_entry, schema in CONF_STRUCTURE.items():
-        key_name = '.'.join(prefix + [conf_entry])
-        if conf_entry not in config:
-            config[conf_entry] = schema.get('default')
-            if not schema['optional']:
-                configuration_issues.append(
-                    '{key} was not found in configuration, but is required.'
-                    .format(key=key_name)
-                )
-            # No need to validate an empty or default configuration entry.
-            continue
+SCHEMA_TYPES = ('single', 'list', 'list_of_dicts')
+# Validators which look at the filesystem. These are slow on network
+# filesystems, so are run concurrently, each distinct value once.
+FILESYSTEM_VALIDATORS = (validate_local_file_path, validate_local_executable)
+FILESYSTEM_CHECK_WORKERS = 16
 
-        if schema['type'] == 'list_of_dicts':
-            configuration_issues.extend(
-                validate_config(
-                    config=config[conf_entry],
-                    prefix=prefix.append(conf_entry)
+
+def compile_validation_plan(structure, parents=()):
+    """Flatten a config structure into the steps to validate it.
+    Each list_of_dicts entry is followed by the steps for its contents.
+
+    :returns: A list of PlanStep.
+    """
+    plan = []
+    for key, schema in structure.items():
+        if schema['type'] not in SCHEMA_TYPES:
+            raise RuntimeError(
+                'Unknown type in schema: {schema_type}'.format(
+                    schema_type=schema['type'],
                 )
             )
+        keys = parents + (key,)
+        plan.append(PlanStep(keys, schema))
+        if schema['type'] == 'list_of_dicts':
+            plan.extend(compile_validation_plan(schema['contents'], keys))
+    return plan
 
-        validation = schema.get('validation')
-        if validation:
-            if schema['type'] == 'single':
-                entry = [config[conf_entry]]
-            elif schema['type'] == 'list':
-                entry = config[conf_entry]
-                if not isinstance(entry, list):
-                    configuration_issues.append(
-                        '{key} is expected to be a list but was not.'
-                        .format(key=key_name)
+
+VALIDATION_PLAN = compile_validation_plan(CONF_STRUCTURE)
+
+
+def _resolve_plan(config, plan):
+    """Find the values in a config each step of a plan applies to.
+    Missing entries are given their defaults.
+
+    :returns: A list of issues with the config's structure, and a list of
+              (key name, validator, value) checks to run.
+    """
+    # The dicts each step's entries are found in, with the names to report
+    # their keys by, e.g. check_files[2].
+    containers = {(): [('', config)]}
+    issues = []
+    checks = []
+    for step in plan:
+        name_prefixes = containers.get(step.keys[:-1], [])
+        for name_prefix, container in name_prefixes:
+            key = step.keys[-1]
+            key_name = name_prefix + key
+            value = container.get(key)
+            if value is None:
+                container[key] = step.schema.get('default')
+                if not step.schema['optional']:
+                    issues.append(
+                        '{key} was not found in configuration, but is '
+                        'required.'.format(key=key_name)
                     )
-            else:
-                raise RuntimeError(
-                    'Unknown type in schema: {schema_type}'.format(
-                        schema_type=schema['type'],
+                # No need to validate an empty or default entry.
+                continue
+
+            schema_type = step.schema['type']
+            if schema_type == 'list_of_dicts':
+                if (not isinstance(value, list)
+                        or not all(isinstance(item, dict) for item in value)):
+                    issues.append(
+                        '{key} is expected to be a list of mappings but was '
+                        'not.'.format(key=key_name)
                     )
+                    continue
+                containers.setdefault(step.keys, []).extend(
+                    ('{key}[{index}].'.format(key=key_name, index=index),
+                     item)
+                    for index, item in enumerate(value)
                 )
-            entry_issue = validation(entry)
-            if entry_issue:
-                entry_issue = (
-                    '{key} is invalid: {issue}'.format(
-                        key=key_name,
-                        issue=entry_issue,
+            elif schema_type == 'list':
+                if not isinstance(value, list):
+                    issues.append(
+                        '{key} is expected to be a list but was not.'
+                        .format(key=key_name)
                     )
-                )
-                configuration_issues.append(entry_issue)
+                    continue
+                if step.schema.get('validate'):
+                    checks.extend(
+                        ('{key}[{index}]'.format(key=key_name, index=index),
+                         step.schema['validate'], item)
+                        for index, item in enumerate(value)
+                    )
+            elif step.schema.get('validate'):
+                checks.append((key_name, step.schema['validate'], value))
+    return issues, checks
+
+
+def _run_checks(checks):
+    """Run validators, those using the filesystem concurrently.
+
+    :returns: A list of issues found.
+    """
+    filesystem_checks = list({
+        (validator, value)
+        for _, validator, value in checks
+        if validator in FILESYSTEM_VALIDATORS and isinstance(value, str)
+    })
+    results = {}
+    if filesystem_checks:
+        with ThreadPoolExecutor(
+                max_workers=min(FILESYSTEM_CHECK_WORKERS,
+                                len(filesystem_checks))) as executor:
+            results = dict(zip(
+                filesystem_checks,
+                executor.map(
+                    lambda check: check[0](check[1]), filesystem_checks,
+                ),
+            ))
+
+    issues = []
+    for key_name, validator, value in checks:
+        if validator in FILESYSTEM_VALIDATORS and isinstance(value, str):
+            issue = results[(validator, value)]
+        else:
+            issue = validator(value)
+        if issue:
+            issues.append('{key} is invalid: {issue}'.format(
+                key=key_name,
+                issue=issue,
+            ))
+    return issues
+
 
-    if prefix:
-        return configuration_issues
+def validate_config(config, check_values=True):
+    """Validate the provided config, based on the defined CONF_STRUCTURE.
+    Missing entries are set to their defaults.
+
+    :param config: The config dict.
+    :param check_values: If False, only the defaults are applied, e.g. for
+                         a config which is known to be valid.
+
+    :raises InvalidConfiguration: If any issues are found.
+    """
+    issues, checks = _resolve_plan(config, VALIDATION_PLAN)
+    if check_values:
+        issues.extend(_run_checks(checks))
+    if issues:
+        raise InvalidConfiguration('\n'.join(issues))
+
+
+def _plan_fingerprint():
+    """Get a hash of the validation plan, so that configs validated by
+    another version of borgit are validated again."""
+    return hashlib.sha256(repr([
+        (step.keys, step.schema['type'], step.schema['optional'],
+         getattr(step.schema.get('validate'), '__name__', None))
+        for step in VALIDATION_PLAN
+    ]).encode('UTF-8')).hexdigest()
+
+
+def load_config(path):
+    """Load and validate a config file.
+    With a state_directory, the hash of a config file which passed
+    validation is kept, and validation of that config is skipped while it is
+    unchanged.
+
+    :raises InvalidConfiguration: If any issues are found.
+
+    :returns: The config dict, with defaults applied.
+    """
+    with open(path, 'rb') as config_file:
+        content = config_file.read()
+    config = yaml.safe_load(content)
+    if not isinstance(config, dict):
+        raise InvalidConfiguration(
+            'Expected {path} to contain a mapping of settings.'.format(
+                path=path,
+            )
+        )
+    config_hash = hashlib.sha256(
+        content + _plan_fingerprint().encode('UTF-8'),
+    ).hexdigest()
 
-    # We are at the top level, raise any configuration issues
-    if configuration_issues:
-        raise InvalidConfiguration('\n'.join(configuration_issues))
-    return []
+    state_file = None
+    if (isinstance(config.get('state_directory'), str)
+            and os.path.isdir(config['state_directory'])):
+        state_file = get_state_file(config, 'config_validation')
+    path = os.path.abspath(path)
+    validated = bool(
+        state_file and state_file.read().get(path) == config_hash
+    )
+    validate_config(config, check_values=not validated)
+    if state_file and not validated:
+        with state_file.update() as state:
+            state[path] = config_hash
+    return config
 
 
 class InvalidConfiguration(Exception):
@@ -0,0 +1,460 @@
+#! /usr/bin/env python3
+"""Long running borgit service, taking jobs over a local control socket.
+
+Each run of borgit parses its config, lists archives and connects to remote
+repos again, and separate runs (e.g. a scheduled backup and an ad-hoc
+restore) contend for borg's repository locks. The daemon keeps the repos,
+their SSH connections and archive listings between jobs, and queues jobs so
+that each repo only runs one at a time, while jobs on different repos run in
+parallel. Backups use every repo, so wait for all of them.
+
+Requests are JSON objects, one per line, each answered with a line of JSON
+when the job has finished: {"ok": true, "result": ...}, or
+{"ok": false, "error": "..."}. A connection's requests are run in turn, so
+clients wanting jobs run in parallel use a connection for each. Requests:
+
+    {"action": "backup", "archive": "<name>", "concurrent": false}
+    {"action": "list", "repo": "<target>"}
+    {"action": "check", "repo": "<target>", "archive": "<optional name>"}
+    {"action": "restore", "repo": "<target>", "archive": "<name>",
+     "paths": ["<path>", ...], "destination": "<directory>"}
+    {"action": "status"}
+
+Any job may give "lock_wait", the most seconds it will queue for its repos,
+after which it fails as borg does when it can't get a repository lock.
+Time spent queued doesn't use up the lock_wait borg is given, so borg only
+waits for locks held by processes outside the daemon.
+
+status is answered at once, with the queue depth of each repo and the wait
+and run times of recent jobs.
+
+Run with: python -m borgit.daemon <config file>
+Send a request with: python -m borgit.daemon <config file> --request '<json>'
+"""
+import argparse
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+from borgit.command import get_repos, run_backup
+from borgit.config import InvalidConfiguration, load_config
+from borgit.exceptions import LockTimeout
+from borgit.scratch import get_scratch_space
+from borgit.ssh import multiplex_ssh
+
+SOCKET_NAME = 'borgit.sock'
+# Number of recent jobs of each action that status reports times for.
+LATENCY_WINDOW = 100
+# Longest request line accepted, e.g. a restore of many paths.
+REQUEST_LIMIT = 16 * 1024 * 1024
+
+
+class RequestError(Exception):
+    """Raised when a request to the daemon is not valid."""
+
+
+def get_socket_path(config):
+    """Get the path of the daemon's control socket from the config."""
+    if config.get('daemon_socket_path'):
+        return config['daemon_socket_path']
+    directory = (
+        config.get('state_directory')
+        or config.get('working_directory')
+        or tempfile.gettempdir()
+    )
+    return os.path.join(directory, SOCKET_NAME)
+
+
+def _summarise(durations):
+    """Get the mean and maximum of a list of durations."""
+    if not durations:
+        return {'mean': None, 'max': None}
+    return {
+        'mean': sum(durations) / len(durations),
+        'max': max(durations),
+    }
+
+
+class BorgitDaemon:
+    """Run jobs from the control socket, one at a time on each repo."""
+    def __init__(self, config, logger, socket_path=None):
+        """Initialise the daemon and its repos.
+
+        :param config: A valid borg config dict.
+        :param logger: A logger for job output.
+        :param socket_path: Path of the control socket. Defaults to the
+                            one from get_socket_path.
+        """
+        self.config = config
+        self.logger = logger
+        self.socket_path = socket_path or get_socket_path(config)
+        self.scratch = get_scratch_space(config, logger)
+        self.repos = get_repos(config, self.scratch, logger)
+        # The daemon's SSH connections are shared by every job, so runs
+        # must not open and close their own.
+        self._job_config = dict(config, ssh_multiplex=False)
+        self._locks = {name: asyncio.Lock() for name in self.repos}
+        self._waiting = dict.fromkeys(self.repos, 0)
+        self._running = dict.fromkeys(self.repos)
+        self._archives = {}
+        self._jobs = {}
+        self._started = time.time()
+        self._stop_event = None
+        # Only one job runs on each repo at once.
+        self._executor = ThreadPoolExecutor(max_workers=len(self.repos))
+        self._actions = {
+            'backup': self._backup,
+            'list': self._list,
+            'check': self._check,
+            'restore': self._restore,
+        }
+
+    def _repo_name(self, request):
+        """Get the target a request is for."""
+        name = request.get('repo')
+        if name not in self.repos:
+            raise RequestError(
+                'Unknown repo {name}. Expected one of: {names}.'.format(
+                    name=name, names=', '.join(self.repos),
+                )
+            )
+        return name
+
+    def _targets(self, action, request):
+        """Get the targets a job needs, in the order they are locked."""
+        if action == 'backup':
+            return list(self.repos)
+        return [self._repo_name(request)]
+
+    def _backup(self, request):
+        """Back up to all repos, as run_backup does."""
+        if not request.get('archive'):
+            raise RequestError('A backup needs an archive name.')
+        try:
+            metrics = run_backup(
+                self.repos, request['archive'], self._job_config,
+                self.logger, bool(request.get('concurrent')),
+                scratch=self.scratch,
+            )
+        finally:
+            self._archives.clear()
+            for repo in self.repos.values():
+                repo.metrics = None
+        return metrics.report()
+
+    def _list(self, request):
+        """List a repo's archives, from the last listing if it is current.
+        """
+        name = self._repo_name(request)
+        if name not in self._archives:
+            self._archives[name] = [
+                {
+                    'name': archive.name,
+                    'id': archive.id,
+                    'start': archive.start.isoformat(),
+                }
+                for archive in self.repos[name].iter_archives()
+            ]
+        return self._archives[name]
+
+    def _check(self, request):
+        """Check a repo, or just one archive of it."""
+        repo = self.repos[self._repo_name(request)]
+        if request.get('archive'):
+            repo.check_archive(request['archive'])
+        else:
+            repo.check()
+
+    def _restore(self, request):
+        """Restore paths from an archive to a destination directory."""
+        repo = self.repos[self._repo_name(request)]
+        if not (request.get('archive') and request.get('paths')
+                and request.get('destination')):
+            raise RequestError(
+                'A restore needs an archive, paths and a destination.'
+            )
+        repo.restore_files_from_archive(
+            request['archive'], request['paths'], request['destination'],
+        )
+
+    def _record_job(self, action, waited, ran, succeeded):
+        """Record the times of a finished job."""
+        jobs = self._jobs.setdefault(action, {
+            'completed': 0,
+            'failed': 0,
+            'recent': deque(maxlen=LATENCY_WINDOW),
+        })
+        jobs['completed' if succeeded else 'failed'] += 1
+        jobs['recent'].append((waited, ran))
+
+    def status(self):
+        """Get the queue depth of each repo and recent job times."""
+        return {
+            'uptime': time.time() - self._started,
+            'repos': {
+                name: {
+                    'waiting': self._waiting[name],
+                    'running': self._running[name],
+                }
+                for name in self.repos
+            },
+            'jobs': {
+                action: {
+                    'completed': jobs['completed'],
+                    'failed': jobs['failed'],
+                    'wait': _summarise([
+                        waited for waited, _ in jobs['recent']
+                    ]),
+                    'run': _summarise([ran for _, ran in jobs['recent']]),
+                }
+                for action, jobs in self._jobs.items()
+            },
+        }
+
+    async def submit(self, request):
+        """Queue a job and wait for it to be run.
+
+        :param request: A request dict, as described for this module.
+
+        :raises RequestError: If the request is not valid.
+        :raises LockTimeout: If the job's lock_wait expires while it is
+                             queued.
+
+        :returns: The job's result.
+        """
+        action = request.get('action')
+        if action == 'status':
+            return self.status()
+        if action not in self._actions:
+            raise RequestError(
+                'Unknown action {action}. Expected one of: {actions}.'.format(
+                    action=action,
+                    actions=', '.join(['status'] + list(self._actions)),
+                )
+            )
+        targets = self._targets(action, request)
+        lock_wait = request.get('lock_wait')
+
+        queued = time.monotonic()
+        pending = list(targets)
+        held = []
+        for name in pending:
+            self._waiting[name] += 1
+        try:
+            deadline = None if lock_wait is None else queued + lock_wait
+            for name in targets:
+                timeout = None
+                if deadline is not None:
+                    timeout = max(deadline - time.monotonic(), 0)
+                try:
+                    await asyncio.wait_for(self._locks[name].acquire(),
+                                           timeout)
+                except asyncio.TimeoutError:
+                    raise LockTimeout(
+                        '{action} waited more than {wait}s for {repo}.'
+                        .format(action=action, wait=lock_wait, repo=name)
+                    )
+                held.append(name)
+                pending.remove(name)
+                self._waiting[name] -= 1
+
+            started = time.monotonic()
+            for name in held:
+                self._running[name] = action
+            succeeded = False
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._actions[action], request,
+                )
+                succeeded = True
+            finally:
+                self._record_job(action, started - queued,
+                                 time.monotonic() - started, succeeded)
+            return result
+        finally:
+            for name in pending:
+                self._waiting[name] -= 1
+            for name in held:
+                self._running[name] = None
+                self._locks[name].release()
+
+    async def _handle_connection(self, reader, writer):
+        """Answer each request sent on a connection."""
+        try:
+            async for line in reader:
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise RequestError('Expected a JSON object.')
+                    response = {
+                        'ok': True,
+                        'result': await self.submit(request),
+                    }
+                except (RequestError, ValueError) as err:
+                    response = {'ok': False, 'error': str(err)}
+                except Exception as err:
+                    self.logger.error('{action} failed: {err}'.format(
+                        action=request['action'], err=err,
+                    ))
+                    response = {
+                        'ok': False,
+                        'error': str(err) or type(err).__name__,
+                    }
+                writer.write(json.dumps(response).encode('UTF-8') + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            # The client went away before its answer.
+            pass
+        finally:
+            writer.close()
+
+    def _remove_stale_socket(self):
+        """Remove a control socket left by a daemon which is not running.
+
+        :raises RuntimeError: If another daemon is using the socket.
+        """
+        if not os.path.exists(self.socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(self.socket_path)
+        except OSError:
+            os.unlink(self.socket_path)
+            return
+        finally:
+            probe.close()
+        raise RuntimeError(
+            'A daemon is already listening on {path}.'.format(
+                path=self.socket_path,
+            )
+        )
+
+    async def serve(self, ready=None):
+        """Answer requests until SIGINT or SIGTERM is received.
+
+        :param ready: Optional event set once the socket is listening.
+        """
+        self._remove_stale_socket()
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signal_number, stop.set)
+        self._stop_event = stop
+        server = await asyncio.start_unix_server(
+            self._handle_connection, path=self.socket_path,
+            limit=REQUEST_LIMIT,
+        )
+        os.chmod(self.socket_path, 0o600)
+        self.logger.info('Listening on {path}.'.format(
+            path=self.socket_path,
+        ))
+        try:
+            async with server:
+                if ready is not None:
+                    ready.set()
+                await stop.wait()
+        finally:
+            for signal_number in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signal_number)
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def stop(self):
+        """Stop serving, as SIGTERM does. Must be called from the event
+        loop the daemon is serving in."""
+        self._stop_event.set()
+
+    def run(self):
+        """Run the daemon until it is stopped, then tidy up."""
+        if self.config.get('ssh_multiplex', True):
+            connections = multiplex_ssh(self.repos, self.logger)
+        else:
+            connections = nullcontext()
+        try:
+            with connections:
+                asyncio.run(self.serve())
+        finally:
+            # Jobs still running are left to finish.
+            self._executor.shutdown()
+            self.scratch.cleanup()
+
+
+def send_request(socket_path, request):
+    """Send a request to a running daemon and wait for the answer.
+
+    :returns: The response dict.
+    """
+    with socket.socket(socket.AF_UNIX) as connection:
+        connection.connect(socket_path)
+        connection.sendall(json.dumps(request).encode('UTF-8') + b'\n')
+        with connection.makefile('rb') as response:
+            return json.loads(response.readline())
+
+
+def main(args):
+    """Run the daemon, or send it a request, with provided arguments."""
+    parser = argparse.ArgumentParser(
+        description=(
+            'Run borgit as a daemon taking jobs over a control socket, or '
+            'send a running daemon a request.'
+        ),
+    )
+    parser.add_argument(
+        'config',
+        help='Path to the borgit config file.',
+    )
+    parser.add_argument(
+        '--request',
+        help=(
+            'JSON request to send to the running daemon, e.g. '
+            '\'{"action": "status"}\'.'
+        ),
+    )
+    args = parser.parse_args(args)
+
+    try:
+        config = load_config(args.config)
+    except InvalidConfiguration as err:
+        sys.stderr.write('Invalid config {path}:\n{err}\n'.format(
+            path=args.config, err=err,
+        ))
+        sys.exit(1)
+
+    if args.request:
+        try:
+            request = json.loads(args.request)
+        except ValueError as err:
+            parser.error('Request is not valid JSON: {err}'.format(err=err))
+        socket_path = get_socket_path(config)
+        try:
+            response = send_request(socket_path, request)
+        except OSError as err:
+            sys.stderr.write(
+                'Could not reach the daemon at {path}: {err}\n'.format(
+                    path=socket_path, err=err,
+                )
+            )
+            sys.exit(1)
+        print(json.dumps(response, indent=2))
+        if not response['ok']:
+            sys.exit(1)
+        return
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s',
+    )
+    BorgitDaemon(config, logging.getLogger('borgit-daemon')).run()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
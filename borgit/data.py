@@ -1,4 +1,5 @@
 """Tools for handling config data for borgit."""
+from datetime import datetime
 import os
 import re
 
@@ -12,38 +13,115 @@ REMOTE_BORG_REGEX = re.compile(
 SIZE_REGEX = re.compile(
     r'^(?P<value>[0-9]+)(?P<unit>[A-Za-z]+)$'
 )
+DURATION_REGEX = re.compile(
+    r'^(?P<value>[0-9]+)(?P<unit>[A-Za-z]*)$'
+)
+# borg compression specs, optionally with borg's auto heuristic, which only
+# uses the given compressor on data lz4 finds compressible.
+COMPRESSION_REGEX = re.compile(
+    r'^(auto,)?(none|lz4|zstd(,[0-9]+)?|zlib(,[0-9])?|lzma(,[0-9])?)$'
+)
+CHUNKER_PARAMS_REGEX = re.compile(
+    r'^(default|(buzhash,)?[0-9]+,[0-9]+,[0-9]+,[0-9]+'
+    r'|fixed,[0-9]+(,[0-9]+)?)$'
+)
+# How the remote archive is made. scan backs up the sources again, while
+# export_tar copies the new local archive.
+REPLICATION_MODES = ('scan', 'export_tar')
+# Daily window of local time runs must fit in, e.g. 22:00-06:00.
+TIME_WINDOW_REGEX = re.compile(
+    r'^(?P<start>[0-9]{1,2}:[0-9]{2})-(?P<end>[0-9]{1,2}:[0-9]{2})$'
+)
+# What to do with a run forecast not to fit the backup window. refuse fails
+# the run, while defer waits for the next window if the run would fit it.
+WINDOW_ACTIONS = ('refuse', 'defer')
 
 
 def validate_local_file_path(config_value):
     """Validate whether the supplied value is a local file path."""
+    if not isinstance(config_value, str):
+        return 'Expected a path.'
     if not os.path.exists(config_value):
-        return (
-            'Could not find local path: {path}'.format(path=config_value),
-        )
+        return 'Could not find local path: {path}'.format(path=config_value)
     return ''
 
 
 def validate_string(config_value):
     """Validate that the provided value is a string."""
     if not isinstance(config_value, str):
+        return 'Expected a string.'
+    return ''
+
+
+def validate_boolean(config_value):
+    """Validate that the provided value is a boolean."""
+    if not isinstance(config_value, bool):
+        return 'Expected true or false.'
+    return ''
+
+
+def validate_replication_mode(config_value):
+    """Validate that the provided value is a known replication mode."""
+    if config_value not in REPLICATION_MODES:
+        return 'Expected one of: {modes}.'.format(
+            modes=', '.join(REPLICATION_MODES),
+        )
+    return ''
+
+
+def validate_window_action(config_value):
+    """Validate that the provided value is a known backup window action."""
+    if config_value not in WINDOW_ACTIONS:
+        return 'Expected one of: {actions}.'.format(
+            actions=', '.join(WINDOW_ACTIONS),
+        )
+    return ''
+
+
+def validate_positive_integer(config_value):
+    """Validate that the provided value is an integer of at least 1."""
+    if isinstance(config_value, bool) or not isinstance(config_value, int):
+        return 'Expected a whole number.'
+    if config_value < 1:
+        return 'Expected a number of at least 1.'
+    return ''
+
+
+def validate_compression(config_value):
+    """Validate that the provided value is a borg compression spec."""
+    if not COMPRESSION_REGEX.match(str(config_value)):
         return (
-            'Expected a string.',
+            'Expected a borg compression spec, e.g. lz4, zstd,3 or '
+            'auto,zstd,10.'
+        )
+    return ''
+
+
+def validate_chunker_params(config_value):
+    """Validate that the provided value is a borg chunker-params spec."""
+    if not CHUNKER_PARAMS_REGEX.match(str(config_value)):
+        return (
+            'Expected borg chunker params, e.g. buzhash,19,23,21,4095 or '
+            'fixed,4194304.'
         )
     return ''
 
 
 def validate_remote_borg_address(config_value):
     """Validate that the value is a supported remote borg address."""
-    if not REMOTE_BORG_REGEX.findall(config_value):
+    if (not isinstance(config_value, str)
+            or not REMOTE_BORG_REGEX.findall(config_value)):
         return (
             'Expected remote borg backup location in the form: '
-            'ssh://<username>_backups@<FQDN_OR_IP>/~/repository',
+            'ssh://<username>_backups@<FQDN_OR_IP>/~/repository'
         )
     return ''
 
 
 def validate_local_executable(config_value):
     """Validate that a local executable file has been provided."""
+    if not isinstance(config_value, str):
+        return 'Expected a path.'
     if not os.path.isfile(config_value):
         return '{path} does not exist.'.format(path=config_value)
     if not os.access(config_value, os.X_OK):
@@ -69,13 +147,21 @@ def convert_size_input(size_input):
     # Supported size specifiers, with the required multiplier
     supported_size_specifiers = {
         'b': 1,
-        'mib': 1024,
-        'mb': 1000,
-        'm': 1000,
+        'k': 1000,
+        'kb': 1000,
+        'kib': 1024,
+        'm': 1000 ** 2,
+        'mb': 1000 ** 2,
+        'mib': 1024 ** 2,
+        'g': 1000 ** 3,
+        'gb': 1000 ** 3,
+        'gib': 1024 ** 3,
     }
-    output_specifiers = ', '.join(('B', 'MiB', 'MB', 'M'))
+    output_specifiers = ', '.join(
+        ('B', 'KiB', 'KB', 'K', 'MiB', 'MB', 'M', 'GiB', 'GB', 'G')
+    )
 
-    first_parse = SIZE_REGEX.match(size_input)
+    first_parse = SIZE_REGEX.match(str(size_input))
     if not first_parse:
         raise SizeConversionError(
             'Could not convert {inp} to size. Expected numbers followed by '
@@ -98,3 +184,95 @@ def convert_size_input(size_input):
         )
 
     return int(first_parse['value']) * multiplier
+
+
+def validate_duration_input(config_value):
+    """Validate that a parseable duration has been provided."""
+    try:
+        convert_duration_input(config_value)
+        return ''
+    except DurationConversionError as err:
+        return str(err)
+
+
+class DurationConversionError(Exception):
+    """Raised when failing an attempt to convert a duration input."""
+
+
+def convert_duration_input(duration_input):
+    """Convert a duration input, e.g. 7d, to the duration in seconds."""
+    # Supported duration specifiers, with the required multiplier
+    supported_duration_specifiers = {
+        '': 1,
+        's': 1,
+        'm': 60,
+        'h': 60 * 60,
+        'd': 24 * 60 * 60,
+        'w': 7 * 24 * 60 * 60,
+    }
+    output_specifiers = ', '.join(('s', 'm', 'h', 'd', 'w'))
+
+    first_parse = DURATION_REGEX.match(str(duration_input))
+    if not first_parse:
+        raise DurationConversionError(
+            'Could not convert {inp} to duration. Expected numbers '
+            'followed by a unit ({units}). e.g. 7d'.format(
+                inp=duration_input,
+                units=output_specifiers,
+            )
+        )
+
+    first_parse = first_parse.groupdict()
+    multiplier = supported_duration_specifiers.get(
+        first_parse['unit'].lower(),
+    )
+    if not multiplier:
+        raise DurationConversionError(
+            'Could not convert {inp} to duration. Unrecognised unit {unit}. '
+            'Valid units are: {units}'.format(
+                inp=duration_input,
+                unit=first_parse['unit'],
+                units=output_specifiers,
+            )
+        )
+
+    return int(first_parse['value']) * multiplier
+
+
+def validate_time_window(config_value):
+    """Validate that a parseable daily time window has been provided."""
+    try:
+        parse_time_window(config_value)
+        return ''
+    except TimeWindowError as err:
+        return str(err)
+
+
+class TimeWindowError(Exception):
+    """Raised when failing an attempt to parse a time window."""
+
+
+def parse_time_window(window_input):
+    """Parse a daily time window, e.g. 22:00-06:00, to (start, end) times.
+    The end is before the start for windows which cross midnight."""
+    parsed = TIME_WINDOW_REGEX.match(str(window_input))
+    if not parsed:
+        raise TimeWindowError(
+            'Could not parse {inp} as a time window. Expected start and '
+            'end times, e.g. 22:00-06:00'.format(inp=window_input)
+        )
+    try:
+        start, end = (
+            datetime.strptime(parsed[bound], '%H:%M').time()
+            for bound in ('start', 'end')
+        )
+    except ValueError:
+        raise TimeWindowError(
+            'Could not parse {inp} as a time window. Times must be between '
+            '00:00 and 23:59.'.format(inp=window_input)
+        )
+    if start == end:
+        raise TimeWindowError(
+            'The time window {inp} is empty.'.format(inp=window_input)
+        )
+    return start, end
@@ -0,0 +1,454 @@
+#! /usr/bin/env python3
+"""Forecasting of how much a run will upload and how long it will take.
+
+The sources are walked and compared with the listing of each repo's latest
+archive, to find the new and changed files that borg will have to read.
+The compression ratio and throughput of each repo are taken from the run
+history kept in the state_directory (see borgit.metrics), to forecast the
+data each repo will store and the time its pipeline will take. How well the
+changed files will deduplicate can't be known in advance, so the forecast
+assumes they won't, and is an upper bound.
+
+With backup_window set, run_backup uses the forecast to refuse (or, with
+backup_window_action: defer, wait for the next window) a run which would
+not finish within the window.
+
+Run with: python -m borgit.estimate <config file>
+"""
+import argparse
+from collections import namedtuple
+from datetime import datetime, timedelta
+import json
+import os
+import sqlite3
+import stat
+import sys
+import time
+
+from borgit.config import InvalidConfiguration, load_config
+from borgit.data import parse_time_window
+from borgit.exceptions import OutsideBackupWindow
+from borgit.retention import group_archives
+from borgit.scratch import get_scratch_space
+from borgit.sources import plan_backup
+
+# Number of recent successful runs of a repo to forecast from.
+HISTORY_RUNS = 10
+
+# Files a run will need to back up.
+# new_*: Files which aren't in the latest archive.
+# changed_*: Files whose size or modification time differ from the archive.
+# unchanged_files: Files borg will skip using its files cache.
+ChangeEstimate = namedtuple(
+    'ChangeEstimate',
+    ['new_files', 'new_bytes', 'changed_files', 'changed_bytes',
+     'unchanged_files'],
+)
+
+# Forecast for one repo.
+# upload_bytes: Data expected to be stored, after compression. Assumes no
+#               deduplication of the changed files, so is an upper bound.
+# backup_seconds: Expected time for the backup itself.
+# total_seconds: Expected time for the repo's whole pipeline, including
+#                checks. None if the repo has no history to forecast from.
+# history_runs: Number of previous runs the forecast is based on.
+Forecast = namedtuple(
+    'Forecast',
+    ['target', 'repo', 'changes', 'upload_bytes', 'backup_seconds',
+     'total_seconds', 'history_runs'],
+)
+
+
+def scan_sources(sources):
+    """Get the size and modification time of every file in the sources.
+
+    :returns: A dict of (size, mtime) tuples keyed on the path as borg
+              stores it (without a leading /). mtime is a naive local
+              datetime, like borg's.
+    """
+    files = {}
+    for source in sources:
+        source = os.path.abspath(source)
+        if os.path.isfile(source):
+            walked = [(os.path.dirname(source), [os.path.basename(source)])]
+        else:
+            walked = (
+                (directory, names)
+                for directory, _, names in os.walk(source)
+            )
+        for directory, names in walked:
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    file_stat = os.lstat(path)
+                except OSError:
+                    # Files may vanish while the sources are walked.
+                    continue
+                if not stat.S_ISREG(file_stat.st_mode):
+                    continue
+                files[path.lstrip('/')] = (
+                    file_stat.st_size,
+                    datetime.fromtimestamp(file_stat.st_mtime),
+                )
+    return files
+
+
+def compare_with_archive(files, archived):
+    """Count the files which differ from an archive.
+
+    :param files: Files from scan_sources.
+    :param archived: FileRecords of the archive, or None if there is none.
+
+    :returns: A ChangeEstimate.
+    """
+    known = {}
+    for record in archived or []:
+        if record.type == '-':
+            known[record.path] = (record.size, record.mtime)
+    counts = {'new_files': 0, 'new_bytes': 0, 'changed_files': 0,
+              'changed_bytes': 0, 'unchanged_files': 0}
+    for path, (size, mtime) in files.items():
+        previous = known.get(path)
+        if previous is None:
+            counts['new_files'] += 1
+            counts['new_bytes'] += size
+        elif (previous[0] != size
+              or abs((previous[1] - mtime).total_seconds()) >= 0.001):
+            counts['changed_files'] += 1
+            counts['changed_bytes'] += size
+        else:
+            counts['unchanged_files'] += 1
+    return ChangeEstimate(**counts)
+
+
+def load_history(path, repo, limit=HISTORY_RUNS):
+    """Get a repo's recent successful runs from the run history.
+
+    :returns: A list of dicts of the backup statistics of each run, with
+              other_seconds, the wall clock time of the run's other phases
+              for the repo. Empty if there is no history.
+    """
+    if not path or not os.path.exists(path):
+        return []
+    connection = sqlite3.connect(path)
+    try:
+        rows = connection.execute(
+            'SELECT runs.id, backups.original_size, '
+            'backups.compressed_size, backups.deduplicated_size, '
+            'backups.duration FROM backups '
+            'JOIN runs ON runs.id = backups.run_id '
+            'WHERE backups.repo = ? AND runs.succeeded '
+            'ORDER BY runs.started DESC LIMIT ?',
+            (repo, limit),
+        ).fetchall()
+        history = []
+        for run_id, original, compressed, deduplicated, duration in rows:
+            other_seconds = _wall_clock(connection.execute(
+                'SELECT started, duration FROM phases '
+                'WHERE run_id = ? AND repo = ? '
+                "AND phase NOT IN ('backup', 'replicate')",
+                (run_id, repo),
+            ).fetchall())
+            history.append({
+                'original_size': original or 0,
+                'compressed_size': compressed or 0,
+                'deduplicated_size': deduplicated or 0,
+                'duration': duration or 0,
+                'other_seconds': other_seconds,
+            })
+        return history
+    except sqlite3.Error:
+        # A history from an older borgit may lack tables.
+        return []
+    finally:
+        connection.close()
+
+
+def _wall_clock(phases):
+    """Get the time during which any of a set of phases was running.
+    Phases may overlap, e.g. checks run concurrently, or be nested.
+
+    :param phases: A list of (started, duration) tuples. Phases recorded
+                   before start times were kept have no start, and are
+                   counted in full.
+    """
+    total = 0
+    end = None
+    for started, duration in sorted(
+            phase for phase in phases if phase[0] is not None):
+        finished = started + (duration or 0)
+        if end is None or started >= end:
+            total += finished - started
+            end = finished
+        elif finished > end:
+            total += finished - end
+            end = finished
+    return total + sum(
+        duration or 0 for started, duration in phases if started is None
+    )
+
+
+def fit_throughput(samples):
+    """Fit backup time as a fixed overhead plus time per byte stored.
+
+    :param samples: A list of (bytes stored, seconds) of previous backups,
+                    the bytes being after compression and deduplication.
+
+    :returns: (overhead seconds, bytes per second). The overhead is 0 if
+              the history doesn't show one, e.g. with only one run.
+    """
+    total_bytes = sum(size for size, _ in samples)
+    total_seconds = sum(seconds for _, seconds in samples)
+    if not total_seconds:
+        return 0, None
+    count = len(samples)
+    mean_bytes = total_bytes / count
+    mean_seconds = total_seconds / count
+    variance = sum((size - mean_bytes) ** 2 for size, _ in samples)
+    if count > 1 and variance:
+        slope = sum(
+            (size - mean_bytes) * (seconds - mean_seconds)
+            for size, seconds in samples
+        ) / variance
+        overhead = mean_seconds - slope * mean_bytes
+        if slope > 0 and overhead >= 0:
+            return overhead, 1 / slope
+    return 0, (total_bytes / total_seconds) or None
+
+
+def forecast(target, repo, changes, history):
+    """Forecast a repo's run from its changes and history.
+    The throughput is fitted to the data each past backup stored, and
+    applied to the changed data after compression, as that is the most
+    the backup will store."""
+    changed_bytes = changes.new_bytes + changes.changed_bytes
+    if not history:
+        return Forecast(
+            target=target, repo=repo.repo, changes=changes,
+            upload_bytes=changed_bytes, backup_seconds=None,
+            total_seconds=None, history_runs=0,
+        )
+    original = sum(run['original_size'] for run in history)
+    compressed = sum(run['compressed_size'] for run in history)
+    ratio = compressed / original if original else 1
+    upload_bytes = int(changed_bytes * ratio)
+    overhead, rate = fit_throughput([
+        (run['deduplicated_size'], run['duration']) for run in history
+    ])
+    backup_seconds = overhead + (upload_bytes / rate if rate else 0)
+    other_seconds = sum(run['other_seconds'] for run in history) / len(
+        history
+    )
+    return Forecast(
+        target=target, repo=repo.repo, changes=changes,
+        upload_bytes=upload_bytes, backup_seconds=backup_seconds,
+        total_seconds=backup_seconds + other_seconds,
+        history_runs=len(history),
+    )
+
+
+def estimate_run(repos, config):
+    """Forecast a run for each repo.
+
+    :param repos: Repos obtained via a get_repos call.
+    :param config: A valid borg config dict.
+
+    :returns: A list of Forecast, in the order of repos.
+    """
+    plan = plan_backup(config, 'estimate')
+    setting_names = [
+        setting['name'] for setting in config.get('source_settings') or []
+    ]
+    files = {
+        part.archive_name: scan_sources(part.sources) for part in plan
+    }
+    history_path = None
+    if config.get('state_directory'):
+        history_path = os.path.join(config['state_directory'],
+                                    'history.sqlite')
+
+    forecasts = []
+    for target, repo in repos.items():
+        groups = group_archives(repo.iter_archives(), setting_names)
+        totals = dict.fromkeys(ChangeEstimate._fields, 0)
+        for part in plan:
+            group = None
+            if part.archive_name != 'estimate':
+                group = part.archive_name[len('estimate-'):]
+            latest = max(groups.get(group, []), default=None,
+                         key=lambda archive: archive.start)
+            archived = None
+            if latest is not None:
+                archived = repo.iter_files_in_archive(latest.name,
+                                                      part.sources)
+            changes = compare_with_archive(files[part.archive_name],
+                                           archived)
+            for field, value in changes._asdict().items():
+                totals[field] += value
+        forecasts.append(forecast(
+            target, repo, ChangeEstimate(**totals),
+            load_history(history_path, repo.repo),
+        ))
+    return forecasts
+
+
+def _window_bounds(window, now):
+    """Get the start and end of the window which is open at now, or of the
+    next one if none is."""
+    start_time, end_time = window
+    start = datetime.combine(now.date(), start_time)
+    end = datetime.combine(now.date(), end_time)
+    if end <= start:
+        # The window crosses midnight.
+        if now < end:
+            start -= timedelta(days=1)
+        else:
+            end += timedelta(days=1)
+    if now >= end:
+        start += timedelta(days=1)
+        end += timedelta(days=1)
+    return start, end
+
+
+def run_duration(forecasts, concurrent):
+    """Get the forecast time for a run, or None if it can't be forecast."""
+    durations = [forecast.total_seconds for forecast in forecasts]
+    if not durations or None in durations:
+        return None
+    if concurrent:
+        return max(durations)
+    return sum(durations)
+
+
+def enforce_window(forecasts, config, logger, concurrent=False, now=None,
+                   sleep=time.sleep):
+    """Make sure a run will finish within the backup_window.
+    If it won't, the run is refused, or with backup_window_action: defer,
+    delayed until the next window if it would fit that.
+
+    :param now: The current time, as a naive local datetime.
+    :param sleep: Function to wait a number of seconds, for tests.
+
+    :raises OutsideBackupWindow: If the run is refused.
+    """
+    window = parse_time_window(config['backup_window'])
+    duration = run_duration(forecasts, concurrent)
+    if duration is None:
+        logger.warning(
+            'Cannot forecast the run time without previous runs to go on, '
+            'so starting it regardless of backup_window.'
+        )
+        return
+    now = now or datetime.now()
+    start, end = _window_bounds(window, now)
+    if start <= now and now + timedelta(seconds=duration) <= end:
+        return
+
+    description = (
+        'The run is forecast to take {duration:.0f}s, which will not fit '
+        'in the backup window {window}.'.format(
+            duration=duration, window=config['backup_window'],
+        )
+    )
+    if start <= now:
+        # The rest of this window isn't long enough, so try the next.
+        start += timedelta(days=1)
+        end += timedelta(days=1)
+    fits_next = start + timedelta(seconds=duration) <= end
+    if config.get('backup_window_action') == 'defer' and fits_next:
+        logger.warning('{description} Waiting until {start}.'.format(
+            description=description, start=start.isoformat(' ', 'minutes'),
+        ))
+        sleep((start - now).total_seconds())
+        return
+    raise OutsideBackupWindow(description)
+
+
+def format_forecasts(forecasts):
+    """Format forecasts as a table."""
+    lines = ['{:<16} {:>10} {:>12} {:>10} {:>12} {:>10}'.format(
+        'target', 'new files', 'changed', 'read MiB', 'upload MiB',
+        'time',
+    )]
+    for forecast in forecasts:
+        changes = forecast.changes
+        lines.append('{:<16} {:>10} {:>12} {:>10.1f} {:>12.1f} {:>10}'.format(
+            forecast.target,
+            changes.new_files,
+            changes.changed_files,
+            (changes.new_bytes + changes.changed_bytes) / 2**20,
+            forecast.upload_bytes / 2**20,
+            '{:.0f}s'.format(forecast.total_seconds)
+            if forecast.total_seconds is not None else 'unknown',
+        ))
+    return '\n'.join(lines)
+
+
+def main(args):
+    """Estimate a run with provided arguments."""
+    # Imported here as borgit.command uses this module.
+    from borgit.command import get_repos
+
+    parser = argparse.ArgumentParser(
+        description=(
+            'Forecast how much data a borgit run will upload to each '
+            'repository, and how long it will take.'
+        ),
+    )
+    parser.add_argument(
+        'config',
+        help='Path to the borgit config file.',
+    )
+    parser.add_argument(
+        '--concurrent',
+        action='store_true',
+        help='Forecast for repos being processed concurrently.',
+    )
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='Output the forecasts as JSON.',
+    )
+    args = parser.parse_args(args)
+
+    try:
+        config = load_config(args.config)
+    except InvalidConfiguration as err:
+        sys.stderr.write('Invalid config {path}:\n{err}\n'.format(
+            path=args.config, err=err,
+        ))
+        sys.exit(1)
+    with get_scratch_space(config) as scratch:
+        forecasts = estimate_run(get_repos(config, scratch), config)
+    duration = run_duration(forecasts, args.concurrent)
+
+    if args.json:
+        print(json.dumps({
+            'targets': [
+                dict(forecast._asdict(), changes=forecast.changes._asdict())
+                for forecast in forecasts
+            ],
+            'total_seconds': duration,
+        }, indent=2))
+    else:
+        print(format_forecasts(forecasts))
+        if duration is not None:
+            print('Forecast run time: {duration:.0f}s.'.format(
+                duration=duration,
+            ))
+
+    if config.get('backup_window') and duration is not None:
+        now = datetime.now()
+        start, end = _window_bounds(
+            parse_time_window(config['backup_window']), now,
+        )
+        if start > now or now + timedelta(seconds=duration) > end:
+            sys.stderr.write(
+                'A run started now would not finish within the backup '
+                'window {window}.\n'.format(window=config['backup_window'])
+            )
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,3 +3,27 @@
 
 class CheckFailure(Exception):
     """Raised when integrity checks of a backup fail."""
+
+
+class RepositoryCorrupt(Exception):
+    """Raised when a repository or archive fails a borg integrity check."""
+
+
+class RunCancelled(Exception):
+    """Raised when a repo pipeline is stopped because a sibling failed."""
+
+
+class CommandTimeout(Exception):
+    """Raised when a borg command does not finish within its timeout."""
+
+
+class ScratchSpaceError(Exception):
+    """Raised when there is not enough scratch space to restore files."""
+
+
+class OutsideBackupWindow(Exception):
+    """Raised when a run is forecast not to fit in the backup window."""
+
+
+class LockTimeout(Exception):
+    """Raised when a job can't get a repository within its lock wait."""
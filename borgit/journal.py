@@ -0,0 +1,95 @@
+"""Journal of the phases a run has completed, so an interrupted run can be
+resumed.
+
+If a run stops part way, e.g. because the machine was shut down or a
+network connection dropped, the next run carries on with the same archive
+name. Phases already completed for a repo are skipped, and borg continues
+creating the archive from its last checkpoint (see checkpoint_interval).
+"""
+import time
+
+from borgit.state import get_state_file
+
+# Interrupted runs older than this are abandoned rather than resumed, so a
+# long outage doesn't leave the next backup using stale data.
+RESUME_WINDOW = 24 * 60 * 60
+
+
+class RunJournal:
+    """Record of which phases of the current run completed for each repo.
+    The record is kept until the run finishes."""
+    def __init__(self, state_file, resume_window=RESUME_WINDOW):
+        """Initialise the journal.
+
+        :param state_file: The StateFile to keep the journal in.
+        :param resume_window: Seconds after which an interrupted run is not
+                              resumed.
+        """
+        self.state_file = state_file
+        self.resume_window = resume_window
+        self.resumed = False
+
+    def begin(self, archive_name, logger):
+        """Start a run, or resume the interrupted one.
+
+        :param archive_name: The archive name for a new run.
+        :param logger: A logger to report resuming to.
+
+        :returns: The archive name the run should use. This is that of the
+                  interrupted run if it is being resumed.
+        """
+        with self.state_file.update() as state:
+            run = state.get('run')
+            if run and time.time() - run['started'] > self.resume_window:
+                logger.warning(
+                    'Not resuming the interrupted run of {archive}, as it '
+                    'started too long ago.'.format(archive=run['archive'])
+                )
+                run = None
+            if run:
+                self.resumed = True
+                logger.info(
+                    'Resuming the interrupted run of {archive}.'.format(
+                        archive=run['archive'],
+                    )
+                )
+            else:
+                run = {
+                    'archive': archive_name,
+                    'started': time.time(),
+                    'completed': {},
+                }
+                state['run'] = run
+        return run['archive']
+
+    def is_done(self, repo, phase):
+        """Find whether a phase of the run completed for a repo.
+
+        :param repo: The location of the repo.
+        :param phase: The name of the phase, e.g. backup.
+        """
+        run = self.state_file.read().get('run') or {}
+        return phase in run.get('completed', {}).get(repo, [])
+
+    def mark_done(self, repo, phase):
+        """Record that a phase of the run completed for a repo."""
+        with self.state_file.update() as state:
+            completed = state['run']['completed'].setdefault(repo, [])
+            if phase not in completed:
+                completed.append(phase)
+
+    def finish(self):
+        """Record that the run finished, so the next run starts afresh."""
+        with self.state_file.update() as state:
+            state.pop('run', None)
+
+
+def get_journal(config):
+    """Get the run journal.
+
+    :returns: A RunJournal, or None if no state_directory is configured.
+    """
+    state_file = get_state_file(config, 'journal')
+    if state_file is None:
+        return None
+    return RunJournal(state_file)
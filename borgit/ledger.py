@@ -0,0 +1,138 @@
+"""Ledger of verified file content, so unchanged files need not be
+checked again on every run. Checks are keyed on a fingerprint of the files'
+content, and the ledger also keeps the last fingerprints seen so borg only
+needs to read the content of files whose metadata has changed.
+"""
+import json
+
+from borgit.repo import Fingerprint
+from borgit.state import get_state_file
+
+
+class VerificationLedger:
+    """Record of checks which have passed, keyed on repo, path, check and
+    the fingerprint of the file that was checked."""
+    def __init__(self, state_file, repo_name):
+        """Initialise the ledger for one repo."""
+        self.state_file = state_file
+        self.repo_name = repo_name
+
+    @staticmethod
+    def _check_key(check):
+        """Get a key identifying what a check does.
+        Changing the command or arguments means files must be re-checked."""
+        return json.dumps([
+            check.get('plugin') or check.get('command'),
+            check.get('arguments') or [],
+        ])
+
+    def start_run(self, full_verify_interval=None):
+        """Count a new run for this repo.
+
+        :param full_verify_interval: If set, every this many runs the ledger
+                                     will be ignored and all files checked.
+
+        :returns: True if this run should ignore the ledger.
+        """
+        with self.state_file.update() as state:
+            runs = state.setdefault('runs', {})
+            runs[self.repo_name] = runs.get(self.repo_name, 0) + 1
+            run_count = runs[self.repo_name]
+        return bool(
+            full_verify_interval and run_count % full_verify_interval == 0
+        )
+
+    def known_fingerprints(self):
+        """Get the fingerprints last recorded for this repo.
+
+        :returns: A dict of Fingerprints keyed on path, as passed to
+                  BorgRepo.get_fingerprints.
+        """
+        return {
+            path: Fingerprint(*fingerprint)
+            for path, fingerprint in self.state_file.read().get(
+                'fingerprints', {},
+            ).get(self.repo_name, {}).items()
+        }
+
+    def record_fingerprints(self, fingerprints):
+        """Record the fingerprints of paths in the latest archive."""
+        with self.state_file.update() as state:
+            state.setdefault('fingerprints', {}).setdefault(
+                self.repo_name, {},
+            ).update({
+                path: list(fingerprint)
+                for path, fingerprint in fingerprints.items()
+            })
+
+    def previously_verified(self, check, fingerprint):
+        """Find whether this check already passed on identical content.
+
+        :returns: The name of the archive it was verified in, or None.
+        """
+        entry = self.state_file.read().get('verified', {}).get(
+            self.repo_name, {},
+        ).get(check['path'], {}).get(self._check_key(check))
+        if entry and entry['fingerprint'] == fingerprint.content:
+            return entry['archive']
+        return None
+
+    def record_pass(self, check, fingerprint, archive_name):
+        """Record that a check passed on a file with this fingerprint."""
+        with self.state_file.update() as state:
+            paths = state.setdefault('verified', {}).setdefault(
+                self.repo_name, {},
+            )
+            paths.setdefault(check['path'], {})[self._check_key(check)] = {
+                'fingerprint': fingerprint.content,
+                'archive': archive_name,
+            }
+
+
+def get_ledger(config, repo):
+    """Get the verification ledger for a repo.
+
+    :returns: A VerificationLedger, or None if no state_directory is
+              configured.
+    """
+    state_file = get_state_file(config, 'verification_ledger')
+    if state_file is None:
+        return None
+    return VerificationLedger(state_file, repo.repo)
+
+
+def filter_verified_checks(ledger, checks, fingerprints, archive_name,
+                           logger, full_verify_interval=None):
+    """Drop checks which have already passed on identical content.
+
+    :param ledger: The VerificationLedger for the repo.
+    :param checks: The check_files entries due to be run.
+    :param fingerprints: Fingerprints of the checked paths, as returned by
+                         BorgRepo.get_fingerprints.
+    :param archive_name: The archive being checked.
+    :param logger: A logger to report skipped checks.
+    :param full_verify_interval: Ignore the ledger every this many runs.
+
+    :returns: The checks which still need to be run.
+    """
+    if ledger.start_run(full_verify_interval):
+        logger.info(
+            'Checking all files in {archive}, ignoring previous '
+            'verifications.'.format(archive=archive_name)
+        )
+        return checks
+
+    remaining = []
+    for check in checks:
+        fingerprint = fingerprints.get(check['path'].lstrip('/'))
+        verified_in = None
+        if fingerprint:
+            verified_in = ledger.previously_verified(check, fingerprint)
+        if verified_in:
+            logger.info(
+                '[{path}] Unchanged, previously verified in archive '
+                '{archive}.'.format(path=check['path'], archive=verified_in)
+            )
+        else:
+            remaining.append(check)
+    return remaining
@@ -0,0 +1,288 @@
+"""Performance metrics for borgit runs.
+
+Timings of each phase of a run and of each borg command, along with the
+statistics borg reports for each backup, are collected by RunMetrics. They
+can be written as a JSON report, as a Prometheus textfile (for the node
+exporter's textfile collector), and appended to an SQLite history so that
+changes in throughput can be seen over time.
+"""
+from contextlib import contextmanager
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+HISTORY_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY,
+        archive TEXT,
+        started REAL,
+        duration REAL,
+        succeeded INTEGER
+    )''',
+    '''CREATE TABLE IF NOT EXISTS phases (
+        run_id INTEGER REFERENCES runs(id),
+        repo TEXT,
+        phase TEXT,
+        duration REAL,
+        succeeded INTEGER,
+        started REAL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS backups (
+        run_id INTEGER REFERENCES runs(id),
+        repo TEXT,
+        original_size INTEGER,
+        compressed_size INTEGER,
+        deduplicated_size INTEGER,
+        nfiles INTEGER,
+        duration REAL
+    )''',
+)
+
+
+class RunMetrics:
+    """Collector for the metrics of one borgit run.
+    Safe to record to from several threads."""
+    def __init__(self, archive_name):
+        """Initialise the collector for a run creating archive_name."""
+        self.archive_name = archive_name
+        self.started = time.time()
+        self.finished = None
+        self.succeeded = None
+        self.phases = []
+        self.commands = []
+        self.backups = {}
+        self.targets = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, repo, phase_name):
+        """Time a phase of the run for a repo, e.g. 'backup'."""
+        started = time.time()
+        start = time.monotonic()
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            with self._lock:
+                self.phases.append({
+                    'repo': repo,
+                    'phase': phase_name,
+                    'duration': time.monotonic() - start,
+                    'succeeded': succeeded,
+                    'started': started,
+                })
+
+    def record_command(self, repo, command, duration, returncode):
+        """Record the time taken by a borg command."""
+        with self._lock:
+            self.commands.append({
+                'repo': repo,
+                'command': command,
+                'duration': duration,
+                'returncode': returncode,
+            })
+
+    def record_backup(self, repo, stats):
+        """Record the statistics of a backup, as returned by
+        BorgRepo.backup."""
+        with self._lock:
+            self.backups[repo] = stats
+
+    def record_target(self, target, repo, duration, error=None):
+        """Record the outcome of processing one repo of the run.
+
+        :param target: The name the repo is configured with.
+        :param repo: The location of the repo.
+        :param duration: Seconds spent processing the repo.
+        :param error: The exception which stopped the repo, if any.
+        """
+        with self._lock:
+            self.targets.append({
+                'target': target,
+                'repo': repo,
+                'duration': duration,
+                'succeeded': error is None,
+                'error': None if error is None else str(error),
+            })
+
+    def finish(self, succeeded):
+        """Mark the run as finished."""
+        self.finished = time.time()
+        self.succeeded = succeeded
+
+    def report(self):
+        """Get the metrics as a dict suitable for JSON output."""
+        with self._lock:
+            return {
+                'archive': self.archive_name,
+                'started': self.started,
+                'duration': (self.finished or time.time()) - self.started,
+                'succeeded': self.succeeded,
+                'phases': list(self.phases),
+                'commands': list(self.commands),
+                'backups': dict(self.backups),
+                'targets': list(self.targets),
+            }
+
+    def write_json(self, path):
+        """Write the run report as JSON."""
+        _write_atomically(path, json.dumps(self.report(), indent=2))
+
+    def write_prometheus(self, path):
+        """Write the run's metrics in Prometheus text exposition format."""
+        report = self.report()
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append('# HELP {name} {help}'.format(
+                name=name, help=help_text,
+            ))
+            lines.append('# TYPE {name} gauge'.format(name=name))
+            for labels, value in samples:
+                label_text = ','.join(
+                    '{key}="{value}"'.format(
+                        key=key, value=_escape_label(labels[key]),
+                    )
+                    for key in sorted(labels)
+                )
+                if label_text:
+                    label_text = '{' + label_text + '}'
+                lines.append('{name}{labels} {value}'.format(
+                    name=name, labels=label_text, value=value,
+                ))
+
+        metric('borgit_run_start_time_seconds',
+               'When the last run started.',
+               [({}, report['started'])])
+        metric('borgit_run_duration_seconds',
+               'Time taken by the last run.',
+               [({}, report['duration'])])
+        metric('borgit_run_success',
+               'Whether the last run succeeded.',
+               [({}, int(bool(report['succeeded'])))])
+        metric('borgit_phase_duration_seconds',
+               'Time taken by each phase of the last run.',
+               [({'repo': phase['repo'], 'phase': phase['phase']},
+                 phase['duration'])
+                for phase in report['phases']])
+
+        metric('borgit_target_success',
+               'Whether each repo was processed successfully in the last '
+               'run.',
+               [({'target': target['target']}, int(target['succeeded']))
+                for target in report['targets']])
+        metric('borgit_target_duration_seconds',
+               'Time taken to process each repo in the last run.',
+               [({'target': target['target']}, target['duration'])
+                for target in report['targets']])
+
+        command_totals = {}
+        for command in report['commands']:
+            key = (command['repo'], command['command'])
+            command_totals[key] = (
+                command_totals.get(key, 0) + command['duration']
+            )
+        metric('borgit_borg_command_duration_seconds',
+               'Total time spent in each borg command in the last run.',
+               [({'repo': repo, 'command': command}, duration)
+                for (repo, command), duration in sorted(
+                    command_totals.items())])
+
+        for stat, help_text in (
+                ('original_size', 'Size of the data backed up.'),
+                ('compressed_size', 'Compressed size of the data.'),
+                ('deduplicated_size', 'Size of new data after '
+                                      'deduplication.'),
+                ('nfiles', 'Number of files backed up.'),
+                ('duration', 'Time borg reported for the backup.')):
+            metric('borgit_backup_' + stat,
+                   help_text,
+                   [({'repo': repo}, stats[stat])
+                    for repo, stats in sorted(report['backups'].items())
+                    if stats.get(stat) is not None])
+
+        _write_atomically(path, '\n'.join(lines) + '\n')
+
+    def append_history(self, path):
+        """Append this run to an SQLite history database."""
+        report = self.report()
+        connection = sqlite3.connect(path)
+        try:
+            with connection:
+                for statement in HISTORY_SCHEMA:
+                    connection.execute(statement)
+                _add_missing_columns(connection)
+                run_id = connection.execute(
+                    'INSERT INTO runs (archive, started, duration, '
+                    'succeeded) VALUES (?, ?, ?, ?)',
+                    (report['archive'], report['started'],
+                     report['duration'], report['succeeded']),
+                ).lastrowid
+                connection.executemany(
+                    'INSERT INTO phases (run_id, repo, phase, duration, '
+                    'succeeded, started) VALUES (?, ?, ?, ?, ?, ?)',
+                    [(run_id, phase['repo'], phase['phase'],
+                      phase['duration'], phase['succeeded'],
+                      phase.get('started'))
+                     for phase in report['phases']],
+                )
+                connection.executemany(
+                    'INSERT INTO backups VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(run_id, repo, stats.get('original_size'),
+                      stats.get('compressed_size'),
+                      stats.get('deduplicated_size'), stats.get('nfiles'),
+                      stats.get('duration'))
+                     for repo, stats in report['backups'].items()],
+                )
+        finally:
+            connection.close()
+
+
+def _add_missing_columns(connection):
+    """Add columns introduced since a history database was created."""
+    columns = {
+        row[1] for row in connection.execute('PRAGMA table_info(phases)')
+    }
+    if 'started' not in columns:
+        connection.execute('ALTER TABLE phases ADD COLUMN started REAL')
+
+
+def _escape_label(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomically(path, content):
+    """Write a file so that readers never see it partially written."""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as output:
+        output.write(content)
+    os.replace(temp_path, path)
+
+
+def write_metrics(metrics, config, logger):
+    """Write a run's metrics to every configured destination."""
+    destinations = [
+        (config.get('metrics_report_path'), metrics.write_json),
+        (config.get('metrics_textfile_path'), metrics.write_prometheus),
+    ]
+    if config.get('state_directory'):
+        destinations.append((
+            os.path.join(config['state_directory'], 'history.sqlite'),
+            metrics.append_history,
+        ))
+    for path, writer in destinations:
+        if not path:
+            continue
+        try:
+            writer(path)
+        except (OSError, sqlite3.Error) as err:
+            # Failing to report should not fail the backup.
+            logger.warning('Could not write metrics to {path}: {err}'.format(
+                path=path, err=err,
+            ))
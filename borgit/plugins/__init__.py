@@ -0,0 +1,37 @@
+"""In-process check plugins for borgit.
+
+A plugin is a callable taking (source, arguments), where source is either a
+path to the file to check or a binary file object streaming its content, and
+arguments is the list of arguments from the check_files entry. It returns a
+borgit.checks.CheckResult.
+"""
+import importlib
+
+
+# Check commands which are implemented in python, so can be run without
+# starting a new interpreter.
+BUILTIN_PLUGINS = {
+    'check_keepass': 'borgit.plugins.keepass:check',
+    'check_format': 'borgit.plugins.formats:check',
+}
+
+
+def load_plugin(plugin_path):
+    """Import a plugin callable given as 'module:callable'."""
+    module_name, _, callable_name = plugin_path.partition(':')
+    module = importlib.import_module(module_name)
+    return getattr(module, callable_name)
+
+
+def get_plugin(check):
+    """Get the plugin for a check_files entry.
+
+    :returns: The plugin callable, or None if the check must be run as an
+              external command.
+    """
+    plugin_path = check.get('plugin') or BUILTIN_PLUGINS.get(
+        check.get('command'),
+    )
+    if plugin_path:
+        return load_plugin(plugin_path)
+    return None
@@ -0,0 +1,82 @@
+"""File format checker for borgit.
+Checks that files are valid for their format, e.g. that a ZIP file has its
+central directory, reading only the parts of the file needed (see
+borgit.validators)."""
+import argparse
+import sys
+
+from borgit.checks import CheckResult
+from borgit.validators import FormatError, validate_format, VALIDATORS
+
+
+def get_parser():
+    """Get the argument parser for format checks."""
+    parser = argparse.ArgumentParser(
+        description='Check a file is valid for its format for borgit.',
+    )
+
+    parser.add_argument(
+        '-f', '--format',
+        required=True,
+        choices=sorted(VALIDATORS),
+        help='The format the file should be in.',
+    )
+    parser.add_argument(
+        'target_file',
+        help='Path to the file, or - to read it from stdin.',
+    )
+    return parser
+
+
+def check(source, arguments):
+    """Check plugin entry point, see borgit.plugins."""
+    parser = get_parser()
+    # The file to check is supplied separately from the arguments.
+    try:
+        parsed, unknown = parser.parse_known_args(list(arguments) + ['-'])
+    except SystemExit:
+        parsed = None
+        unknown = arguments
+    if unknown or parsed is None:
+        return CheckResult(
+            passed=False,
+            messages=[],
+            errors=['Invalid arguments: {args}'.format(
+                args=' '.join(unknown),
+            )],
+            metrics={},
+        )
+
+    try:
+        details = validate_format(source, parsed.format)
+    except FormatError as err:
+        return CheckResult(
+            passed=False,
+            messages=[],
+            errors=[str(err)],
+            metrics={},
+        )
+    return CheckResult(
+        passed=True,
+        messages=[],
+        errors=[],
+        metrics=details,
+    )
+
+
+def main(args):
+    """Run the checks with provided arguments."""
+    args = get_parser().parse_args(args)
+
+    if args.target_file == '-':
+        target_file = sys.stdin.buffer
+    else:
+        target_file = args.target_file
+
+    try:
+        details = validate_format(target_file, args.format)
+    except FormatError as err:
+        sys.stderr.write(str(err) + '\n')
+        sys.exit(1)
+    for name, value in sorted(details.items()):
+        print('{name}: {value}'.format(name=name, value=value))
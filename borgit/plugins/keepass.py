@@ -0,0 +1,159 @@
+"""Keepass file checker for borgit.
+With thanks to lgg on github's gist:
+https://gist.github.com/lgg/e6ccc6e212d18dd2ecd8a8c116fb1e45"""
+import argparse
+import sys
+
+from borgit.checks import CheckResult
+from borgit.validators import (
+    ByteRange,
+    FormatError,
+    KDB_FIELDS_SIZE,
+    KDB_HEADER_SIZE,
+    KEEPASS_SIGNATURE,
+    parse_kdb_header,
+    read_ranges,
+)
+
+
+class CheckFailure(Exception):
+    """Exceptions that fail the script's health checks."""
+
+
+class NotKDB(CheckFailure):
+    """Error when a file is not a valid KDB."""
+
+
+class UnsupportedKDB(CheckFailure):
+    """Error for unsupported KDB file versions."""
+
+
+class ConstraintViolated(CheckFailure):
+    """Error when user-provided constraints are violated."""
+
+
+def validate_signature(signature):
+    """Validate the KDB file signature."""
+    if signature != KEEPASS_SIGNATURE:
+        raise NotKDB(
+            'Target file is not a valid KDB file.',
+        )
+
+
+def get_kdb_details(data):
+    """Get information from the KDB file.
+    The header is parsed as for the kdb format validator.
+    Returns a dict containing:
+      version: The version of the KDB file.
+      groups: Count of groups in the KDB file.
+      entries: Count of entries in the KDB file.
+    """
+    try:
+        kdb_details = parse_kdb_header(data)
+    except FormatError as err:
+        raise UnsupportedKDB(str(err))
+    if kdb_details['version'] != '1':
+        raise UnsupportedKDB(
+            'Only version 1.x KDB supported currently.'
+        )
+    return kdb_details
+
+
+def check_kdb_file(target_file, min_entries):
+    """Check a KDB file is valid and meets the specified requirements.
+    The target may be a path or a binary file object. Only the header is
+    read, so a streamed file is not read to its end.
+    Returns the details of the KDB file."""
+    chunks, _ = read_ranges(target_file, [ByteRange(0, KDB_HEADER_SIZE)])
+    kdb_data = chunks[0]
+    if not isinstance(target_file, str):
+        target_file = 'streamed file'
+    if len(kdb_data) < KDB_FIELDS_SIZE:
+        raise NotKDB(
+            'Target file is too short to be a valid KDB file.',
+        )
+
+    validate_signature(kdb_data[0:4])
+
+    kdb_details = get_kdb_details(kdb_data)
+
+    if kdb_details['entries'] < min_entries:
+        raise ConstraintViolated(
+            'At least {req} entries were required, '
+            'but {kdb_path} had {count} entries.'.format(
+                req=min_entries,
+                kdb_path=target_file,
+                count=kdb_details['entries'],
+            )
+        )
+    return kdb_details
+
+
+def get_parser():
+    """Get the argument parser for keepass checks."""
+    parser = argparse.ArgumentParser(
+        description='Check a keepass DB for borgit.',
+    )
+
+    parser.add_argument(
+        '-e', '--min-entries',
+        type=int,
+        default=0,
+        help='Minimum entries to consider this KDB healthy.',
+    )
+    parser.add_argument(
+        'keepass_file',
+        help='Path to KDB file, or - to read it from stdin.',
+    )
+    return parser
+
+
+def check(source, arguments):
+    """Check plugin entry point, see borgit.plugins."""
+    parser = get_parser()
+    # The file to check is supplied separately from the arguments.
+    try:
+        parsed, unknown = parser.parse_known_args(list(arguments) + ['-'])
+    except SystemExit:
+        unknown = arguments
+    if unknown:
+        return CheckResult(
+            passed=False,
+            messages=[],
+            errors=['Invalid arguments: {args}'.format(
+                args=' '.join(unknown),
+            )],
+            metrics={},
+        )
+
+    try:
+        details = check_kdb_file(source, parsed.min_entries)
+    except CheckFailure as err:
+        return CheckResult(
+            passed=False,
+            messages=[],
+            errors=[str(err)],
+            metrics={},
+        )
+    return CheckResult(
+        passed=True,
+        messages=[],
+        errors=[],
+        metrics=details,
+    )
+
+
+def main(args):
+    """Run the checks with provided arguments."""
+    args = get_parser().parse_args(args)
+
+    if args.keepass_file == '-':
+        target_file = sys.stdin.buffer
+    else:
+        target_file = args.keepass_file
+
+    try:
+        check_kdb_file(target_file, args.min_entries)
+    except CheckFailure as err:
+        sys.stderr.write(str(err) + '\n')
+        sys.exit(1)
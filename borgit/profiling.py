@@ -0,0 +1,246 @@
+#! /usr/bin/env python3
+"""Compare borg compression and chunker settings on a sample of a source.
+
+A random sample of the source's files is copied to a scratch directory (so
+that every setting reads the same data from the page cache), then backed up
+into a fresh repository with each candidate setting. The throughput and
+stored size of each are reported, to help choose source_settings.
+
+Run with: python -m borgit.profiling <source path>
+"""
+import argparse
+from collections import namedtuple
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from borgit.data import validate_chunker_params, validate_compression
+from borgit.repo import BorgRepo
+
+DEFAULT_COMPRESSION_CANDIDATES = (
+    'none', 'lz4', 'zstd,3', 'auto,zstd,3', 'zstd,10', 'auto,lzma,6',
+)
+
+# Outcome of backing up the sample with one setting.
+# throughput: Bytes of the sample backed up per second.
+# ratio: Stored (compressed) size as a proportion of the original size.
+ProfileResult = namedtuple(
+    'ProfileResult',
+    ['compression', 'chunker_params', 'duration', 'original_size',
+     'compressed_size', 'deduplicated_size', 'throughput', 'ratio'],
+)
+
+
+def sample_source(source, destination, sample_bytes, seed=0):
+    """Copy a random selection of files from a source.
+
+    :param source: The directory (or file) to sample.
+    :param destination: The directory to copy the sample into.
+    :param sample_bytes: Stop once the sample is at least this big.
+    :param seed: Seed for choosing files, so samples can be repeated.
+
+    :returns: The number of files and bytes sampled.
+    """
+    if os.path.isfile(source):
+        paths = [source]
+        source = os.path.dirname(source)
+    else:
+        paths = [
+            os.path.join(directory, name)
+            for directory, _, names in os.walk(source)
+            for name in names
+        ]
+    random.Random(seed).shuffle(paths)
+
+    file_count = 0
+    sampled_bytes = 0
+    for path in paths:
+        if sampled_bytes >= sample_bytes:
+            break
+        if not os.path.isfile(path) or os.path.islink(path):
+            continue
+        target = os.path.join(destination, os.path.relpath(path, source))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            shutil.copyfile(path, target)
+        except OSError:
+            # Files may vanish or be unreadable, the rest still make a sample.
+            continue
+        file_count += 1
+        sampled_bytes += os.path.getsize(target)
+    return file_count, sampled_bytes
+
+
+def profile_settings(sample_dir, candidates, working_directory, logger=None):
+    """Back up a sample with each candidate setting.
+
+    :param sample_dir: The directory holding the sample.
+    :param candidates: List of (compression, chunker_params) tuples.
+                       chunker_params may be None for borg's default.
+    :param working_directory: Where to create the scratch repositories.
+    :param logger: Optional logger for borg's output.
+
+    :returns: A list of ProfileResult, in the order of the candidates.
+    """
+    results = []
+    for compression, chunker_params in candidates:
+        repo_dir = tempfile.mkdtemp(prefix='profile-',
+                                    dir=working_directory)
+        try:
+            repo = BorgRepo(
+                repo=os.path.join(repo_dir, 'repo'),
+                repo_key='borgit-profile',
+                working_directory=repo_dir,
+                logger=logger,
+            )
+            repo.init()
+            start = time.monotonic()
+            stats = repo.backup('profile', [sample_dir], compression,
+                                chunker_params)
+            duration = stats.get('duration') or time.monotonic() - start
+        finally:
+            shutil.rmtree(repo_dir)
+        original_size = stats['original_size']
+        results.append(ProfileResult(
+            compression=compression,
+            chunker_params=chunker_params,
+            duration=duration,
+            original_size=original_size,
+            compressed_size=stats['compressed_size'],
+            deduplicated_size=stats['deduplicated_size'],
+            throughput=original_size / duration if duration else None,
+            ratio=(stats['compressed_size'] / original_size
+                   if original_size else None),
+        ))
+    return results
+
+
+def format_results(results):
+    """Format profile results as a table, smallest stored size first."""
+    lines = ['{:<16} {:<24} {:>10} {:>8} {:>12}'.format(
+        'compression', 'chunker params', 'MiB/s', 'ratio', 'stored MiB',
+    )]
+    for result in sorted(results, key=lambda res: res.deduplicated_size):
+        lines.append('{:<16} {:<24} {:>10} {:>8} {:>12.1f}'.format(
+            result.compression,
+            result.chunker_params or 'default',
+            '{:.1f}'.format(result.throughput / 2**20)
+            if result.throughput else '-',
+            '{:.3f}'.format(result.ratio) if result.ratio else '-',
+            result.deduplicated_size / 2**20,
+        ))
+    return '\n'.join(lines)
+
+
+def main(args):
+    """Profile borg settings on a source with provided arguments."""
+    parser = argparse.ArgumentParser(
+        description=(
+            'Compare borg compression and chunker settings on a sample of '
+            'a backup source.'
+        ),
+    )
+    parser.add_argument(
+        'source',
+        help='The source path to sample.',
+    )
+    parser.add_argument(
+        '-c', '--compression',
+        action='append',
+        help=(
+            'Compression to try. May be given several times. Defaults to: '
+            '{candidates}'.format(
+                candidates=' '.join(DEFAULT_COMPRESSION_CANDIDATES),
+            )
+        ),
+    )
+    parser.add_argument(
+        '-p', '--chunker-params',
+        action='append',
+        help=(
+            'Chunker params to try with each compression. May be given '
+            'several times. Defaults to borg\'s default.'
+        ),
+    )
+    parser.add_argument(
+        '-s', '--sample-mib',
+        type=int,
+        default=256,
+        help='MiB of the source to sample.',
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='Seed for choosing the sample.',
+    )
+    parser.add_argument(
+        '-w', '--working-directory',
+        default=tempfile.gettempdir(),
+        help='Where to put the sample and scratch repositories.',
+    )
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='Output the results as JSON.',
+    )
+    args = parser.parse_args(args)
+
+    compressions = args.compression or list(DEFAULT_COMPRESSION_CANDIDATES)
+    chunker_params = args.chunker_params or [None]
+    problems = [
+        validate_compression(compression) for compression in compressions
+    ] + [
+        validate_chunker_params(params)
+        for params in chunker_params if params
+    ]
+    problems = [problem for problem in problems if problem]
+    if problems:
+        parser.error(' '.join(problems))
+
+    logger = logging.getLogger('borgit-profile')
+    sample_dir = tempfile.mkdtemp(prefix='profile-sample-',
+                                  dir=args.working_directory)
+    try:
+        file_count, sampled_bytes = sample_source(
+            args.source, sample_dir, args.sample_mib * 2**20, args.seed,
+        )
+        if not file_count:
+            sys.stderr.write('No readable files found in {source}.\n'.format(
+                source=args.source,
+            ))
+            sys.exit(1)
+        results = profile_settings(
+            sample_dir,
+            [(compression, params)
+             for compression in compressions
+             for params in chunker_params],
+            args.working_directory,
+            logger,
+        )
+    finally:
+        shutil.rmtree(sample_dir)
+
+    if args.json:
+        print(json.dumps({
+            'source': args.source,
+            'sampled_files': file_count,
+            'sampled_bytes': sampled_bytes,
+            'results': [result._asdict() for result in results],
+        }, indent=2))
+    else:
+        print('Sampled {count} files, {size:.1f} MiB, from {source}.'.format(
+            count=file_count,
+            size=sampled_bytes / 2**20,
+            source=args.source,
+        ))
+        print(format_results(results))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
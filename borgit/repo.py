@@ -1,21 +1,168 @@
 #! /usr/bin/env python3
 """Borgit repo handler."""
+import asyncio
+from collections import namedtuple
+from datetime import datetime
+import hashlib
+import json
+import logging
+import math
 import os
 import subprocess
+import threading
+import time
 
+from borgit.exceptions import CommandTimeout, RunCancelled
 
-class BorgRepo:
-    """Class for working with a specific borg repository."""
-    def __init__(self, repo, repo_key, working_directory):
+
+# An archive in a repository. start is a datetime.
+ArchiveRecord = namedtuple('ArchiveRecord', ['name', 'id', 'start'])
+# An item in an archive. type is borg's type character, e.g. - for a regular
+# file or d for a directory. mtime is a datetime. hash is the sha256 of the
+# content, or None if it was not requested.
+FileRecord = namedtuple(
+    'FileRecord',
+    ['path', 'type', 'size', 'mtime', 'hash'],
+)
+# Fingerprints of the items at or under a path in an archive. metadata is a
+# digest of the size, mtime, ctime and chunk count borg keeps for each item,
+# content is a digest of their sha256s.
+Fingerprint = namedtuple('Fingerprint', ['metadata', 'content'])
+
+# How long borg is given to exit cleanly when stopped before it is killed.
+TERMINATE_GRACE_SECONDS = 10
+# Longest line of borg output that will be read, e.g. one JSON lines record.
+OUTPUT_LINE_LIMIT = 16 * 1024 * 1024
+# How often a running borg command checks whether its run was cancelled.
+CANCEL_POLL_SECONDS = 0.2
+
+
+async def _stop_process(proc):
+    """Stop a borg process, killing it if it will not terminate."""
+    if proc.returncode is not None:
+        return
+    proc.terminate()
+    try:
+        await asyncio.wait_for(proc.wait(), TERMINATE_GRACE_SECONDS)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+
+
+async def _wait_for(awaitable, timeout, cancel_event=None):
+    """Wait for an awaitable as asyncio.wait_for does, but also stop waiting
+    if cancel_event (a threading.Event) is set. The awaitable is cancelled
+    if it is not waited for.
+
+    :raises asyncio.TimeoutError: If the timeout expires.
+    :raises RunCancelled: If cancel_event is set first.
+    """
+    if cancel_event is None:
+        return await asyncio.wait_for(awaitable, timeout)
+
+    async def cancelled():
+        while not cancel_event.is_set():
+            await asyncio.sleep(CANCEL_POLL_SECONDS)
+
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(cancelled())
+    try:
+        done, _ = await asyncio.wait(
+            [task, watcher], timeout=timeout,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    if task in done:
+        return task.result()
+    if watcher in done:
+        raise RunCancelled('Cancelled due to failure of another repo.')
+    raise asyncio.TimeoutError()
+
+
+def _unique_archive_paths(paths):
+    """Get archive paths without leading slashes or duplicates."""
+    # Paths don't have a leading / in the repository, so we'll remove any
+    # supplied leading slashes.
+    sources = []
+    for path in paths:
+        path = path.lstrip('/')
+        if path not in sources:
+            sources.append(path)
+    return sources
+
+
+def _digest_items(items, path):
+    """Digest the descriptions of the items at or under a path.
+
+    :param items: A list of (path, description) tuples.
+
+    :returns: The hex digest, or None if no item is at or under the path.
+    """
+    digest = hashlib.sha256()
+    found = False
+    for item_path, description in items:
+        if item_path == path or item_path.startswith(path.rstrip('/') + '/'):
+            digest.update('{description} {path}\n'.format(
+                description=description, path=item_path,
+            ).encode('UTF-8', 'surrogateescape'))
+            found = True
+    return digest.hexdigest() if found else None
+
+
+class AsyncBorgRepo:
+    """Class for working with a specific borg repository from asyncio.
+    Output from borg is logged line by line while commands run, and commands
+    may be given timeouts or cancelled. If cancel_event (a threading.Event)
+    is set, running commands are stopped and raise RunCancelled."""
+    def __init__(self, repo, repo_key, working_directory, logger=None,
+                 timeout=None, timeouts=None, metrics=None, lock_wait=None,
+                 remote_ratelimit=None, checkpoint_interval=None):
         """Initialise borg repository handler.
-        This will not actually initialise the borg repository."""
+        This will not actually initialise the borg repository.
+
+        :param logger: Logger for borg's output. Defaults to this module's.
+        :param timeout: Seconds any borg command may run before it is
+                        stopped, or None for no limit.
+        :param timeouts: Dict of timeouts for specific borg commands, e.g.
+                         {'create': 3600}, overriding timeout.
+        :param metrics: Optional RunMetrics to record command timings in.
+        :param lock_wait: Seconds borg waits for a repository lock, if not
+                          borg's default.
+        :param remote_ratelimit: Limit on the rate of data sent to a remote
+                                 repository, in KiB/s.
+        :param checkpoint_interval: Seconds between the checkpoints borg
+                                    writes while creating an archive, if not
+                                    borg's default.
+        """
         self.repo = repo
         self.repo_key = repo_key
         self.working_directory = working_directory
+        self.logger = logger or logging.getLogger(__name__)
+        self.timeout = timeout
+        self.timeouts = timeouts or {}
+        self.metrics = metrics
+        self.lock_wait = lock_wait
+        self.remote_ratelimit = remote_ratelimit
+        self.checkpoint_interval = checkpoint_interval
+        # Command borg uses to connect to remote repos, e.g. to reuse a
+        # shared SSH connection. None leaves borg to use its default.
+        self.rsh = None
+        self.cancel_event = None
+
+    def _record_command(self, command, start, returncode):
+        """Record how long a borg command took, if collecting metrics."""
+        if self.metrics:
+            self.metrics.record_command(
+                self.repo, command, time.monotonic() - start, returncode,
+            )
 
-    def _run_borg_command(self, command, archive_name=None, args=None,
-                          sources=None):
-        """Run a borg command on an archive with any (list of) args."""
+    def _build_borg_command(self, command, archive_name=None, args=None,
+                            sources=None):
+        """Get the command line and environment for a borg command."""
         borg_env = os.environ.copy()
         borg_env.update({
             'BORG_REPO': self.repo,
@@ -23,70 +170,753 @@ class BorgRepo:
             # this user... but that's true of the config file anyway.
             'BORG_PASSPHRASE': self.repo_key,
         })
+        if self.rsh:
+            borg_env['BORG_RSH'] = self.rsh
 
         borg_command = ['borg', command]
+        if self.lock_wait:
+            borg_command.extend(['--lock-wait', str(int(self.lock_wait))])
+        if self.remote_ratelimit:
+            borg_command.extend(['--remote-ratelimit',
+                                 str(self.remote_ratelimit)])
         if args:
             borg_command.extend(args)
         if archive_name:
             borg_command.append('::' + archive_name)
         if sources:
             borg_command.extend(sources)
-        return subprocess.check_output(borg_command, env=borg_env,
-                                       cwd=self.working_directory)
+        return borg_command, borg_env
 
-    def init(self):
+    async def _start_borg_command(self, command, archive_name=None,
+                                  args=None, sources=None, cwd=None,
+                                  stdin=None, stdout=asyncio.subprocess.PIPE):
+        """Start a borg command, with its output available as streams.
+        A file descriptor given as stdin or stdout is handed over to borg and
+        closed here, so that the other end of a pipe sees borg finish."""
+        borg_command, borg_env = self._build_borg_command(
+            command, archive_name, args, sources,
+        )
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *borg_command,
+                env=borg_env,
+                cwd=cwd or self.working_directory,
+                stdin=stdin,
+                stdout=stdout,
+                stderr=asyncio.subprocess.PIPE,
+                limit=OUTPUT_LINE_LIMIT,
+            )
+        finally:
+            for stream in stdin, stdout:
+                if isinstance(stream, int) and stream >= 0:
+                    os.close(stream)
+        return borg_command, proc
+
+    async def _log_stream(self, stream, lines=None):
+        """Log each line from a stream as it arrives.
+        If lines is a list, the lines are kept in it instead of logged."""
+        async for line in stream:
+            if lines is None:
+                self.logger.info(
+                    line.decode('UTF-8', 'replace').rstrip('\n'),
+                )
+            else:
+                lines.append(line)
+
+    async def _run_borg_command(self, command, archive_name=None, args=None,
+                                sources=None, cwd=None, stdin=None,
+                                stdout=asyncio.subprocess.PIPE,
+                                log_output=True):
+        """Run a borg command on an archive with any (list of) args.
+        The command runs in the working directory unless cwd is given.
+        borg's stderr is logged as it runs, as is stdout unless log_output
+        is False or stdout is sent elsewhere. Returns stdout if it was not
+        logged.
+
+        :raises CommandTimeout: If the command's timeout expires.
+        :raises RunCancelled: If cancel_event is set while it runs.
+        :raises CalledProcessError: If borg fails.
+        """
+        start = time.monotonic()
+        borg_command, proc = await self._start_borg_command(
+            command, archive_name, args, sources, cwd, stdin, stdout,
+        )
+        stdout = None if log_output else []
+        timeout = self.timeouts.get(command, self.timeout)
+        streams = [self._log_stream(proc.stderr), proc.wait()]
+        if proc.stdout is not None:
+            streams.append(self._log_stream(proc.stdout, stdout))
+        try:
+            await _wait_for(asyncio.gather(*streams), timeout,
+                            self.cancel_event)
+        except asyncio.TimeoutError:
+            await _stop_process(proc)
+            raise CommandTimeout(
+                '{command} did not finish within {timeout}s.'.format(
+                    command=' '.join(borg_command),
+                    timeout=timeout,
+                )
+            )
+        except (asyncio.CancelledError, RunCancelled):
+            await _stop_process(proc)
+            raise
+        finally:
+            self._record_command(command, start, proc.returncode)
+
+        output = b''.join(stdout or [])
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(
+                proc.returncode, borg_command, output=output,
+            )
+        return output
+
+    async def _stream_borg_command(self, command, archive_name=None,
+                                   args=None, sources=None):
+        """Run a borg command, yielding lines of its output as they arrive.
+        CalledProcessError is raised after the last line if borg failed, and
+        RunCancelled if cancel_event is set between lines."""
+        start = time.monotonic()
+        borg_command, proc = await self._start_borg_command(
+            command, archive_name, args, sources,
+        )
+        stderr_logger = asyncio.ensure_future(self._log_stream(proc.stderr))
+        try:
+            async for line in proc.stdout:
+                if (self.cancel_event is not None
+                        and self.cancel_event.is_set()):
+                    raise RunCancelled(
+                        'Cancelled due to failure of another repo.'
+                    )
+                yield line
+            await stderr_logger
+            if await proc.wait() != 0:
+                raise subprocess.CalledProcessError(
+                    proc.returncode, borg_command,
+                )
+        finally:
+            # If the caller stopped early there is no point letting borg
+            # carry on.
+            await _stop_process(proc)
+            stderr_logger.cancel()
+            try:
+                await stderr_logger
+            except asyncio.CancelledError:
+                pass
+            self._record_command(command, start, proc.returncode)
+
+    async def stream_file_from_archive(self, archive_name, path, stdout):
+        """Extract a file from an archive to stdout, a file descriptor such
+        as the write end of a pipe. It is closed once borg has it.
+
+        :raises CommandTimeout: If the extract's timeout expires.
+        :raises CalledProcessError: If borg fails, e.g. because the reader
+                                    closed the pipe early.
+        """
+        await self._run_borg_command(
+            'extract', archive_name,
+            args=['--stdout'],
+            sources=[path.lstrip('/')],
+            stdout=stdout,
+        )
+
+    async def init(self):
         """Initialise the borg backup repository."""
-        self._run_borg_command(
+        await self._run_borg_command(
             'init',
             args=['--encryption=repokey'],
         )
 
-    def backup(self, archive_name, sources):
-        """Backup data using borg."""
+    def _creation_args(self, compression, chunker_params):
+        """Get the borg arguments for how a new archive is written."""
+        args = ['--compression', compression]
+        if chunker_params:
+            args.extend(['--chunker-params', chunker_params])
+        if self.checkpoint_interval:
+            args.extend(['--checkpoint-interval',
+                         str(int(self.checkpoint_interval))])
+        return args
+
+    async def _archive_exists(self, archive_name):
+        """Determine whether the repository has an archive."""
+        return any([
+            archive.name == archive_name
+            async for archive in self.iter_archives()
+        ])
+
+    async def _delete_checkpoints(self, archive_name):
+        """Delete the checkpoints an interrupted attempt to create an
+        archive left behind."""
+        checkpoint = archive_name + '.checkpoint'
+        checkpoints = [
+            archive.name async for archive in self.iter_archives()
+            if archive.name == checkpoint
+            or archive.name.startswith(checkpoint + '.')
+        ]
+        if checkpoints:
+            await self.delete_archives(checkpoints)
+
+    async def backup(self, archive_name, sources, compression='lz4',
+                     chunker_params=None, resume=False):
+        """Backup data using borg.
+        Returns a dict of the statistics borg reports for the new archive:
+        original_size, compressed_size, deduplicated_size, nfiles and
+        duration.
+
+        :param compression: The borg compression spec to use.
+        :param chunker_params: The borg chunker params to use, if not
+                               borg's default.
+        :param resume: Continue an interrupted attempt to create the
+                       archive. Data from its checkpoints is not sent again,
+                       and the checkpoints are removed afterwards. If the
+                       archive was completed, None is returned.
+        """
         if isinstance(sources, str):
             sources = [sources]
-        self._run_borg_command(
+        if resume and await self._archive_exists(archive_name):
+            return None
+        output = await self._run_borg_command(
             'create', archive_name,
             args=[
-                '--stats', '--verbose', '--show-rc',
-                '--compression', 'lz4',
-            ],
+                '--json', '--verbose', '--show-rc',
+            ] + self._creation_args(compression, chunker_params),
             sources=sources,
+            log_output=False,
         )
+        if resume:
+            await self._delete_checkpoints(archive_name)
+        return _archive_stats(output)
 
-    def list_archives(self):
+    async def import_archive(self, source, archive_name, compression='lz4',
+                             chunker_params=None, resume=False):
+        """Copy an archive from another repository into this one.
+        The archive is streamed from borg export-tar on the source straight
+        into borg import-tar here, so the backed up files are not read from
+        disk again. Returns statistics as for backup.
+
+        :param source: The AsyncBorgRepo holding the archive.
+        :param archive_name: The archive to copy. It keeps its name.
+        :param compression: As for backup.
+        :param chunker_params: As for backup.
+        :param resume: As for backup.
+        """
+        if resume and await self._archive_exists(archive_name):
+            return None
+        read_end, write_end = os.pipe()
+        export = asyncio.ensure_future(source._run_borg_command(
+            'export-tar', archive_name,
+            sources=['-'],
+            stdout=write_end,
+        ))
+        import_ = asyncio.ensure_future(self._run_borg_command(
+            'import-tar', archive_name,
+            args=['--json'] + self._creation_args(compression,
+                                                  chunker_params),
+            sources=['-'],
+            stdin=read_end,
+            log_output=False,
+        ))
+        try:
+            # If either side fails the other will see the pipe break, but
+            # the first failure is the one worth reporting.
+            _, output = await asyncio.gather(export, import_)
+        except BaseException:
+            for task in export, import_:
+                task.cancel()
+            await asyncio.gather(export, import_, return_exceptions=True)
+            raise
+        if resume:
+            await self._delete_checkpoints(archive_name)
+        return _archive_stats(output)
+
+    async def delete_archives(self, archive_names):
+        """Delete archives from the repository.
+        The space they used is not freed until the repository is compacted.
+        """
+        await self._run_borg_command(
+            'delete', archive_names[0],
+            sources=archive_names[1:],
+        )
+
+    async def prune(self, glob, policy):
+        """Delete the archives matching a glob which borg prune's keep
+        rules don't keep, along with checkpoints a later archive superseded.
+        The space they used is not freed until the repository is compacted.
+
+        :param glob: Only archives whose names match this are considered.
+        :param policy: A dict of the keep_* settings. keep_within is in
+                       seconds, and rounded up to whole hours for borg.
+        """
+        args = ['--glob-archives', glob]
+        for option, value in sorted(policy.items()):
+            if option == 'keep_within':
+                value = '{hours}H'.format(
+                    hours=max(1, math.ceil(value / 3600)),
+                )
+            args.extend(['--' + option.replace('_', '-'), str(value)])
+        await self._run_borg_command('prune', args=args)
+
+    async def list_archives(self):
         """Get a list of all archives in the repository."""
-        return self._run_borg_command(
+        return (await self._run_borg_command(
             'list',
             args=['--format', '{archive}{NL}'],
-        ).splitlines()
+            log_output=False,
+        )).splitlines()
 
-    def list_files_in_archive(self, archive_name):
+    async def iter_archives(self):
+        """Yield an ArchiveRecord for each archive in the repository."""
+        listing = json.loads(await self._run_borg_command(
+            'list',
+            args=['--json'],
+            log_output=False,
+        ))
+        for archive in listing['archives']:
+            yield ArchiveRecord(
+                name=archive['name'],
+                id=archive['id'],
+                start=datetime.fromisoformat(archive['start']),
+            )
+
+    async def latest_archive(self):
+        """Get the most recently started archive's ArchiveRecord.
+        Returns None if the repository has no archives."""
+        return max(
+            [archive async for archive in self.iter_archives()],
+            key=lambda archive: archive.start,
+            default=None,
+        )
+
+    async def list_files_in_archive(self, archive_name):
         """Get a list of all files in an archive."""
-        return self._run_borg_command(
+        return (await self._run_borg_command(
             'list', archive_name,
             args=['--format', '{path}{NL}'],
-        ).splitlines()
+            log_output=False,
+        )).splitlines()
 
-    def restore_file_from_archive(self, archive_name, path):
-        """Restore specific file or directory from an archive."""
-        # Paths don't have a leading / in the repository, so we'll remove any
-        # supplied leading slashes.
-        path = path.lstrip('/')
-        self._run_borg_command(
+    async def iter_files_in_archive(self, archive_name, paths=None,
+                                    with_hash=False):
+        """Yield a FileRecord for each item in an archive.
+        Items are read from borg as they are listed, so large archives can be
+        processed without holding the whole listing in memory.
+
+        :param archive_name: The archive to list.
+        :param paths: Only list items at or under these paths.
+        :param with_hash: Include the sha256 of each file. Borg must read all
+                          of the content to provide this.
+        """
+        args = ['--json-lines']
+        if with_hash:
+            # With --json-lines, a format replaces the default size and mtime
+            # keys with the keys it names, so they must be named too.
+            args.extend(['--format', '{size}{mtime}{sha256}'])
+        sources = None
+        if paths:
+            sources = sorted(_unique_archive_paths(paths))
+        lines = self._stream_borg_command(
+            'list', archive_name, args=args, sources=sources,
+        )
+        try:
+            async for line in lines:
+                item = json.loads(line)
+                yield FileRecord(
+                    path=item['path'],
+                    type=item['type'],
+                    size=item.get('size', 0),
+                    mtime=datetime.fromisoformat(item['mtime']),
+                    hash=item.get('sha256'),
+                )
+        finally:
+            # Stop borg now if we were stopped early, rather than whenever
+            # the listing generator is garbage collected.
+            await lines.aclose()
+
+    async def get_fingerprints(self, archive_name, paths, known=None):
+        """Get a Fingerprint of the items at or under each path in an
+        archive. Changing, adding or removing any item changes both parts.
+        Borg must read the content of files to hash them, so as with its own
+        files cache, the content fingerprint of a path whose metadata
+        fingerprint is unchanged is reused rather than read again.
+
+        :param archive_name: The archive to fingerprint paths in.
+        :param paths: The paths to fingerprint.
+        :param known: Fingerprints from a previous archive, keyed on path
+                      without leading /.
+
+        :returns: A dict of Fingerprints keyed on path (without leading /).
+                  Paths which are not in the archive are omitted.
+        """
+        known = known or {}
+        paths = [path.lstrip('/') for path in paths]
+        # With --json-lines, a format replaces the default size and mtime
+        # keys with the keys it names.
+        items = await self._list_item_digests(
+            archive_name, paths, '{size}{mtime}{ctime}{num_chunks}',
+            '{size} {mtime} {ctime} {num_chunks}',
+        )
+        metadata = {}
+        for path in paths:
+            digest = _digest_items(items, path)
+            if digest:
+                metadata[path] = digest
+
+        changed = [
+            path for path, digest in metadata.items()
+            if path not in known or known[path].metadata != digest
+        ]
+        content = {}
+        if changed:
+            items = await self._list_item_digests(
+                archive_name, changed, '{sha256}', '{type} {sha256}',
+            )
+            for path in changed:
+                content[path] = _digest_items(items, path)
+
+        return {
+            path: Fingerprint(
+                metadata=digest,
+                content=content[path] if path in content
+                else known[path].content,
+            )
+            for path, digest in metadata.items()
+        }
+
+    async def _list_item_digests(self, archive_name, paths, list_format,
+                                 item_format):
+        """List the items at or under paths in an archive.
+
+        :param list_format: The keys borg should list for each item.
+        :param item_format: How those keys are combined into the digested
+                            description of each item.
+
+        :returns: A list of (path, description) tuples.
+        """
+        lines = self._stream_borg_command(
+            'list', archive_name,
+            args=['--json-lines', '--format', list_format],
+            sources=sorted(_unique_archive_paths(paths)),
+        )
+        items = []
+        try:
+            async for line in lines:
+                item = json.loads(line)
+                items.append((item['path'], item_format.format(**item)))
+        finally:
+            await lines.aclose()
+        return items
+
+    async def restore_files_from_archive(self, archive_name, paths,
+                                         destination=None):
+        """Restore many files or directories from an archive.
+        All paths are extracted by a single borg invocation, into the
+        destination directory if one is given or the working directory
+        otherwise."""
+        await self._run_borg_command(
             'extract',
             archive_name=archive_name,
-            sources=[path],
+            sources=_unique_archive_paths(paths),
+            cwd=destination,
         )
 
-    def check(self):
-        """Verify the integrity of the repository."""
-        self._run_borg_command(
+    async def check(self, repository_only=False, archives_only=False,
+                    verify_data=False, last=None, max_duration=None):
+        """Verify the integrity of the repository.
+
+        :param repository_only: Only check the repository's segments.
+        :param archives_only: Only check the archives' metadata.
+        :param verify_data: Also read and verify all archived data.
+        :param last: Only check this many of the most recent archives.
+        :param max_duration: Run a partial repository check for at most this
+                             many seconds. Borg will continue from where it
+                             stopped on the next partial check.
+        """
+        args = []
+        if repository_only:
+            args.append('--repository-only')
+        if archives_only:
+            args.append('--archives-only')
+        if verify_data:
+            args.append('--verify-data')
+        if last:
+            args.extend(['--last', str(last)])
+        if max_duration:
+            args.extend(['--max-duration', str(int(max_duration))])
+        await self._run_borg_command(
             'check',
+            args=args,
         )
 
-    def check_archive(self, archive_name):
-        """Verify the integrity of a specific archive."""
-        self._run_borg_command(
+    async def check_archive(self, archive_name, archives_only=False):
+        """Verify the integrity of a specific archive.
+        If archives_only is set, the repository's segments are not checked.
+        """
+        await self._run_borg_command(
             'check', archive_name,
+            args=['--archives-only'] if archives_only else None,
+        )
+
+    async def compact(self):
+        """Free the space in the repository's segments used by deleted
+        archives."""
+        await self._run_borg_command('compact')
+
+    async def repository_stats(self):
+        """Get borg's statistics for the whole repository.
+        Returns a dict including unique_csize, the space used by the
+        repository's data."""
+        output = await self._run_borg_command(
+            'info',
+            args=['--json'],
+            log_output=False,
+        )
+        return json.loads(output)['cache']['stats']
+
+
+def _archive_stats(output):
+    """Get the statistics of a new archive from borg's JSON output."""
+    archive = json.loads(output)['archive']
+    stats = dict(archive['stats'])
+    stats['duration'] = archive.get('duration')
+    return stats
+
+
+def _run_sync(coroutine):
+    """Run a coroutine to completion from synchronous code."""
+    return asyncio.run(coroutine)
+
+
+def _iterate_sync(async_iterable):
+    """Iterate over an async iterable from synchronous code."""
+    loop = asyncio.new_event_loop()
+    iterator = async_iterable.__aiter__()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(iterator.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        # Make sure any borg process is stopped if iteration ended early.
+        loop.run_until_complete(iterator.aclose())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        # Let the closed process's transports finish closing.
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+
+
+class FileStream:
+    """A file being streamed from an archive by borg, which runs through
+    AsyncBorgRepo in a thread of its own. The content is read from stdout,
+    which the reader must close before calling wait."""
+    def __init__(self, engine, archive_name, path):
+        """Start streaming the file."""
+        read_fd, write_fd = os.pipe()
+        self.stdout = os.fdopen(read_fd, 'rb')
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._extract,
+            args=(engine, archive_name, path, write_fd),
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _extract(self, engine, archive_name, path, write_fd):
+        """Run borg until the file has been streamed."""
+        try:
+            _run_sync(engine.stream_file_from_archive(
+                archive_name, path, write_fd,
+            ))
+        except Exception as err:  # pylint: disable=broad-except
+            # Passed to the caller by wait.
+            self._error = err
+
+    def wait(self):
+        """Wait for borg to finish.
+
+        :raises CommandTimeout: If the extract's timeout expired.
+
+        :returns: borg's exit code.
+        """
+        self._thread.join()
+        if isinstance(self._error, subprocess.CalledProcessError):
+            return self._error.returncode
+        if self._error is not None:
+            raise self._error
+        return 0
+
+
+class BorgRepo:
+    """Class for working with a specific borg repository.
+    This is a synchronous wrapper around AsyncBorgRepo."""
+    def __init__(self, repo, repo_key, working_directory, logger=None,
+                 timeout=None, timeouts=None, metrics=None, lock_wait=None,
+                 remote_ratelimit=None, checkpoint_interval=None):
+        """Initialise borg repository handler.
+        This will not actually initialise the borg repository.
+        See AsyncBorgRepo for the optional arguments."""
+        self.engine = AsyncBorgRepo(
+            repo=repo,
+            repo_key=repo_key,
+            working_directory=working_directory,
+            logger=logger,
+            timeout=timeout,
+            timeouts=timeouts,
+            metrics=metrics,
+            lock_wait=lock_wait,
+            remote_ratelimit=remote_ratelimit,
+            checkpoint_interval=checkpoint_interval,
         )
+
+    @property
+    def repo(self):
+        """The location of the borg repository."""
+        return self.engine.repo
+
+    @property
+    def repo_key(self):
+        """The passphrase for the borg repository."""
+        return self.engine.repo_key
+
+    @property
+    def working_directory(self):
+        """The directory borg commands are run in."""
+        return self.engine.working_directory
+
+    @property
+    def metrics(self):
+        """The RunMetrics borg command timings are recorded in, if any."""
+        return self.engine.metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        """Set where borg command timings are recorded."""
+        self.engine.metrics = metrics
+
+    @property
+    def rsh(self):
+        """The command borg uses to connect to the repository, if not
+        borg's default."""
+        return self.engine.rsh
+
+    @rsh.setter
+    def rsh(self, rsh):
+        """Set the command borg uses to connect to the repository."""
+        self.engine.rsh = rsh
+
+    @property
+    def cancel_event(self):
+        """The threading.Event which stops running borg commands when set,
+        if any."""
+        return self.engine.cancel_event
+
+    @cancel_event.setter
+    def cancel_event(self, cancel_event):
+        """Set the event which stops running borg commands."""
+        self.engine.cancel_event = cancel_event
+
+    def init(self):
+        """Initialise the borg backup repository."""
+        _run_sync(self.engine.init())
+
+    def backup(self, archive_name, sources, compression='lz4',
+               chunker_params=None, resume=False):
+        """Backup data using borg.
+        See AsyncBorgRepo.backup."""
+        return _run_sync(self.engine.backup(
+            archive_name, sources, compression, chunker_params, resume,
+        ))
+
+    def import_archive(self, source, archive_name, compression='lz4',
+                       chunker_params=None, resume=False):
+        """Copy an archive from another BorgRepo into this one.
+        See AsyncBorgRepo.import_archive."""
+        return _run_sync(self.engine.import_archive(
+            source.engine, archive_name, compression, chunker_params, resume,
+        ))
+
+    def delete_archives(self, archive_names):
+        """Delete archives from the repository.
+        See AsyncBorgRepo.delete_archives."""
+        _run_sync(self.engine.delete_archives(archive_names))
+
+    def prune(self, glob, policy):
+        """Delete the archives matching a glob which the keep rules don't
+        keep. See AsyncBorgRepo.prune."""
+        _run_sync(self.engine.prune(glob, policy))
+
+    def list_archives(self):
+        """Get a list of all archives in the repository."""
+        return _run_sync(self.engine.list_archives())
+
+    def iter_archives(self):
+        """Yield an ArchiveRecord for each archive in the repository."""
+        return _iterate_sync(self.engine.iter_archives())
+
+    def latest_archive(self):
+        """Get the most recently started archive's ArchiveRecord.
+        Returns None if the repository has no archives."""
+        return _run_sync(self.engine.latest_archive())
+
+    def list_files_in_archive(self, archive_name):
+        """Get a list of all files in an archive."""
+        return _run_sync(self.engine.list_files_in_archive(archive_name))
+
+    def iter_files_in_archive(self, archive_name, paths=None,
+                              with_hash=False):
+        """Yield a FileRecord for each item in an archive.
+        See AsyncBorgRepo.iter_files_in_archive."""
+        return _iterate_sync(self.engine.iter_files_in_archive(
+            archive_name, paths, with_hash,
+        ))
+
+    def get_fingerprints(self, archive_name, paths, known=None):
+        """Get fingerprints of the items at or under paths in an archive.
+        See AsyncBorgRepo.get_fingerprints."""
+        return _run_sync(
+            self.engine.get_fingerprints(archive_name, paths, known),
+        )
+
+    def restore_file_from_archive(self, archive_name, path):
+        """Restore specific file or directory from an archive."""
+        self.restore_files_from_archive(archive_name, [path])
+
+    def restore_files_from_archive(self, archive_name, paths,
+                                   destination=None):
+        """Restore many files or directories from an archive.
+        See AsyncBorgRepo.restore_files_from_archive."""
+        _run_sync(self.engine.restore_files_from_archive(
+            archive_name, paths, destination,
+        ))
+
+    def stream_file_from_archive(self, archive_name, path):
+        """Start streaming a file from an archive to a pipe.
+        borg is subject to the repo's timeouts, and logged and timed like
+        any other command.
+
+        :returns: A FileStream.
+        """
+        return FileStream(self.engine, archive_name, path)
+
+    def check(self, repository_only=False, archives_only=False,
+              verify_data=False, last=None, max_duration=None):
+        """Verify the integrity of the repository.
+        See AsyncBorgRepo.check."""
+        _run_sync(self.engine.check(
+            repository_only, archives_only, verify_data, last, max_duration,
+        ))
+
+    def check_archive(self, archive_name, archives_only=False):
+        """Verify the integrity of a specific archive.
+        If archives_only is set, the repository's segments are not checked.
+        """
+        _run_sync(self.engine.check_archive(archive_name, archives_only))
+
+    def compact(self):
+        """Free the space used by deleted archives.
+        See AsyncBorgRepo.compact."""
+        _run_sync(self.engine.compact())
+
+    def repository_stats(self):
+        """Get borg's statistics for the whole repository.
+        See AsyncBorgRepo.repository_stats."""
+        return _run_sync(self.engine.repository_stats())
@@ -0,0 +1,315 @@
+"""Removal of old archives according to a retention policy.
+
+The keep_* settings are borg prune's options of the same names: keep_within
+keeps every archive in that period, keep_last keeps that many of the latest
+archives, and the rest keep the latest archive of each of that many hours,
+days, weeks, months or years which have archives.
+
+The rules are applied separately to the run's own archives and to those of
+each source_settings entry (see borgit.sources), by running borg prune
+limited to a glob matching each kind, before the repository is compacted.
+borg prune also deletes checkpoints left by interrupted backups once a later
+backup of the same sources has completed. The archives just created and the
+last ones to pass their checks are always kept, which prune does as long as
+they are the latest of their kind. Borg 1.x globs can't exclude names, so
+when a kind's glob would also match other archives (e.g. the run's own
+archives alongside source_settings ones), or a protected archive isn't the
+latest, the rules are applied here instead and the archives not kept are
+deleted with borg delete.
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+from fnmatch import fnmatchcase
+from glob import escape
+import time
+
+from borgit.data import convert_duration_input
+from borgit.state import get_state_file
+
+# Rules for keeping the latest archive of each period, from the shortest
+# period, as with borg prune. Each maps an archive's start to its period.
+PERIOD_RULES = (
+    ('keep_last', lambda start: start),
+    ('keep_hourly', lambda start: start.strftime('%Y-%m-%d %H')),
+    ('keep_daily', lambda start: start.strftime('%Y-%m-%d')),
+    ('keep_weekly', lambda start: start.isocalendar()[:2]),
+    ('keep_monthly', lambda start: start.strftime('%Y-%m')),
+    ('keep_yearly', lambda start: start.year),
+)
+RETENTION_OPTIONS = ('keep_within',) + tuple(rule for rule, _ in PERIOD_RULES)
+
+# Outcome of applying retention to a repo.
+# deleted: Names of the archives deleted.
+# archives_before, archives_after: Number of archives in the repository.
+# reclaimed_bytes: Space freed by compacting the repository.
+# list_before, list_after: Seconds taken to list the archives.
+RetentionResult = namedtuple(
+    'RetentionResult',
+    ['deleted', 'archives_before', 'archives_after', 'reclaimed_bytes',
+     'list_before', 'list_after'],
+)
+
+
+def select_archives_to_keep(archives, policy, now=None):
+    """Apply the retention rules to a set of archives.
+
+    :param archives: ArchiveRecords of one kind of archive.
+    :param policy: A dict of the keep_* settings. keep_within is in seconds.
+    :param now: The current time, as a naive local datetime like borg's.
+
+    :returns: The set of names of the archives to keep.
+    """
+    now = now or datetime.now()
+    archives = sorted(archives, key=lambda archive: archive.start,
+                      reverse=True)
+    keep = set()
+    if policy.get('keep_within'):
+        cutoff = now - timedelta(seconds=policy['keep_within'])
+        keep.update(
+            archive.name for archive in archives if archive.start > cutoff
+        )
+    for rule, period_of in PERIOD_RULES:
+        count = policy.get(rule)
+        if not count:
+            continue
+        kept = 0
+        last_period = None
+        for archive in archives:
+            period = period_of(archive.start)
+            if period == last_period:
+                continue
+            last_period = period
+            if archive.name not in keep:
+                keep.add(archive.name)
+                kept += 1
+                if kept == count:
+                    break
+    return keep
+
+
+def _archive_group(archive_name, source_setting_names):
+    """Get the source_settings entry an archive was created for, or None
+    for the run's own archive. Checkpoints belong with the archive they
+    are a checkpoint of."""
+    archive_name = archive_name.split('.checkpoint')[0]
+    for name in sorted(source_setting_names, key=len, reverse=True):
+        if archive_name.endswith('-' + name):
+            return name
+    return None
+
+
+def _group_glob(group):
+    """Get the glob matching the archives of a source_settings entry and
+    their checkpoints, or those of the run's own archives if group is None.
+    """
+    if group is None:
+        return '*'
+    return '*-{name}*'.format(name=escape(group))
+
+
+def group_archives(archives, source_setting_names):
+    """Group archives by the source_settings entry they were created for.
+
+    :returns: A dict of lists of ArchiveRecords, keyed on the setting name,
+              with the run's own archives under None. Checkpoints of
+              interrupted backups are left out.
+    """
+    groups = {}
+    for archive in archives:
+        if '.checkpoint' in archive.name:
+            continue
+        group = _archive_group(archive.name, source_setting_names)
+        groups.setdefault(group, []).append(archive)
+    return groups
+
+
+def stale_checkpoints(archives, source_setting_names):
+    """Find checkpoints which a later completed backup has superseded.
+
+    :returns: The names of checkpoints older than the newest completed
+              archive of the same sources.
+    """
+    newest = {
+        group: max(archive.start for archive in members)
+        for group, members in group_archives(
+            archives, source_setting_names).items()
+    }
+    return [
+        archive.name for archive in archives
+        if '.checkpoint' in archive.name
+        and archive.start < newest.get(
+            _archive_group(archive.name, source_setting_names),
+            archive.start,
+        )
+    ]
+
+
+class RetentionPolicy:
+    """Prune a repo's archives which the retention rules don't keep."""
+    def __init__(self, repo, logger, policy, source_setting_names=(),
+                 state_file=None):
+        """Initialise the policy for one repo.
+
+        :param repo: The BorgRepo to apply the policy to.
+        :param logger: A logger to report the results to.
+        :param policy: A dict of the keep_* settings. keep_within is in
+                       seconds.
+        :param source_setting_names: The names of the source_settings,
+                                     whose archives are kept separately.
+        :param state_file: Optional StateFile recording which archives last
+                           passed their checks.
+        """
+        self.repo = repo
+        self.logger = logger
+        self.policy = policy
+        self.source_setting_names = list(source_setting_names)
+        self.state_file = state_file
+
+    def _list_archives(self):
+        """List the repo's archives, timing how long it takes."""
+        start = time.monotonic()
+        archives = list(self.repo.iter_archives())
+        return archives, time.monotonic() - start
+
+    def record_verified(self, archive_names):
+        """Record that archives passed their checks, so they are kept."""
+        if self.state_file is None:
+            return
+        with self.state_file.update() as state:
+            state[self.repo.repo] = {'last_verified': list(archive_names)}
+
+    def protected_archives(self, archive_names):
+        """Get the archives which must be kept regardless of the rules:
+        those given (e.g. just created) and the last to pass their checks.
+        """
+        protected = set(archive_names)
+        if self.state_file is not None:
+            protected.update(self.state_file.read().get(
+                self.repo.repo, {},
+            ).get('last_verified', []))
+        return protected
+
+    def _prunable(self, group, members, archives, protected):
+        """Find whether borg prune can apply the rules to a group of
+        archives: its glob must match only the group's archives and their
+        checkpoints, and any protected archives must be the group's latest,
+        which prune always keeps. Borg lists start times to the second, so
+        the latest must also be the only archive started in that second."""
+        in_group = {
+            archive.name for archive in archives
+            if _archive_group(archive.name, self.source_setting_names)
+            == group
+        }
+        matched = {
+            archive.name for archive in archives
+            if fnmatchcase(archive.name, _group_glob(group))
+        }
+        latest_start = max(archive.start for archive in members)
+        latest = [
+            archive.name for archive in members
+            if archive.start == latest_start
+        ]
+        return matched == in_group and len(latest) == 1 and all(
+            archive.name in latest for archive in members
+            if archive.name in protected
+        )
+
+    def apply(self, archive_names):
+        """Prune archives not kept by the rules, then compact.
+
+        :param archive_names: The archives of the backup just made, which
+                              will be kept.
+
+        :returns: A RetentionResult.
+        """
+        protected = self.protected_archives(archive_names)
+        archives, list_before = self._list_archives()
+        size_before = self.repo.repository_stats()['unique_csize']
+        stale = stale_checkpoints(archives, self.source_setting_names)
+        delete = []
+        for group, members in group_archives(
+                archives, self.source_setting_names).items():
+            if self._prunable(group, members, archives, protected):
+                self.repo.prune(_group_glob(group), self.policy)
+                continue
+            keep = protected | select_archives_to_keep(members, self.policy)
+            delete.extend(
+                archive.name for archive in archives
+                if archive.name not in keep
+                and _archive_group(archive.name, self.source_setting_names)
+                == group
+                and ('.checkpoint' not in archive.name
+                     or archive.name in stale)
+            )
+        if delete:
+            self.repo.delete_archives(delete)
+        remaining, list_after = self._list_archives()
+        remaining_names = {archive.name for archive in remaining}
+        deleted = [
+            archive.name for archive in archives
+            if archive.name not in remaining_names
+        ]
+        if not deleted:
+            self.logger.info('Retention: no archives to delete.')
+            return RetentionResult(
+                deleted=[],
+                archives_before=len(archives),
+                archives_after=len(remaining),
+                reclaimed_bytes=0,
+                list_before=list_before,
+                list_after=list_after,
+            )
+
+        self.repo.compact()
+        size_after = self.repo.repository_stats()['unique_csize']
+        result = RetentionResult(
+            deleted=deleted,
+            archives_before=len(archives),
+            archives_after=len(remaining),
+            reclaimed_bytes=size_before - size_after,
+            list_before=list_before,
+            list_after=list_after,
+        )
+        self._report(result)
+        return result
+
+    def _report(self, result):
+        """Log the outcome of applying retention."""
+        self.logger.info(
+            'Retention: deleted {deleted} of {before} archives, reclaiming '
+            '{reclaimed:.1f} MiB, leaving {after}. Listing archives took '
+            '{list_after:.2f}s, down from {list_before:.2f}s.'.format(
+                deleted=len(result.deleted),
+                before=result.archives_before,
+                reclaimed=result.reclaimed_bytes / 2**20,
+                list_after=result.list_after,
+                list_before=result.list_before,
+                after=result.archives_after,
+            )
+        )
+
+
+def get_retention_policy(config, repo, logger):
+    """Get the retention policy for a repo from the config.
+
+    :returns: A RetentionPolicy, or None if no keep_* settings are
+              configured.
+    """
+    policy = {
+        option: config[option] for option in RETENTION_OPTIONS
+        if config.get(option)
+    }
+    if not policy:
+        return None
+    if 'keep_within' in policy:
+        policy['keep_within'] = convert_duration_input(policy['keep_within'])
+    return RetentionPolicy(
+        repo=repo,
+        logger=logger,
+        policy=policy,
+        source_setting_names=[
+            setting['name']
+            for setting in config.get('source_settings') or []
+        ],
+        state_file=get_state_file(config, 'retention'),
+    )
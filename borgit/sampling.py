@@ -0,0 +1,334 @@
+"""Verification of a sample of backed up files against their sources.
+
+check_files only covers the files it lists. Sample verification restores
+other files from the new archives and compares them with the files they
+were backed up from, within a budget of bytes and/or time per run. Files
+which have gone longest without being verified are chosen first (randomly
+among equals), and with a state_directory the time each file was verified
+is kept, so over successive runs every file gets verified.
+
+The archive listings are read once, keeping only the files chosen so far
+(as in reservoir sampling), so memory doesn't grow with the size of the
+archives.
+
+Files which changed after they were backed up can't be compared, and are
+left for a later run.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+import hashlib
+import heapq
+import itertools
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from borgit.data import convert_duration_input, convert_size_input
+from borgit.sources import get_source_paths
+from borgit.state import get_state_file
+
+# Limits on the files restored by one borg extract, which bound the
+# scratch space needed and how far a time budget can be overrun.
+BATCH_BYTES = 256 * 2**20
+BATCH_FILES = 1000
+# Most files chosen by one run without a byte budget, which bounds the
+# memory used. A time budget is rarely enough to verify more.
+SAMPLE_FILES = 100000
+
+# Outcome of sample verification of a backup.
+# verified: Files restored and found to match their sources.
+# verified_bytes: The total size of those files.
+# changed: Files which changed after being backed up, so weren't compared.
+# mismatched: Paths of files which didn't match their unchanged sources.
+# covered: Files in the archives which have been verified by any run.
+# total: Files in the archives.
+SampleResult = namedtuple(
+    'SampleResult',
+    ['verified', 'verified_bytes', 'changed', 'mismatched', 'covered',
+     'total'],
+)
+
+
+def _file_hash(path):
+    """Get the sha256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as content:
+        for block in iter(lambda: content.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _unchanged(record, path):
+    """Determine whether a source file is as it was when backed up."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    mtime = datetime.fromtimestamp(stat.st_mtime)
+    return (
+        stat.st_size == record.size
+        # borg reports times to the microsecond.
+        and abs((mtime - record.mtime).total_seconds()) < 0.001
+    )
+
+
+class SampleVerifier:
+    """Restore a sample of backed up files and compare them with their
+    sources."""
+    def __init__(self, repo, logger, state_file=None, byte_budget=None,
+                 time_budget=None, seed=None, scratch=None, sources=None):
+        """Initialise the verifier for one repo.
+
+        :param repo: The BorgRepo holding the archives.
+        :param logger: A logger to report the results to.
+        :param state_file: Optional StateFile to record when each file was
+                           last verified in.
+        :param byte_budget: Restore at most this many bytes per run.
+        :param time_budget: Stop restoring files after this many seconds.
+        :param seed: Optional seed for choosing between files, for tests.
+        :param scratch: Optional ScratchSpace to restore files into. By
+                        default they are restored in the repo's working
+                        directory.
+        :param sources: The backup_source_paths the archives were made
+                        from. borg keeps relative sources relative to the
+                        directory it ran in, the repo's working directory,
+                        so their files are found there.
+        """
+        self.repo = repo
+        self.logger = logger
+        self.state_file = state_file
+        self.byte_budget = byte_budget
+        self.time_budget = time_budget
+        self._random = random.Random(seed)
+        self.scratch = scratch
+        self._relative_sources = [
+            os.path.normpath(source) for source in sources or []
+            if not os.path.isabs(source)
+        ]
+
+    def _source_path(self, record):
+        """Get the path of the file a record was backed up from."""
+        for source in self._relative_sources:
+            if record.path == source or record.path.startswith(source + '/'):
+                return os.path.join(self.repo.working_directory, record.path)
+        # borg drops the leading / of absolute paths.
+        return '/' + record.path
+
+    def _verified_times(self):
+        """Get when each file in this repo was last verified."""
+        if self.state_file is None:
+            return {}
+        return self.state_file.read().get(self.repo.repo, {})
+
+    def select(self, candidates, verified_times):
+        """Choose which files to verify, only holding the files chosen so
+        far rather than every candidate.
+
+        :param candidates: An iterable of (archive name, FileRecord) tuples.
+        :param verified_times: When each path was last verified.
+
+        :returns: The chosen candidates, the most overdue first. They are
+                  the most overdue files which fit in the byte budget
+                  together, with files bigger than the whole budget passed
+                  over. Without a byte budget, up to SAMPLE_FILES are
+                  chosen.
+        """
+        # The most overdue files are kept, with a random tie break so
+        # files verified equally long ago (e.g. never) are chosen between
+        # evenly. The heap's first entry is the least overdue kept, ready
+        # to be dropped when a more overdue file needs the room.
+        kept = []
+        kept_bytes = 0
+        order = itertools.count()
+        for archive, record in candidates:
+            if (self.byte_budget is not None
+                    and record.size > self.byte_budget):
+                continue
+            key = (verified_times.get(record.path, 0), self._random.random())
+            heapq.heappush(
+                kept, (-key[0], -key[1], next(order), archive, record),
+            )
+            kept_bytes += record.size
+            while (len(kept) > SAMPLE_FILES
+                   or (self.byte_budget is not None
+                       and kept_bytes > self.byte_budget)):
+                kept_bytes -= heapq.heappop(kept)[4].size
+        kept.sort(reverse=True)
+        return [(archive, record) for _, _, _, archive, record in kept]
+
+    def _batches(self, chosen):
+        """Split the chosen files into batches for restoring, each from a
+        single archive."""
+        batch_limit = BATCH_BYTES
+        if self.scratch is not None and self.scratch.budget:
+            batch_limit = min(batch_limit, self.scratch.budget)
+        by_archive = {}
+        for archive, record in chosen:
+            by_archive.setdefault(archive, []).append(record)
+        for archive, records in by_archive.items():
+            batch = []
+            batch_bytes = 0
+            for record in records:
+                if batch and (len(batch) >= BATCH_FILES
+                              or batch_bytes + record.size > batch_limit):
+                    yield archive, batch
+                    batch = []
+                    batch_bytes = 0
+                batch.append(record)
+                batch_bytes += record.size
+            if batch:
+                yield archive, batch
+
+    @contextmanager
+    def _restore_directory(self, size):
+        """Get a directory to restore a batch of files into."""
+        if self.scratch is not None:
+            with self.scratch.restore_directory(size) as extract_dir:
+                yield extract_dir
+            return
+        extract_dir = tempfile.mkdtemp(
+            prefix='sample-',
+            dir=self.repo.working_directory,
+        )
+        try:
+            yield extract_dir
+        finally:
+            shutil.rmtree(extract_dir)
+
+    def _compare(self, records, extract_dir):
+        """Compare restored files with their sources.
+
+        :returns: Lists of the verified, changed and mismatched records.
+        """
+        verified = []
+        changed = []
+        mismatched = []
+        for record in records:
+            source = self._source_path(record)
+            if not _unchanged(record, source):
+                changed.append(record)
+                continue
+            restored_hash = _file_hash(
+                os.path.join(extract_dir, record.path),
+            )
+            try:
+                source_hash = _file_hash(source)
+            except OSError:
+                changed.append(record)
+                continue
+            if not _unchanged(record, source):
+                # Modified while it was being read.
+                changed.append(record)
+            elif restored_hash == source_hash:
+                verified.append(record)
+            else:
+                mismatched.append(record)
+        return verified, changed, mismatched
+
+    def verify(self, archive_names):
+        """Verify a sample of the files in archives.
+
+        :param archive_names: The archives of the backup.
+
+        :returns: A SampleResult.
+        """
+        start = time.monotonic()
+        verified_times = self._verified_times()
+        # Only the times of files still in the archives are kept, so files
+        # no longer backed up are forgotten.
+        kept_times = {}
+        total = 0
+
+        def candidates():
+            nonlocal total
+            for archive in archive_names:
+                for record in self.repo.iter_files_in_archive(archive):
+                    if record.type != '-':
+                        continue
+                    total += 1
+                    if record.path in verified_times:
+                        kept_times[record.path] = verified_times[record.path]
+                    yield archive, record
+
+        chosen = self.select(candidates(), verified_times)
+
+        verified = []
+        changed = []
+        mismatched = []
+        for archive, batch in self._batches(chosen):
+            if (self.time_budget is not None
+                    and time.monotonic() - start >= self.time_budget):
+                break
+            with self._restore_directory(
+                    sum(record.size for record in batch)) as extract_dir:
+                self.repo.restore_files_from_archive(
+                    archive,
+                    [record.path for record in batch],
+                    destination=extract_dir,
+                )
+                batch_results = self._compare(batch, extract_dir)
+            verified.extend(batch_results[0])
+            changed.extend(batch_results[1])
+            mismatched.extend(batch_results[2])
+
+        now = time.time()
+        kept_times.update({record.path: now for record in verified})
+        if self.state_file is not None:
+            with self.state_file.update() as state:
+                state[self.repo.repo] = kept_times
+
+        result = SampleResult(
+            verified=len(verified),
+            verified_bytes=sum(record.size for record in verified),
+            changed=len(changed),
+            mismatched=[self._source_path(record) for record in mismatched],
+            covered=len(kept_times),
+            total=total,
+        )
+        self._report(result, time.monotonic() - start)
+        return result
+
+    def _report(self, result, duration):
+        """Log the outcome of sample verification."""
+        for path in result.mismatched:
+            self.logger.error(
+                'Sample verification: restored {path} does not match the '
+                'unchanged source file.'.format(path=path)
+            )
+        self.logger.info(
+            'Sample verification compared {verified} files ({size:.1f} '
+            'MiB) with their sources in {duration:.1f}s. {changed} had '
+            'changed since the backup. {covered} of {total} backed up '
+            'files have been verified.'.format(
+                verified=result.verified,
+                size=result.verified_bytes / 2**20,
+                duration=duration,
+                changed=result.changed,
+                covered=result.covered,
+                total=result.total,
+            )
+        )
+
+
+def get_sample_verifier(config, repo, logger, scratch=None):
+    """Get the sample verifier for a repo from the config.
+
+    :returns: A SampleVerifier, or None if sample verification is not
+              configured.
+    """
+    byte_budget = config.get('sample_verify_size')
+    time_budget = config.get('sample_verify_duration')
+    if not byte_budget and not time_budget:
+        return None
+    return SampleVerifier(
+        repo=repo,
+        logger=logger,
+        state_file=get_state_file(config, 'sample_verification'),
+        byte_budget=byte_budget and convert_size_input(byte_budget),
+        time_budget=time_budget and convert_duration_input(time_budget),
+        scratch=scratch,
+        sources=get_source_paths(config),
+    )
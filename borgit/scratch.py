@@ -0,0 +1,225 @@
+"""Management of the scratch space files are restored into for checking.
+
+Each run keeps its scratch directories in a directory of its own under
+working_directory, marked with the process ID of the run. Everything is
+removed when the run ends, and directories left by runs which crashed are
+removed when the next run starts.
+
+Restores are sized from the archive listing before they start. If
+scratch_space_budget is set, restores wait until they fit within it, so
+concurrent checks can't fill the disk. Small restores go to
+scratch_ram_directory (e.g. a tmpfs such as /dev/shm) if one is configured.
+"""
+import atexit
+from contextlib import contextmanager
+import glob
+import os
+import shutil
+import tempfile
+import threading
+
+from borgit.data import convert_size_input
+from borgit.exceptions import ScratchSpaceError
+
+RUN_DIRECTORY_PREFIX = 'borgit-scratch-'
+PID_FILE = 'borgit.pid'
+DEFAULT_RAM_LIMIT = '64MiB'
+
+
+def _process_running(pid):
+    """Determine whether a process is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It exists, but belongs to someone else.
+        return True
+    return True
+
+
+def sweep_leftovers(directory, logger=None):
+    """Remove scratch directories left by runs which are no longer running.
+
+    :returns: The paths removed.
+    """
+    removed = []
+    pattern = os.path.join(directory, RUN_DIRECTORY_PREFIX + '*')
+    for run_directory in glob.glob(pattern):
+        try:
+            with open(os.path.join(run_directory, PID_FILE)) as pid_file:
+                pid = int(pid_file.read().strip())
+        except (OSError, ValueError):
+            # Not yet marked by a starting run, or not ours.
+            continue
+        if _process_running(pid):
+            continue
+        shutil.rmtree(run_directory, ignore_errors=True)
+        removed.append(run_directory)
+        if logger:
+            logger.warning(
+                'Removed scratch space left by a previous run: '
+                '{path}'.format(path=run_directory)
+            )
+    return removed
+
+
+class ScratchSpace:
+    """Scratch directories for one run, within a budget.
+    Safe to use from several threads, and as a context manager which
+    cleans up on exit."""
+    def __init__(self, directory, budget=None, ram_directory=None,
+                 ram_limit=None, logger=None):
+        """Initialise the scratch space.
+        Leftovers from crashed runs are removed from the directories.
+
+        :param directory: The directory to create scratch directories in.
+        :param budget: Most bytes to restore to directory at once, if
+                       limited.
+        :param ram_directory: Optional RAM backed directory for restores of
+                              up to ram_limit bytes.
+        :param ram_limit: Most bytes to restore to ram_directory at once.
+        :param logger: Optional logger to report swept leftovers to.
+        """
+        self.directory = directory
+        self.budget = budget
+        self.ram_directory = ram_directory
+        self.ram_limit = ram_limit or 0
+        self.logger = logger
+        self._run_directories = {}
+        self._in_use = {directory: 0, ram_directory: 0}
+        self._condition = threading.Condition()
+        for root in (directory, ram_directory):
+            if root:
+                sweep_leftovers(root, logger)
+        # In case the owner exits without cleaning up. Unregistered by
+        # cleanup, so long running processes don't collect these.
+        atexit.register(self.cleanup)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+    def _run_directory(self, root):
+        """Get this run's directory under root, creating it if needed."""
+        with self._condition:
+            if root not in self._run_directories:
+                run_directory = tempfile.mkdtemp(
+                    prefix=RUN_DIRECTORY_PREFIX, dir=root,
+                )
+                with open(os.path.join(run_directory, PID_FILE),
+                          'w') as pid_file:
+                    pid_file.write(str(os.getpid()))
+                self._run_directories[root] = run_directory
+            return self._run_directories[root]
+
+    def directory_for(self, prefix):
+        """Create a scratch directory which lasts for the whole run, e.g. as
+        a repo's working directory."""
+        return tempfile.mkdtemp(
+            prefix=prefix, dir=self._run_directory(self.directory),
+        )
+
+    def _reserve(self, size):
+        """Reserve space for a restore, waiting for it to fit the budget.
+
+        :returns: The root directory the space is reserved in.
+        """
+        with self._condition:
+            if (self.ram_directory
+                    and self._in_use[self.ram_directory] + size
+                    <= self.ram_limit):
+                root = self.ram_directory
+            else:
+                root = self.directory
+                # Restores bigger than the whole budget run on their own.
+                self._condition.wait_for(
+                    lambda: self.budget is None
+                    or self._in_use[root] == 0
+                    or self._in_use[root] + size <= self.budget
+                )
+            self._in_use[root] += size
+            return root
+
+    def _release(self, root, size):
+        """Release reserved space."""
+        with self._condition:
+            self._in_use[root] -= size
+            self._condition.notify_all()
+
+    @contextmanager
+    def restore_directory(self, size):
+        """Get a directory to restore size bytes into, removed afterwards.
+        Waits until the restore fits in the budget.
+
+        :raises ScratchSpaceError: If the filesystem doesn't have the space.
+        """
+        root = self._reserve(size)
+        try:
+            free = shutil.disk_usage(root).free
+            if size > free:
+                raise ScratchSpaceError(
+                    'Restoring {size} bytes needs more than the {free} '
+                    'bytes free in {root}.'.format(
+                        size=size, free=free, root=root,
+                    )
+                )
+            path = tempfile.mkdtemp(
+                prefix='extract-', dir=self._run_directory(root),
+            )
+            try:
+                yield path
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+        finally:
+            self._release(root, size)
+
+    def cleanup(self):
+        """Remove all of this run's scratch directories."""
+        atexit.unregister(self.cleanup)
+        with self._condition:
+            run_directories = list(self._run_directories.values())
+            self._run_directories = {}
+        for run_directory in run_directories:
+            shutil.rmtree(run_directory, ignore_errors=True)
+
+
+def plan_restores(sizes, budget):
+    """Group restores into batches which each fit in a budget.
+    Batches are filled in order, and a restore bigger than the budget gets
+    a batch to itself.
+
+    :param sizes: A list of (item, size) tuples.
+    :param budget: The most bytes for a batch, or None for no limit.
+
+    :returns: A list of (items, total size) tuples.
+    """
+    batches = []
+    items = []
+    total = 0
+    for item, size in sizes:
+        if items and budget is not None and total + size > budget:
+            batches.append((items, total))
+            items = []
+            total = 0
+        items.append(item)
+        total += size
+    if items:
+        batches.append((items, total))
+    return batches
+
+
+def get_scratch_space(config, logger=None):
+    """Get the scratch space for a run from the config."""
+    budget = config.get('scratch_space_budget')
+    return ScratchSpace(
+        directory=config.get('working_directory') or tempfile.gettempdir(),
+        budget=budget and convert_size_input(budget),
+        ram_directory=config.get('scratch_ram_directory'),
+        ram_limit=convert_size_input(
+            config.get('scratch_ram_limit') or DEFAULT_RAM_LIMIT,
+        ),
+        logger=logger,
+    )
@@ -0,0 +1,468 @@
+"""Splitting of backups across several borg repositories.
+
+borg create is largely single threaded, and a repository only allows one
+writer at a time, so a large backup can't use more than about one core.
+With shard_count set, each destination is made up of that many repositories
+(shards), each holding some of the backup_source_paths, and backups to the
+shards are run in parallel. ShardedBorgRepo presents the shards as one
+repository, so the rest of borgit needn't know about them.
+
+Sources are assigned to shards by shard_assignments, or otherwise by
+balancing their sizes. With a state_directory, assignments are kept so that
+sources stay in the shard that already holds their deduplicated data.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+import itertools
+import os
+
+from borgit.repo import ArchiveRecord
+from borgit.state import get_state_file
+
+
+def shard_location(repo, index):
+    """Get the location of a shard of a repository.
+    The first shard is the repository itself, so that turning sharding on
+    keeps using the existing repository."""
+    if index == 0:
+        return repo
+    return '{repo}-shard{number}'.format(
+        repo=repo.rstrip('/'),
+        number=index + 1,
+    )
+
+
+def _source_size(path):
+    """Get the total size of the files in a source."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
+    total = 0
+    for directory, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.lstat(os.path.join(directory, name)).st_size
+            except OSError:
+                # Files may vanish while the source is measured.
+                pass
+    return total
+
+
+class ShardAssigner:
+    """Decide which shard each backup source belongs in."""
+    def __init__(self, shard_count, explicit=None, state_file=None):
+        """Initialise the assigner.
+
+        :param shard_count: The number of shards.
+        :param explicit: shard_assignments config entries, each with paths
+                         (glob patterns) and shard (numbered from 1).
+        :param state_file: Optional StateFile to keep assignments in.
+
+        :raises ValueError: If an explicit assignment is to a shard which
+                            doesn't exist.
+        """
+        self.shard_count = shard_count
+        self.explicit = explicit or []
+        self.state_file = state_file
+        for assignment in self.explicit:
+            if not 1 <= assignment['shard'] <= shard_count:
+                raise ValueError(
+                    'shard_assignments refers to shard {shard}, but there '
+                    'are only {count} shards.'.format(
+                        shard=assignment['shard'],
+                        count=shard_count,
+                    )
+                )
+
+    def _explicit_shard(self, source):
+        """Get the configured shard index of a source, if it has one."""
+        for assignment in self.explicit:
+            if any(fnmatch(source.rstrip('/'), pattern.rstrip('/'))
+                   for pattern in assignment['paths']):
+                return assignment['shard'] - 1
+        return None
+
+    def assign(self, sources):
+        """Assign sources to shards.
+        Sources without an explicit or previous assignment are placed,
+        largest first, in whichever shard holds the least data.
+
+        :returns: A dict of shard index keyed on source.
+        """
+        known = {}
+        if self.state_file is not None:
+            known = self.state_file.read().get('sources', {})
+        known = {
+            source: entry for source, entry in known.items()
+            if entry['shard'] < self.shard_count
+        }
+
+        assignments = {}
+        loads = [0] * self.shard_count
+        unassigned = []
+        for source in sources:
+            shard = self._explicit_shard(source)
+            if shard is None and source in known:
+                shard = known[source]['shard']
+            if shard is None:
+                unassigned.append(source)
+                continue
+            assignments[source] = shard
+            size = known.get(source, {}).get('size')
+            if size is None:
+                size = _source_size(source)
+            known[source] = {'shard': shard, 'size': size}
+            loads[shard] += size
+
+        sizes = {source: _source_size(source) for source in unassigned}
+        for source in sorted(unassigned, key=lambda src: -sizes[src]):
+            shard = loads.index(min(loads))
+            assignments[source] = shard
+            known[source] = {'shard': shard, 'size': sizes[source]}
+            loads[shard] += sizes[source]
+
+        if self.state_file is not None and unassigned:
+            with self.state_file.update() as state:
+                state.setdefault('sources', {}).update({
+                    source: known[source] for source in unassigned
+                })
+        return assignments
+
+
+class ShardedBorgRepo:
+    """A set of borg repositories used as one.
+    This provides the same methods as BorgRepo. Archives are created in each
+    shard with sources assigned to it, and operations on paths are sent to
+    the shard holding them."""
+    def __init__(self, shards, assigner, assignments):
+        """Initialise the sharded repository.
+
+        :param shards: A BorgRepo for each shard, the first being the
+                       repository the shards are named after.
+        :param assigner: The ShardAssigner placing sources in shards.
+        :param assignments: The shard index of each configured source, as
+                            returned by the assigner.
+        """
+        self.shards = shards
+        self.assigner = assigner
+        self.assignments = dict(assignments)
+        # The indexes of the shards holding each archive. With
+        # source_settings, a run's archives each hold different sources, so
+        # may be in different shards.
+        self._archive_shards = {}
+
+    @property
+    def repo(self):
+        """The location the shards are named after."""
+        return self.shards[0].repo
+
+    @property
+    def repo_key(self):
+        """The passphrase for the borg repositories."""
+        return self.shards[0].repo_key
+
+    @property
+    def working_directory(self):
+        """The directory borg commands are run in."""
+        return self.shards[0].working_directory
+
+    @property
+    def metrics(self):
+        """The RunMetrics borg command timings are recorded in, if any."""
+        return self.shards[0].metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        """Set where borg command timings are recorded."""
+        for shard in self.shards:
+            shard.metrics = metrics
+
+    @property
+    def rsh(self):
+        """The command borg uses to connect to the repositories, if not
+        borg's default."""
+        return self.shards[0].rsh
+
+    @rsh.setter
+    def rsh(self, rsh):
+        """Set the command borg uses to connect to the repositories.
+        All shards of a destination are on the same host, so can share a
+        connection."""
+        for shard in self.shards:
+            shard.rsh = rsh
+
+    @property
+    def cancel_event(self):
+        """The threading.Event which stops running borg commands when set,
+        if any."""
+        return self.shards[0].cancel_event
+
+    @cancel_event.setter
+    def cancel_event(self, cancel_event):
+        """Set the event which stops running borg commands."""
+        for shard in self.shards:
+            shard.cancel_event = cancel_event
+
+    def _map(self, function, items):
+        """Call function on each item in parallel, returning the results in
+        order."""
+        items = list(items)
+        if not items:
+            return []
+        with ThreadPoolExecutor(max_workers=len(items)) as executor:
+            return list(executor.map(function, items))
+
+    def _shard_for_path(self, path):
+        """Get the index of the shard holding a path."""
+        path = '/' + path.lstrip('/')
+        for source, shard in self.assignments.items():
+            source = os.path.abspath(source)
+            if path == source or path.startswith(source.rstrip('/') + '/'):
+                return shard
+        return 0
+
+    def _split_paths(self, paths):
+        """Group paths by the index of the shard holding them."""
+        grouped = {}
+        for path in paths:
+            grouped.setdefault(self._shard_for_path(path), []).append(path)
+        return grouped
+
+    def _archive_indexes(self, archive_name):
+        """Get the indexes of the shards holding an archive.
+        Archives not created or copied by this object are looked for in
+        every shard."""
+        if archive_name not in self._archive_shards:
+            holding = self._map(
+                lambda shard: any(
+                    archive.name == archive_name
+                    for archive in shard.iter_archives()
+                ),
+                self.shards,
+            )
+            self._archive_shards[archive_name] = [
+                index for index, held in enumerate(holding) if held
+            ]
+        return self._archive_shards[archive_name]
+
+    def _archive_shards_for(self, archive_name):
+        """Get the shards holding an archive."""
+        return [
+            self.shards[index]
+            for index in self._archive_indexes(archive_name)
+        ]
+
+    def init(self):
+        """Initialise all the borg repositories."""
+        self._map(lambda shard: shard.init(), self.shards)
+
+    def backup(self, archive_name, sources, compression='lz4',
+               chunker_params=None, resume=False):
+        """Back up sources to their shards, in parallel.
+        Returns the combined statistics of each shard's archive. When
+        resuming, shards which already completed the archive are skipped."""
+        if isinstance(sources, str):
+            sources = [sources]
+        new_sources = [
+            source for source in sources if source not in self.assignments
+        ]
+        if new_sources:
+            self.assignments.update(self.assigner.assign(new_sources))
+        grouped = {}
+        for source in sources:
+            grouped.setdefault(self.assignments[source], []).append(source)
+        self._archive_shards[archive_name] = sorted(grouped)
+
+        return _combine_shard_stats(self._map(
+            lambda item: self.shards[item[0]].backup(
+                archive_name, item[1], compression, chunker_params, resume,
+            ),
+            sorted(grouped.items()),
+        ))
+
+    def import_archive(self, source, archive_name, compression='lz4',
+                       chunker_params=None, resume=False):
+        """Copy an archive from another sharded repository into this one,
+        shard by shard in parallel. Both must have the same shards."""
+        indexes = source._archive_indexes(archive_name)
+        self._archive_shards[archive_name] = list(indexes)
+        return _combine_shard_stats(self._map(
+            lambda index: self.shards[index].import_archive(
+                source.shards[index], archive_name, compression,
+                chunker_params, resume,
+            ),
+            indexes,
+        ))
+
+    def list_archives(self):
+        """Get a list of all archives in any shard."""
+        names = []
+        for shard_names in self._map(lambda shard: shard.list_archives(),
+                                     self.shards):
+            names.extend(name for name in shard_names if name not in names)
+        return names
+
+    def delete_archives(self, archive_names):
+        """Delete archives from every shard holding them."""
+        def delete(shard):
+            present = [
+                archive.name for archive in shard.iter_archives()
+                if archive.name in archive_names
+            ]
+            if present:
+                shard.delete_archives(present)
+        self._map(delete, self.shards)
+        for archive_name in archive_names:
+            self._archive_shards.pop(archive_name, None)
+
+    def iter_archives(self):
+        """Yield an ArchiveRecord for each archive in any shard.
+        Each archive is only yielded once, with the earliest start of its
+        parts."""
+        archives = {}
+        for shard_archives in self._map(
+                lambda shard: list(shard.iter_archives()), self.shards):
+            for archive in shard_archives:
+                existing = archives.get(archive.name)
+                if existing is None or archive.start < existing.start:
+                    archives[archive.name] = ArchiveRecord(
+                        name=archive.name,
+                        id=archive.id,
+                        start=archive.start,
+                    )
+        return iter(sorted(archives.values(),
+                           key=lambda archive: archive.start))
+
+    def latest_archive(self):
+        """Get the most recently started archive's ArchiveRecord.
+        Returns None if no shard has any archives."""
+        return max(self.iter_archives(),
+                   key=lambda archive: archive.start, default=None)
+
+    def list_files_in_archive(self, archive_name):
+        """Get a list of all files in an archive, across shards."""
+        return list(itertools.chain.from_iterable(self._map(
+            lambda shard: shard.list_files_in_archive(archive_name),
+            self._archive_shards_for(archive_name),
+        )))
+
+    def iter_files_in_archive(self, archive_name, paths=None,
+                              with_hash=False):
+        """Yield a FileRecord for each item in an archive, across shards.
+        Only the shards holding the archive and the paths are listed."""
+        indexes = self._archive_indexes(archive_name)
+        if paths:
+            targets = [
+                (self.shards[index], shard_paths)
+                for index, shard_paths in sorted(
+                    self._split_paths(paths).items())
+                if index in indexes
+            ]
+        else:
+            targets = [(self.shards[index], None) for index in indexes]
+        for shard, shard_paths in targets:
+            yield from shard.iter_files_in_archive(
+                archive_name, shard_paths, with_hash,
+            )
+
+    def get_fingerprints(self, archive_name, paths, known=None):
+        """Get fingerprints of the items at or under paths in an archive.
+        See AsyncBorgRepo.get_fingerprints."""
+        fingerprints = {}
+        for shard_fingerprints in self._map(
+                lambda item: self.shards[item[0]].get_fingerprints(
+                    archive_name, item[1], known,
+                ),
+                sorted(self._split_paths(paths).items())):
+            fingerprints.update(shard_fingerprints)
+        return fingerprints
+
+    def restore_file_from_archive(self, archive_name, path):
+        """Restore specific file or directory from an archive."""
+        self.restore_files_from_archive(archive_name, [path])
+
+    def restore_files_from_archive(self, archive_name, paths,
+                                   destination=None):
+        """Restore many files or directories from an archive, extracting
+        from each shard holding them in parallel."""
+        self._map(
+            lambda item: self.shards[item[0]].restore_files_from_archive(
+                archive_name, item[1], destination,
+            ),
+            sorted(self._split_paths(paths).items()),
+        )
+
+    def stream_file_from_archive(self, archive_name, path):
+        """Start streaming a file from an archive to a pipe.
+        See BorgRepo.stream_file_from_archive."""
+        return self.shards[self._shard_for_path(path)]\
+            .stream_file_from_archive(archive_name, path)
+
+    def check(self, repository_only=False, archives_only=False,
+              verify_data=False, last=None, max_duration=None):
+        """Verify the integrity of every shard, in parallel.
+        See AsyncBorgRepo.check."""
+        self._map(
+            lambda shard: shard.check(
+                repository_only, archives_only, verify_data, last,
+                max_duration,
+            ),
+            self.shards,
+        )
+
+    def check_archive(self, archive_name, archives_only=False):
+        """Verify the integrity of a specific archive in every shard holding
+        part of it."""
+        self._map(
+            lambda shard: shard.check_archive(archive_name, archives_only),
+            self._archive_shards_for(archive_name),
+        )
+
+    def prune(self, glob, policy):
+        """Prune the archives matching a glob in every shard."""
+        self._map(lambda shard: shard.prune(glob, policy), self.shards)
+        # Any archive may have gone, so they'll be found again if needed.
+        self._archive_shards.clear()
+
+    def compact(self):
+        """Free the space used by deleted archives in every shard."""
+        self._map(lambda shard: shard.compact(), self.shards)
+
+    def repository_stats(self):
+        """Get borg's statistics for all shards, added together."""
+        stats = {}
+        for shard_stats in self._map(
+                lambda shard: shard.repository_stats(), self.shards):
+            for key, value in shard_stats.items():
+                stats[key] = stats.get(key, 0) + value
+        return stats
+
+
+def _combine_shard_stats(results):
+    """Combine the statistics of archives created in parallel.
+    Shards which skipped creating their archive are ignored, and None is
+    returned if all of them did."""
+    results = [shard_stats for shard_stats in results
+               if shard_stats is not None]
+    if not results:
+        return None
+    stats = {}
+    for shard_stats in results:
+        for key, value in shard_stats.items():
+            if value is None:
+                continue
+            if key == 'duration':
+                stats[key] = max(stats.get(key, 0), value)
+            else:
+                stats[key] = stats.get(key, 0) + value
+    return stats
+
+
+def get_shard_assigner(config):
+    """Get the ShardAssigner for the configured shards.
+    Every destination must use the same assignments, so that archives can
+    be copied between them shard by shard."""
+    return ShardAssigner(
+        shard_count=config['shard_count'],
+        explicit=config.get('shard_assignments'),
+        state_file=get_state_file(config, 'shards'),
+    )
@@ -0,0 +1,79 @@
+"""Grouping of backup sources by the borg settings they are backed up with.
+
+borg applies one compression and chunker setting to a whole archive, so
+sources given their own settings in source_settings are backed up into an
+archive of their own. Sources without their own settings go in the archive
+named for the run.
+"""
+from collections import namedtuple
+from fnmatch import fnmatch
+import os
+
+
+# One borg create of a run.
+# archive_name: The name of the archive to create.
+# sources: The backup_source_paths to back up into it.
+# compression: The borg compression spec to use.
+# chunker_params: The borg chunker params to use, or None for borg's default.
+BackupPart = namedtuple(
+    'BackupPart',
+    ['archive_name', 'sources', 'compression', 'chunker_params'],
+)
+
+
+def get_source_paths(config):
+    """Get the configured backup_source_paths as a list."""
+    sources = config.get('backup_source_paths') or []
+    if isinstance(sources, str):
+        sources = [sources]
+    return list(sources)
+
+
+def plan_backup(config, archive_name):
+    """Work out which archives a run will create, and what goes in each.
+
+    :param config: A valid borg config dict.
+    :param archive_name: Name of the run's archive.
+
+    :returns: A list of BackupPart. The part for sources without their own
+              settings comes first, if there are any such sources.
+    """
+    compression = config.get('compression') or 'lz4'
+    chunker_params = config.get('chunker_params')
+    default_part = BackupPart(archive_name, [], compression, chunker_params)
+    parts = {}
+    for source in get_source_paths(config):
+        for setting in config.get('source_settings') or []:
+            if any(fnmatch(source.rstrip('/'), pattern.rstrip('/'))
+                   for pattern in setting['paths']):
+                part = parts.setdefault(setting['name'], BackupPart(
+                    archive_name='{archive}-{name}'.format(
+                        archive=archive_name,
+                        name=setting['name'],
+                    ),
+                    sources=[],
+                    compression=setting.get('compression') or compression,
+                    chunker_params=(setting.get('chunker_params')
+                                    or chunker_params),
+                ))
+                break
+        else:
+            part = default_part
+        part.sources.append(source)
+
+    plan = list(parts.values())
+    if default_part.sources or not plan:
+        plan.insert(0, default_part)
+    return plan
+
+
+def part_for_path(plan, path):
+    """Get the BackupPart a backed up path was stored in.
+    Paths outside all sources are looked for in the first part."""
+    path = os.path.abspath(path)
+    for part in plan:
+        for source in part.sources:
+            source = os.path.abspath(source)
+            if path == source or path.startswith(source.rstrip('/') + '/'):
+                return part
+    return plan[0]
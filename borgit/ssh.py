@@ -0,0 +1,211 @@
+"""Shared SSH connections for remote borg repositories.
+
+Each borg command on a remote repository would otherwise open its own SSH
+connection, repeating the key exchange and authentication every time. An
+SSHMaster holds one authenticated connection open for the run and borg is
+pointed at it through BORG_RSH.
+
+The master's setup time is recorded as an ssh-connect phase. Once it is up,
+opening a session over it (which each borg command does) is timed once as
+an ssh-reuse phase, so the saving can be seen per command. borg gives no
+way to time the sessions its own commands open.
+"""
+from contextlib import contextmanager
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+
+from borgit.data import REMOTE_BORG_REGEX
+
+# Seconds allowed for the master connection to be established.
+CONNECT_TIMEOUT = 60
+
+
+def get_ssh_destination(repo_location):
+    """Get the user@host to connect to for a remote borg repository.
+
+    :returns: The destination, or None if the repository is not remote.
+    """
+    match = REMOTE_BORG_REGEX.match(repo_location or '')
+    if not match:
+        return None
+    return '{username}_backups@{host}'.format(
+        username=match.group('username'),
+        # Bracketed IPv6 addresses are only needed in URLs.
+        host=match.group('fqdn_or_ip').strip('[]'),
+    )
+
+
+class SSHMaster:
+    """A multiplexed SSH connection to one destination."""
+    def __init__(self, destination):
+        """Initialise the master connection handler.
+        The connection is not made until start is called."""
+        self.destination = destination
+        self.control_directory = None
+        self.setup_time = None
+        self.reuse_time = None
+
+    @property
+    def control_path(self):
+        """The path of the master connection's control socket."""
+        return self.control_directory + '/master'
+
+    @property
+    def rsh(self):
+        """The ssh command borg should use to reuse this connection."""
+        return ' '.join([
+            'ssh',
+            '-o', 'ControlMaster=no',
+            '-o', 'ControlPath=' + shlex.quote(self.control_path),
+        ])
+
+    def start(self):
+        """Establish the master connection.
+
+        :raises CalledProcessError: If the connection could not be made.
+        :raises TimeoutExpired: If connecting took too long.
+        :raises OSError: If ssh could not be run.
+        """
+        # Control socket paths are limited in length, so this is kept short.
+        self.control_directory = tempfile.mkdtemp(prefix='borgit-ssh-')
+        start = time.monotonic()
+        try:
+            subprocess.run(
+                [
+                    'ssh', '-f', '-N',
+                    '-o', 'BatchMode=yes',
+                    '-o', 'ControlMaster=yes',
+                    '-o', 'ControlPersist=yes',
+                    '-o', 'ControlPath=' + self.control_path,
+                    self.destination,
+                ],
+                check=True,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                timeout=CONNECT_TIMEOUT,
+            )
+        except (OSError, subprocess.CalledProcessError,
+                subprocess.TimeoutExpired):
+            shutil.rmtree(self.control_directory)
+            self.control_directory = None
+            raise
+        self.setup_time = time.monotonic() - start
+
+    def time_reuse(self):
+        """Time opening a session over the master connection, as each borg
+        command does. The session runs true, or borg serve if the
+        destination forces it, which exits as it has no input.
+
+        :returns: The seconds taken, or None if the session failed.
+        """
+        start = time.monotonic()
+        try:
+            subprocess.run(
+                [
+                    'ssh',
+                    '-o', 'BatchMode=yes',
+                    '-o', 'ControlMaster=no',
+                    '-o', 'ControlPath=' + self.control_path,
+                    self.destination, 'true',
+                ],
+                check=True,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=CONNECT_TIMEOUT,
+            )
+        except (OSError, subprocess.CalledProcessError,
+                subprocess.TimeoutExpired):
+            return None
+        self.reuse_time = time.monotonic() - start
+        return self.reuse_time
+
+    def stop(self):
+        """Close the master connection."""
+        if self.control_directory is None:
+            return
+        subprocess.call(
+            [
+                'ssh',
+                '-o', 'ControlPath=' + self.control_path,
+                '-O', 'exit',
+                self.destination,
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        shutil.rmtree(self.control_directory, ignore_errors=True)
+        self.control_directory = None
+
+
+@contextmanager
+def multiplex_ssh(repos, logger, metrics=None):
+    """Share one SSH connection between all borg commands on each remote
+    repo while the context is active.
+    If a connection cannot be made in advance, borg is left to connect for
+    each command as usual.
+
+    :param repos: Dict of BorgRepo objects, keyed on name.
+    :param logger: A logger to report connection setup.
+    :param metrics: Optional RunMetrics to record connection setup, and
+                    the time to open a session over it, in.
+    """
+    masters = {}
+    try:
+        for repo_name, repo in repos.items():
+            destination = get_ssh_destination(repo.repo)
+            if not destination:
+                continue
+            master = SSHMaster(destination)
+            try:
+                if metrics:
+                    with metrics.phase(repo.repo, 'ssh-connect'):
+                        master.start()
+                else:
+                    master.start()
+            except (OSError, subprocess.CalledProcessError,
+                    subprocess.TimeoutExpired) as err:
+                logger.warning(
+                    'Could not open shared SSH connection for {repo}, each '
+                    'borg command will connect separately: {err}'.format(
+                        repo=repo_name, err=err,
+                    )
+                )
+                continue
+            masters[repo_name] = master
+            repo.rsh = master.rsh
+            if metrics:
+                with metrics.phase(repo.repo, 'ssh-reuse'):
+                    master.time_reuse()
+            else:
+                master.time_reuse()
+        yield masters
+    finally:
+        for repo_name, master in masters.items():
+            repos[repo_name].rsh = None
+            master.stop()
+            commands = 0
+            if metrics:
+                commands = sum(
+                    1 for command in metrics.report()['commands']
+                    if command['repo'] == repos[repo_name].repo
+                )
+            if master.reuse_time is None:
+                reuse = 'an unmeasured time'
+            else:
+                reuse = '{reuse:.2f}s'.format(reuse=master.reuse_time)
+            logger.info(
+                'SSH connection setup for {repo} took {setup:.2f}s once, '
+                'shared by {commands} borg commands. Connecting through it '
+                'took {reuse}.'.format(
+                    repo=repo_name,
+                    setup=master.setup_time,
+                    commands=commands,
+                    reuse=reuse,
+                )
+            )
@@ -0,0 +1,58 @@
+"""Persistence of borgit state between runs."""
+from contextlib import contextmanager
+import json
+import os
+import threading
+
+
+class StateFile:
+    """A JSON document stored on disk, safe to update from several threads.
+    Updates are written to a temporary file then moved into place, so a
+    crash mid-write will not lose the previous state."""
+    _locks = {}
+    _locks_lock = threading.Lock()
+
+    def __init__(self, path):
+        """Initialise the state file handler.
+        The file will be created on first update."""
+        self.path = path
+        with self._locks_lock:
+            self._lock = self._locks.setdefault(
+                os.path.abspath(path), threading.Lock(),
+            )
+
+    def _load(self):
+        """Load the current state, or an empty state if there is none."""
+        try:
+            with open(self.path) as state_handle:
+                return json.load(state_handle)
+        except FileNotFoundError:
+            return {}
+
+    def read(self):
+        """Get a copy of the current state."""
+        with self._lock:
+            return self._load()
+
+    @contextmanager
+    def update(self):
+        """Get the current state for modification.
+        The state is saved when the context exits without error."""
+        with self._lock:
+            state = self._load()
+            yield state
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as state_handle:
+                json.dump(state, state_handle, indent=2, sort_keys=True)
+            os.replace(temp_path, self.path)
+
+
+def get_state_file(config, name):
+    """Get a named state file in the configured state directory.
+
+    :returns: A StateFile, or None if no state_directory is configured.
+    """
+    state_directory = config.get('state_directory')
+    if not state_directory:
+        return None
+    return StateFile(os.path.join(state_directory, name + '.json'))
@@ -0,0 +1,365 @@
+"""Validation of file formats from the few bytes that identify them.
+
+Each validator declares the byte ranges of a file it needs: a range with a
+negative offset is counted from the end of the file. Only those ranges are
+read, so checking a multi-GB file costs a few reads. For a file streamed
+from an archive, borg can only provide the content from the start, so the
+stream is read up to the last range needed from the start of the file, and
+reading stops there (ending the extract early). Ranges at the end of a file
+mean reading through the stream, but only the last bytes are kept.
+"""
+from collections import namedtuple
+import os
+import struct
+
+# Size of the blocks a stream is read past ranges in.
+READ_BLOCK_SIZE = 1024 * 1024
+
+# offset: Position of the range. Negative offsets count from the end.
+# length: Number of bytes wanted. Fewer are provided if the file ends.
+ByteRange = namedtuple('ByteRange', ['offset', 'length'])
+
+# ranges: The ByteRanges the validator needs.
+# parse: Callable taking the bytes of each range (in order) and the file
+#        size (None if it is unknown), returning a dict of details about the
+#        file. It raises FormatError if the file is not valid.
+Validator = namedtuple('Validator', ['ranges', 'parse'])
+
+
+class FormatError(Exception):
+    """Raised when a file is not valid for the expected format."""
+
+
+def _read_exactly(stream, length):
+    """Read up to length bytes, stopping early only at the end of stream."""
+    chunks = []
+    remaining = length
+    while remaining > 0:
+        chunk = stream.read(min(remaining, READ_BLOCK_SIZE))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def _read_file_ranges(path, ranges):
+    """Read byte ranges from a file on disk."""
+    with open(path, 'rb') as target:
+        size = os.fstat(target.fileno()).st_size
+        chunks = []
+        for byte_range in ranges:
+            start = byte_range.offset
+            if start < 0:
+                start = max(0, size + start)
+            target.seek(start)
+            chunks.append(target.read(byte_range.length))
+    return chunks, size
+
+
+def _read_stream_ranges(stream, ranges):
+    """Read byte ranges from a stream, reading no further than needed."""
+    head_length = max(
+        [byte_range.offset + byte_range.length
+         for byte_range in ranges if byte_range.offset >= 0] or [0]
+    )
+    tail_length = max(
+        [-byte_range.offset for byte_range in ranges
+         if byte_range.offset < 0] or [0]
+    )
+    head = _read_exactly(stream, head_length)
+    size = None
+    tail = b''
+    if len(head) < head_length:
+        size = len(head)
+        tail = head
+    elif tail_length:
+        size = len(head)
+        tail = head[-tail_length:]
+        for block in iter(lambda: stream.read(READ_BLOCK_SIZE), b''):
+            size += len(block)
+            tail = (tail + block)[-tail_length:]
+
+    chunks = []
+    tail_start = (size or 0) - len(tail)
+    for byte_range in ranges:
+        if byte_range.offset >= 0:
+            chunks.append(
+                head[byte_range.offset:byte_range.offset + byte_range.length]
+            )
+        else:
+            start = max(0, size + byte_range.offset) - tail_start
+            chunks.append(tail[start:start + byte_range.length])
+    return chunks, size
+
+
+def read_ranges(source, ranges):
+    """Read byte ranges from a file.
+
+    :param source: A path, or a binary file object streaming the file.
+    :param ranges: A list of ByteRange.
+
+    :returns: A list of the bytes of each range, and the size of the file.
+              The size is None if a stream was not read to its end.
+    """
+    if isinstance(source, str):
+        return _read_file_ranges(source, ranges)
+    return _read_stream_ranges(source, ranges)
+
+
+def _require(condition, message):
+    """Raise a FormatError unless a condition holds."""
+    if not condition:
+        raise FormatError(message)
+
+
+KEEPASS_SIGNATURE = bytes((0x03, 0xd9, 0xa2, 0x9a))
+KDB_HEADER_SIZE = 124
+# The KDB header fields read, which end with the entry count.
+KDB_FIELDS_SIZE = 56
+KDB_VERSION_SIGNATURE = bytes((0xfb, 0x4b, 0xb5))
+KDB_VERSIONS = {
+    0x65: '1',
+    0x66: '2-alpha',
+}
+KDBX_CIPHERS = {
+    '31c1f2e6bf714350be5805216afc5aff': 'AES-256',
+    'd6038a2b8b6f4cb5a524339a31dbb59a': 'ChaCha20',
+    'ad68f29f576f4bb9a36ad47af965346c': 'Twofish',
+}
+# KeePass 2 headers are a few hundred bytes, this is a generous limit.
+KDBX_HEADER_LIMIT = 64 * 1024
+
+
+def parse_kdb_header(header):
+    """Get the details of a KeePass 1.x database from its header.
+    Only the first KDB_FIELDS_SIZE bytes are needed.
+
+    :raises FormatError: If the header is not a KDB header.
+
+    :returns: A dict of the version, and the counts of groups and entries.
+    """
+    _require(len(header) >= KDB_FIELDS_SIZE,
+             'File is too short for a KDB header.')
+    _require(header[0:4] == KEEPASS_SIGNATURE,
+             'File does not have the KeePass signature.')
+    version = KDB_VERSIONS.get(header[4])
+    _require(header[5:8] == KDB_VERSION_SIGNATURE and version,
+             'Unknown or corrupt KDB version.')
+    return {
+        'version': version,
+        'groups': int.from_bytes(header[48:52], 'little'),
+        'entries': int.from_bytes(header[52:56], 'little'),
+    }
+
+
+def _parse_kdb(chunks, size):
+    """Validate a KeePass 1.x database header."""
+    _require(len(chunks[0]) == KDB_HEADER_SIZE,
+             'File is too short for a KDB header.')
+    return parse_kdb_header(chunks[0])
+
+
+def _parse_kdbx(chunks, size):
+    """Validate a KeePass 2.x (KDBX 3.1 or 4) database header."""
+    header = chunks[0]
+    _require(len(header) >= 12, 'File is too short for a KDBX header.')
+    _require(header[0:4] == KEEPASS_SIGNATURE,
+             'File does not have the KeePass signature.')
+    _require(header[4:8] == bytes((0x67, 0xfb, 0x4b, 0xb5)),
+             'File is not a KDBX database.')
+    minor, major = struct.unpack('<HH', header[8:12])
+    _require(major in (2, 3, 4),
+             'Unsupported KDBX version {major}.'.format(major=major))
+    # Before version 4, field lengths are 2 bytes rather than 4.
+    length_format = '<I' if major >= 4 else '<H'
+    length_size = struct.calcsize(length_format)
+
+    fields = {}
+    position = 12
+    while True:
+        _require(position + 1 + length_size <= len(header),
+                 'KDBX header is truncated or too long.')
+        field_id = header[position]
+        length = struct.unpack_from(
+            length_format, header, position + 1,
+        )[0]
+        position += 1 + length_size
+        fields[field_id] = header[position:position + length]
+        position += length
+        if field_id == 0:
+            break
+    _require(position <= len(header), 'KDBX header is truncated.')
+    # 2 is the cipher, 4 the master seed.
+    _require(2 in fields and 4 in fields,
+             'KDBX header is missing required fields.')
+    return {
+        'version': '{major}.{minor}'.format(major=major, minor=minor),
+        'cipher': KDBX_CIPHERS.get(fields[2].hex(), 'unknown'),
+        'header_size': position,
+    }
+
+
+def _parse_sqlite(chunks, size):
+    """Validate an SQLite database header, and its page count if the
+    file size is known."""
+    header = chunks[0]
+    _require(len(header) == 100 and header[0:16] == b'SQLite format 3\x00',
+             'File does not have the SQLite header.')
+    page_size = struct.unpack('>H', header[16:18])[0]
+    if page_size == 1:
+        page_size = 65536
+    _require(512 <= page_size <= 65536 and page_size & (page_size - 1) == 0,
+             'Invalid SQLite page size {size}.'.format(size=page_size))
+    details = {'page_size': page_size}
+    # The page count is only valid if written by a version of SQLite which
+    # maintained it, shown by the change counter matching.
+    page_count = struct.unpack('>I', header[28:32])[0]
+    if header[24:28] == header[92:96] and page_count:
+        details['page_count'] = page_count
+        if size is not None:
+            _require(
+                size == page_count * page_size,
+                'SQLite file is {size} bytes, but has {count} pages of '
+                '{page_size} bytes.'.format(
+                    size=size, count=page_count, page_size=page_size,
+                ),
+            )
+    elif size is not None:
+        _require(size % page_size == 0,
+                 'SQLite file size is not a multiple of its page size.')
+    return details
+
+
+ZIP_EOCD_SIGNATURE = b'PK\x05\x06'
+ZIP_EOCD_SIZE = 22
+
+
+def _parse_zip(chunks, size):
+    """Validate a ZIP file's end of central directory record."""
+    tail = chunks[0]
+    # The record ends with a comment of up to 64KiB, so search backwards for
+    # a signature whose comment length reaches the end of the file.
+    position = tail.rfind(ZIP_EOCD_SIGNATURE)
+    while position >= 0:
+        if position + ZIP_EOCD_SIZE <= len(tail):
+            comment_length = struct.unpack_from('<H', tail, position + 20)[0]
+            if position + ZIP_EOCD_SIZE + comment_length == len(tail):
+                break
+        position = tail.rfind(ZIP_EOCD_SIGNATURE, 0, position)
+    _require(position >= 0,
+             'No ZIP end of central directory record found.')
+    entries, directory_size, directory_offset = struct.unpack_from(
+        '<HII', tail, position + 10,
+    )
+    details = {'entries': entries}
+    if entries == 0xffff or directory_offset == 0xffffffff:
+        details['zip64'] = True
+        return details
+    if size is not None:
+        record_offset = size - len(tail) + position
+        _require(
+            directory_offset + directory_size == record_offset,
+            'ZIP central directory does not end where its end record '
+            'starts.',
+        )
+    return details
+
+
+def _tar_checksum_valid(block):
+    """Determine whether a tar header block's checksum is correct."""
+    try:
+        recorded = int(block[148:156].strip(b' \x00') or b'0', 8)
+    except ValueError:
+        return False
+    # The checksum is calculated with its own field as spaces.
+    unsigned = sum(block[:148]) + 8 * 32 + sum(block[156:512])
+    return recorded == unsigned
+
+
+def _parse_tar(chunks, size):
+    """Validate a tar file's first header and end of archive marker."""
+    header, trailer = chunks
+    _require(len(header) == 512 and _tar_checksum_valid(header),
+             'First tar header block is invalid.')
+    _require(trailer == bytes(1024),
+             'Tar file does not end with the end of archive marker.')
+    if size is not None:
+        _require(size % 512 == 0,
+                 'Tar file size is not a multiple of 512 bytes.')
+    details = {'format': 'ustar' if header[257:262] == b'ustar' else 'v7'}
+    return details
+
+
+def _parse_gzip(chunks, size):
+    """Validate a gzip file's header and trailer."""
+    header, trailer = chunks
+    _require(header[0:3] == b'\x1f\x8b\x08',
+             'File does not have the gzip header.')
+    _require(len(trailer) == 8, 'File is too short for a gzip trailer.')
+    if size is not None:
+        _require(size >= 18, 'File is too short to be gzipped.')
+    return {
+        # gzip only records the size modulo 4GiB.
+        'uncompressed_size_mod_4gib': struct.unpack('<I', trailer[4:8])[0],
+    }
+
+
+PGDUMP_FORMATS = {
+    1: 'custom',
+    3: 'tar',
+}
+
+
+def _parse_pgdump(chunks, size):
+    """Validate a pg_dump custom format archive header."""
+    header = chunks[0]
+    _require(len(header) >= 11 and header[0:5] == b'PGDMP',
+             'File does not have the pg_dump archive header.')
+    major, minor, revision, int_size, offset_size, dump_format = header[5:11]
+    _require(1 <= int_size <= 8 and 1 <= offset_size <= 8,
+             'Invalid pg_dump archive header.')
+    return {
+        'archive_version': '{}.{}.{}'.format(major, minor, revision),
+        'format': PGDUMP_FORMATS.get(dump_format, str(dump_format)),
+    }
+
+
+def _parse_pgdump_sql(chunks, size):
+    """Validate that a plain SQL pg_dump is complete."""
+    header, trailer = chunks
+    _require(b'-- PostgreSQL database dump' in header,
+             'File does not start like a PostgreSQL dump.')
+    _require(b'-- PostgreSQL database dump complete' in trailer,
+             'PostgreSQL dump is incomplete.')
+    return {}
+
+
+VALIDATORS = {
+    'kdb': Validator([ByteRange(0, KDB_HEADER_SIZE)], _parse_kdb),
+    'kdbx': Validator([ByteRange(0, KDBX_HEADER_LIMIT)], _parse_kdbx),
+    'sqlite': Validator([ByteRange(0, 100)], _parse_sqlite),
+    'zip': Validator([ByteRange(-(ZIP_EOCD_SIZE + 65535),
+                                ZIP_EOCD_SIZE + 65535)], _parse_zip),
+    'tar': Validator([ByteRange(0, 512), ByteRange(-1024, 1024)],
+                     _parse_tar),
+    'gzip': Validator([ByteRange(0, 10), ByteRange(-8, 8)], _parse_gzip),
+    'pgdump': Validator([ByteRange(0, 11)], _parse_pgdump),
+    'pgdump_sql': Validator([ByteRange(0, 256), ByteRange(-256, 256)],
+                            _parse_pgdump_sql),
+}
+
+
+def validate_format(source, format_name):
+    """Validate a file against a format, reading only what is needed.
+
+    :param source: A path, or a binary file object streaming the file.
+    :param format_name: One of the keys of VALIDATORS.
+
+    :raises FormatError: If the file is not valid.
+
+    :returns: A dict of details about the file.
+    """
+    validator = VALIDATORS[format_name]
+    chunks, size = read_ranges(source, validator.ranges)
+    return validator.parse(chunks, size)
@@ -0,0 +1,152 @@
+"""Scheduling of borg integrity checks for borgit.
+
+Without any state the whole repository is checked before and after every
+backup. With a state_directory configured, checks are tiered:
+  - Every run checks the repository's segments (partially, if
+    repository_check_duration is set, with borg continuing where the last
+    partial check stopped) and the latest archive before the backup, then
+    the new archive after it.
+  - If full_repository_check_interval is set, a complete repository check is
+    run whenever the last one is older than that, so every segment is still
+    verified over that window.
+  - If verify_data_interval is set, all archived data is read and verified
+    whenever that was last done longer ago than that.
+"""
+import subprocess
+import time
+
+from borgit.data import convert_duration_input
+from borgit.exceptions import RepositoryCorrupt
+from borgit.state import get_state_file
+
+
+class VerificationPolicy:
+    """Decide which borg checks to run on a repo, and run them."""
+    def __init__(self, repo, logger, state_file=None,
+                 repository_check_duration=None,
+                 full_repository_check_interval=None,
+                 verify_data_interval=None):
+        """Initialise the policy for one repo.
+        All durations and intervals are in seconds. If there is no state
+        file, every check is a full check."""
+        self.repo = repo
+        self.logger = logger
+        self.state_file = state_file
+        self.repository_check_duration = repository_check_duration
+        self.full_repository_check_interval = full_repository_check_interval
+        self.verify_data_interval = verify_data_interval
+
+    def _last_run(self, check_name):
+        """Get when a check was last completed on this repo, if ever."""
+        return self.state_file.read().get(self.repo.repo, {}).get(check_name)
+
+    def _is_due(self, check_name, interval):
+        """Determine whether a check scheduled every interval is due."""
+        if not interval:
+            return False
+        last_run = self._last_run(check_name)
+        return last_run is None or time.time() - last_run >= interval
+
+    def _record_run(self, check_name):
+        """Record that a check has just completed on this repo."""
+        with self.state_file.update() as state:
+            state.setdefault(self.repo.repo, {})[check_name] = time.time()
+
+    def _run(self, description, check, *args, **kwargs):
+        """Run a borg check, treating any failure as corruption."""
+        self.logger.info('Running {check}.'.format(check=description))
+        start = time.monotonic()
+        try:
+            check(*args, **kwargs)
+        except subprocess.CalledProcessError as err:
+            raise RepositoryCorrupt(
+                'Integrity check of {repo} failed: {err}'.format(
+                    repo=self.repo.repo,
+                    err=err,
+                )
+            )
+        self.logger.info('{check} passed in {duration:.1f}s.'.format(
+            check=description.capitalize(),
+            duration=time.monotonic() - start,
+        ))
+
+    def pre_backup(self):
+        """Check the repo and its latest archive before a backup.
+
+        :raises RepositoryCorrupt: If any check fails.
+        """
+        latest_archive = self.repo.latest_archive()
+        if self.state_file is None:
+            self._run('full repository check', self.repo.check)
+            if latest_archive:
+                self._run(
+                    'check of archive {name}'.format(
+                        name=latest_archive.name,
+                    ),
+                    self.repo.check_archive, latest_archive.name,
+                )
+            return
+
+        if (
+            self.repository_check_duration
+            and not self._is_due('full_repository_check',
+                                 self.full_repository_check_interval)
+        ):
+            self._run(
+                'partial repository check (up to {duration}s)'.format(
+                    duration=self.repository_check_duration,
+                ),
+                self.repo.check,
+                repository_only=True,
+                max_duration=self.repository_check_duration,
+            )
+        else:
+            self._run('repository check', self.repo.check,
+                      repository_only=True)
+            self._record_run('full_repository_check')
+
+        if latest_archive:
+            self._run('check of latest archive', self.repo.check,
+                      archives_only=True, last=1)
+
+    def post_backup(self, *archive_names):
+        """Check newly created archives, and verify data if due.
+
+        :raises RepositoryCorrupt: If any check fails.
+        """
+        if self.state_file is None:
+            self._run('full repository check', self.repo.check)
+            for archive_name in archive_names:
+                self._run(
+                    'check of archive {name}'.format(name=archive_name),
+                    self.repo.check_archive, archive_name,
+                )
+            return
+
+        for archive_name in archive_names:
+            self._run(
+                'check of archive {name}'.format(name=archive_name),
+                self.repo.check_archive, archive_name, archives_only=True,
+            )
+        if self._is_due('verify_data', self.verify_data_interval):
+            self._run('verification of all archived data', self.repo.check,
+                      archives_only=True, verify_data=True)
+            self._record_run('verify_data')
+
+
+def get_verification_policy(config, repo, logger):
+    """Get the verification policy for a repo from the config."""
+    def duration(key):
+        value = config.get(key)
+        return convert_duration_input(value) if value else None
+
+    return VerificationPolicy(
+        repo=repo,
+        logger=logger,
+        state_file=get_state_file(config, 'verification'),
+        repository_check_duration=duration('repository_check_duration'),
+        full_repository_check_interval=duration(
+            'full_repository_check_interval',
+        ),
+        verify_data_interval=duration('verify_data_interval'),
+    )
@@ -1,14 +1,23 @@
 """Base tests of local borg backups."""
+import hashlib
+import json
 import logging
 import os
 import shutil
+import subprocess
 from tempfile import mkdtemp
+import threading
+import time
 
 import pytest
 
-from borgit.command import perform_backup
-from borgit.exceptions import CheckFailure
+from borgit.checks import CheckResult
+from borgit.command import get_repos, perform_backup, run_backup
+from borgit.exceptions import CheckFailure, CommandTimeout, RunCancelled
+from borgit.journal import get_journal
+from borgit.metrics import RunMetrics
 from borgit.repo import BorgRepo
+from borgit.scratch import get_scratch_space
 
 
 class _TestLogger:
@@ -162,3 +171,599 @@ def test_local_no_checks():
     perform_backup(repo, archive_name, config, logger)
 
     shutil.rmtree(workdir)
+
+
+BASE_SOURCE = os.path.join(os.path.dirname(__file__), 'base')
+KDB_PATH = os.path.join(BASE_SOURCE, 'test.kdb')
+
+
+def _kdb_check(min_entries, **settings):
+    """Get a check_files entry requiring the test KDB to have at least
+    min_entries entries, with any other settings given."""
+    check = {
+        'path': KDB_PATH,
+        'command': 'check_keepass',
+        'arguments': ['--min-entries={}'.format(min_entries)],
+    }
+    check.update(settings)
+    return check
+
+
+def _local_config(workdir, **settings):
+    """Get a config backing up the base test files to a repo in workdir,
+    with any other settings given."""
+    config = {
+        'repo_passphrase': 'base_test',
+        'local_destination_path': os.path.join(workdir, 'repo'),
+        'remote_destination_path': None,
+        'backup_source_paths': BASE_SOURCE,
+        'working_directory': workdir,
+    }
+    config.update(settings)
+    return config
+
+
+def _init_repo(workdir, **settings):
+    """Make and initialise the BorgRepo of a _local_config, with any other
+    BorgRepo settings given."""
+    repo = BorgRepo(
+        repo=os.path.join(workdir, 'repo'),
+        repo_key='base_test',
+        working_directory=workdir,
+        **settings
+    )
+    repo.init()
+    return repo
+
+
+def _init_repos(workdir, names, uninitialised=()):
+    """Make a BorgRepo in workdir for each name, each with a working
+    directory of its own, and initialise those not in uninitialised.
+
+    :returns: A dict of the BorgRepos, keyed on name.
+    """
+    repos = {}
+    for repo_name in names:
+        repo_workdir = os.path.join(workdir, repo_name + '_work')
+        os.mkdir(repo_workdir)
+        repos[repo_name] = BorgRepo(
+            repo=os.path.join(workdir, repo_name),
+            repo_key='base_test',
+            working_directory=repo_workdir,
+        )
+        if repo_name not in uninitialised:
+            repos[repo_name].init()
+    return repos
+
+
+def test_concurrent_run():
+    """Run the local and remote pipelines concurrently against two repos."""
+    workdir = mkdtemp(prefix='borgit-test-concurrent-')
+    config = _local_config(workdir, check_files=[_kdb_check(2)])
+
+    repos = _init_repos(workdir, ['local', 'remote'])
+    logger = _TestLogger()
+    metrics = run_backup(repos, 'concurrent_test', config, logger,
+                         concurrent=True)
+    assert metrics.succeeded
+    assert set(metrics.backups) == {repo.repo for repo in repos.values()}
+
+    assert logger.has_log_entry(words=['[local]', 'finished'], level='info')
+    assert logger.has_log_entry(words=['[remote]', 'finished'], level='info')
+    assert logger.has_log_entry(words=['concurrent', 'saving'], level='info')
+
+    shutil.rmtree(workdir)
+
+
+def test_fan_out_to_remotes():
+    """Check a failing remote does not stop backups to the others."""
+    workdir = mkdtemp(prefix='borgit-test-fan-out-')
+    config = _local_config(
+        workdir,
+        max_concurrent_uploads=1,
+        metrics_report_path=os.path.join(workdir, 'report.json'),
+    )
+
+    repos = _init_repos(
+        workdir, ['local', 'offsite1', 'unreachable', 'offsite2'],
+        uninitialised=['unreachable'],
+    )
+    logger = _TestLogger()
+    with pytest.raises(subprocess.CalledProcessError):
+        run_backup(repos, 'fan_out_test', config, logger, concurrent=True)
+
+    with open(config['metrics_report_path']) as report_handle:
+        targets = {
+            target['target']: target
+            for target in json.load(report_handle)['targets']
+        }
+    assert set(targets) == set(repos)
+    assert not targets['unreachable']['succeeded']
+    for repo_name in 'local', 'offsite1', 'offsite2':
+        assert targets[repo_name]['succeeded']
+    assert logger.has_log_entry(words=['offsite2', 'succeeded'],
+                                level='info')
+    assert logger.has_log_entry(words=['unreachable', 'failed'],
+                                level='error')
+
+    shutil.rmtree(workdir)
+
+
+def test_sharded_run():
+    """Back up sources split across shards as though to one repo."""
+    workdir = mkdtemp(prefix='borgit-test-sharded-')
+    extra_source = os.path.join(workdir, 'extra')
+    os.mkdir(extra_source)
+    with open(os.path.join(extra_source, 'notes.txt'), 'w') as notes:
+        notes.write('borgit\n')
+
+    config = _local_config(
+        workdir,
+        backup_source_paths=[BASE_SOURCE, extra_source],
+        check_files=[
+            _kdb_check(2),
+            {
+                'path': os.path.join(extra_source, 'notes.txt'),
+                'minimum_size': '1B',
+            },
+        ],
+        shard_count=2,
+        state_directory=workdir,
+    )
+
+    scratch = get_scratch_space(config)
+    repos = get_repos(config, scratch)
+    repo = repos['local']
+    repo.init()
+    logger = _TestLogger()
+    metrics = run_backup(repos, 'sharded_test', config, logger,
+                         scratch=scratch)
+    assert metrics.succeeded
+
+    for shard in repo.shards:
+        assert [archive.name for archive in shard.iter_archives()] == [
+            'sharded_test',
+        ]
+    assert repo.shards[1].repo == config['local_destination_path'] + (
+        '-shard2'
+    )
+    files = repo.list_files_in_archive('sharded_test')
+    assert any(path.endswith(b'base/test.kdb') for path in files)
+    assert any(path.endswith(b'extra/notes.txt') for path in files)
+    assert logger.has_log_entry(words=['test.kdb', 'entries'], level='info')
+
+    # Sources stay in their shard on later runs.
+    assert get_repos(config, scratch)['local'].assignments == (
+        repo.assignments
+    )
+
+    scratch.cleanup()
+    shutil.rmtree(workdir)
+
+
+def test_sharded_source_settings():
+    """Check archives of source_settings are only used in their shards."""
+    workdir = mkdtemp(prefix='borgit-test-sharded-settings-')
+    extra_source = os.path.join(workdir, 'extra')
+    os.mkdir(extra_source)
+    with open(os.path.join(extra_source, 'notes.txt'), 'w') as notes:
+        notes.write('borgit\n')
+
+    config = _local_config(
+        workdir,
+        backup_source_paths=[BASE_SOURCE, extra_source],
+        shard_count=2,
+        shard_assignments=[{'paths': [extra_source], 'shard': 2}],
+        source_settings=[
+            {'name': 'extra', 'paths': [extra_source]},
+        ],
+        check_files=[
+            _kdb_check(2),
+            {
+                'path': os.path.join(extra_source, 'notes.txt'),
+                'minimum_size': '1B',
+            },
+        ],
+        sample_verify_size='1MiB',
+    )
+
+    scratch = get_scratch_space(config)
+    repos = get_repos(config, scratch)
+    repo = repos['local']
+    repo.init()
+    logger = _TestLogger()
+    metrics = run_backup(repos, 'settings_test', config, logger,
+                         scratch=scratch)
+    assert metrics.succeeded
+
+    assert [
+        [archive.name for archive in shard.iter_archives()]
+        for shard in repo.shards
+    ] == [['settings_test'], ['settings_test-extra']]
+    assert logger.has_log_entry(['sample verification compared'], 'info')
+
+    # Shards are found from the repos for archives of earlier runs.
+    repo = get_repos(config, scratch)['local']
+    repo.check_archive('settings_test-extra')
+    assert [
+        record.path for record in repo.iter_files_in_archive(
+            'settings_test-extra',
+        ) if record.type == '-'
+    ] == [os.path.join(extra_source, 'notes.txt').lstrip('/')]
+
+    scratch.cleanup()
+    shutil.rmtree(workdir)
+
+
+def test_replicated_run():
+    """Copy the local archive to the remote repo rather than rescanning."""
+    workdir = mkdtemp(prefix='borgit-test-replicated-')
+    config = _local_config(
+        workdir,
+        check_files=[_kdb_check(2)],
+        replication_mode='export_tar',
+    )
+
+    repos = _init_repos(workdir, ['local', 'remote'])
+    logger = _TestLogger()
+    metrics = run_backup(repos, 'replicated_test', config, logger,
+                         concurrent=True)
+    assert metrics.succeeded
+
+    phases = {
+        (phase['repo'], phase['phase'])
+        for phase in metrics.report()['phases']
+    }
+    assert (repos['local'].repo, 'backup') in phases
+    assert (repos['remote'].repo, 'replicate') in phases
+    assert (repos['remote'].repo, 'backup') not in phases
+    assert (
+        repos['remote'].list_files_in_archive('replicated_test')
+        == repos['local'].list_files_in_archive('replicated_test')
+    )
+
+    shutil.rmtree(workdir)
+
+
+def test_resumed_run():
+    """Resume an interrupted run from the phase it stopped in."""
+    workdir = mkdtemp(prefix='borgit-test-resumed-')
+    state_directory = os.path.join(workdir, 'state')
+    os.mkdir(state_directory)
+    config = _local_config(
+        workdir,
+        replication_mode='export_tar',
+        state_directory=state_directory,
+    )
+
+    repos = _init_repos(workdir, ['local', 'remote'])
+    logger = _TestLogger()
+
+    # The interrupted run backed up to the local repo, but was stopped
+    # part way through copying its archive, leaving a checkpoint.
+    journal = get_journal(config)
+    journal.begin('interrupted_test', logger)
+    repos['local'].backup('interrupted_test', config['backup_source_paths'])
+    journal.mark_done(repos['local'].repo, 'pre-check')
+    journal.mark_done(repos['local'].repo, 'backup')
+    repos['remote'].backup('interrupted_test.checkpoint',
+                           config['backup_source_paths'])
+
+    metrics = run_backup(repos, 'resumed_test', config, logger)
+    assert metrics.succeeded
+    assert metrics.archive_name == 'interrupted_test'
+    assert logger.has_log_entry(['resuming', 'interrupted_test'], 'info')
+
+    phases = {
+        (phase['repo'], phase['phase'])
+        for phase in metrics.report()['phases']
+    }
+    assert (repos['local'].repo, 'backup') not in phases
+    assert (repos['local'].repo, 'post-check') in phases
+    assert (repos['remote'].repo, 'replicate') in phases
+    assert [
+        archive.name for archive in repos['remote'].iter_archives()
+    ] == ['interrupted_test']
+
+    # The run finished, so the next one starts afresh.
+    metrics = run_backup(repos, 'next_test', config, logger)
+    assert metrics.archive_name == 'next_test'
+
+    shutil.rmtree(workdir)
+
+
+def test_local_source_settings():
+    """Back up sources with their own settings into their own archive."""
+    workdir = mkdtemp(prefix='borgit-test-source-settings-')
+    config = _local_config(
+        workdir,
+        backup_source_paths=[BASE_SOURCE],
+        source_settings=[
+            {
+                'name': 'kdb',
+                'paths': ['*/base'],
+                'compression': 'auto,zstd,3',
+            },
+        ],
+        check_files=[_kdb_check(2)],
+    )
+
+    repo = _init_repo(workdir)
+    logger = _TestLogger()
+    perform_backup(repo, 'settings_test', config, logger)
+
+    assert [archive.name for archive in repo.iter_archives()] == [
+        'settings_test-kdb',
+    ]
+    assert logger.has_log_entry(words=['test.kdb', 'entries'], level='info')
+
+    shutil.rmtree(workdir)
+
+
+def test_local_metadata_check():
+    """Check metadata checks run from the listing, without extraction."""
+    workdir = mkdtemp(prefix='borgit-test-local-metadata-')
+    config = _local_config(workdir, check_files=[
+        {'path': KDB_PATH, 'minimum_size': '1MiB'},
+    ])
+
+    repo = _init_repo(workdir)
+    logger = _TestLogger()
+    metrics = RunMetrics('metadata_test')
+    with pytest.raises(CheckFailure):
+        perform_backup(repo, 'metadata_test', config, logger,
+                       metrics=metrics)
+
+    assert logger.has_log_entry(
+        words=['base/test.kdb', 'below the minimum', '1MiB'],
+        level='error',
+    )
+    phases = [phase['phase'] for phase in metrics.report()['phases']]
+    assert 'metadata-check' in phases
+    assert 'restore' not in phases
+
+    shutil.rmtree(workdir)
+
+
+def test_local_size_change_check():
+    """Check sizes are compared with the previous archive's listing."""
+    workdir = mkdtemp(prefix='borgit-test-local-size-change-')
+    config = _local_config(workdir, check_files=[
+        {'path': KDB_PATH, 'maximum_size_change': 10},
+    ])
+
+    repo = _init_repo(workdir)
+    loggers = []
+    for archive_name in 'size_change_1', 'size_change_2':
+        loggers.append(_TestLogger())
+        perform_backup(repo, archive_name, config, loggers[-1])
+
+    assert loggers[0].has_log_entry(
+        words=['base/test.kdb', 'no earlier archive'], level='warning',
+    )
+    assert not loggers[1].messages['warning']
+    assert loggers[1].has_log_entry(
+        words=['base/test.kdb', 'size:'], level='info',
+    )
+
+    shutil.rmtree(workdir)
+
+
+def test_local_streamed_check():
+    """Perform a local test with a check streamed from the archive."""
+    workdir = mkdtemp(prefix='borgit-test-local-stream-')
+    config = _local_config(workdir, check_files=[
+        _kdb_check(200, stream=True),
+    ])
+
+    metrics = RunMetrics('local_stream_test')
+    repo = _init_repo(workdir, metrics=metrics)
+    archive_name = 'local_stream_test'
+    logger = _TestLogger()
+    with pytest.raises(CheckFailure):
+        perform_backup(repo, archive_name, config, logger, metrics=metrics)
+
+    assert logger.has_log_entry(
+        words=['at least', '200', 'required', 'streamed'],
+        level='error',
+    )
+    # The stream is timed like any other borg command.
+    assert 'extract' in [command['command'] for command in metrics.commands]
+    assert os.listdir(workdir) == ['repo']
+
+    shutil.rmtree(workdir)
+
+
+
+def _read_one_byte(source, arguments):
+    """Check plugin which passes after reading only the first byte."""
+    source.read(1)
+    return CheckResult(passed=True, messages=[], errors=[], metrics={})
+
+
+def test_local_streamed_check_borg_exit():
+    """Check streamed checks fail when borg does, unless the check stopped
+    reading early."""
+    workdir = mkdtemp(prefix='borgit-test-local-stream-exit-')
+    source = os.path.join(workdir, 'source')
+    os.mkdir(source)
+    large = os.path.join(source, 'large.bin')
+    with open(large, 'wb') as large_file:
+        large_file.write(os.urandom(2**20))
+
+    def streamed_check(path):
+        return {
+            'path': path,
+            'plugin': 'tests.basetests:_read_one_byte',
+            'stream': True,
+        }
+
+    config = _local_config(
+        workdir,
+        backup_source_paths=source,
+        check_files=[
+            streamed_check(large),
+            streamed_check(os.path.join(source, 'missing.bin')),
+        ],
+    )
+    repo = _init_repo(workdir)
+    logger = _TestLogger()
+    with pytest.raises(CheckFailure):
+        perform_backup(repo, 'stream_exit_test', config, logger)
+
+    assert not logger.has_log_entry(
+        words=['large.bin', 'check failed'], level='error',
+    )
+    assert logger.has_log_entry(
+        words=['missing.bin', 'check failed'], level='error',
+    )
+    assert logger.has_log_entry(
+        words=['missing.bin', 'exited with code'], level='error',
+    )
+
+    shutil.rmtree(workdir)
+
+def test_local_concurrent_checks():
+    """Perform a local test with checks run concurrently."""
+    workdir = mkdtemp(prefix='borgit-test-local-concurrent-checks-')
+    config = _local_config(
+        workdir,
+        check_files=[_kdb_check(2), _kdb_check(200, stream=True)],
+        check_concurrency=2,
+    )
+
+    repo = _init_repo(workdir)
+    archive_name = 'local_concurrent_checks_test'
+    logger = _TestLogger()
+    with pytest.raises(CheckFailure):
+        perform_backup(repo, archive_name, config, logger)
+
+    assert logger.has_log_entry(
+        words=['[' + KDB_PATH + ']', 'backup', 'check', 'failed'],
+        level='error',
+    )
+    assert logger.has_log_entry(
+        words=['[' + KDB_PATH + ']', 'at least', '200', 'required'],
+        level='error',
+    )
+
+    shutil.rmtree(workdir)
+
+
+def test_local_unchanged_files_skipped():
+    """Check files already verified are not checked again when unchanged."""
+    workdir = mkdtemp(prefix='borgit-test-local-ledger-')
+    state_dir = os.path.join(workdir, 'state')
+    os.mkdir(state_dir)
+    config = _local_config(
+        workdir,
+        check_files=[_kdb_check(2)],
+        state_directory=state_dir,
+        full_verify_interval=3,
+    )
+
+    repo = _init_repo(workdir)
+    logger = _TestLogger()
+    perform_backup(repo, 'local_ledger_test_1', config, logger)
+    assert not logger.has_log_entry(words=['unchanged'], level='info')
+
+    perform_backup(repo, 'local_ledger_test_2', config, logger)
+    assert logger.has_log_entry(
+        words=['unchanged', 'previously verified', 'local_ledger_test_1'],
+        level='info',
+    )
+
+    perform_backup(repo, 'local_ledger_test_3', config, logger)
+    assert logger.has_log_entry(
+        words=['checking all files', 'local_ledger_test_3'],
+        level='info',
+    )
+
+    shutil.rmtree(workdir)
+
+
+def test_local_fingerprints():
+    """Check fingerprints follow file metadata and content between
+    archives, and known content fingerprints are reused."""
+    workdir = mkdtemp(prefix='borgit-test-local-fingerprints-')
+    source = os.path.join(workdir, 'source')
+    os.mkdir(source)
+    notes = os.path.join(source, 'notes.txt')
+    with open(notes, 'w') as notes_file:
+        notes_file.write('borgit\n')
+
+    repo = _init_repo(workdir)
+    fingerprints = []
+    for archive_name in 'first', 'unchanged', 'touched', 'changed':
+        if archive_name == 'touched':
+            os.utime(notes, (0, 0))
+        if archive_name == 'changed':
+            with open(notes, 'w') as notes_file:
+                notes_file.write('changed\n')
+        repo.backup(archive_name, [source])
+        fingerprints.append(
+            repo.get_fingerprints(archive_name, [notes])[notes.lstrip('/')],
+        )
+    first, unchanged, touched, changed = fingerprints
+    assert first == unchanged
+    assert touched.metadata != unchanged.metadata
+    assert touched.content == unchanged.content
+    assert changed.content != touched.content
+
+    known = {notes.lstrip('/'): first._replace(content='known')}
+    assert repo.get_fingerprints('unchanged', [notes], known) == {
+        notes.lstrip('/'): first._replace(content='known'),
+    }
+
+    shutil.rmtree(workdir)
+
+
+def test_local_file_hashes():
+    """Check files can be listed with the sha256 of their content."""
+    workdir = mkdtemp(prefix='borgit-test-local-hashes-')
+    source = os.path.join(workdir, 'source')
+    os.mkdir(source)
+    notes = os.path.join(source, 'notes.txt')
+    with open(notes, 'w') as notes_file:
+        notes_file.write('borgit\n')
+
+    repo = _init_repo(workdir)
+    repo.backup('hashes', [source])
+    records = list(repo.iter_files_in_archive('hashes', [notes], True))
+    assert [
+        (record.path, record.size, record.hash) for record in records
+    ] == [(
+        notes.lstrip('/'), 7, hashlib.sha256(b'borgit\n').hexdigest(),
+    )]
+    assert records[0].mtime.timestamp() == pytest.approx(
+        os.stat(notes).st_mtime, abs=1,
+    )
+
+    shutil.rmtree(workdir)
+
+
+def test_local_command_timeout():
+    """Check borg commands are stopped when their timeout expires."""
+    workdir = mkdtemp(prefix='borgit-test-local-timeout-')
+
+    repo = _init_repo(workdir, timeouts={'check': 0.01})
+    with pytest.raises(CommandTimeout):
+        repo.check()
+
+    shutil.rmtree(workdir)
+
+
+def test_local_command_cancelled(fake_borg, monkeypatch):
+    """Check running borg commands are stopped when the run is cancelled."""
+    workdir = mkdtemp(prefix='borgit-test-local-cancelled-')
+
+    repo = _init_repo(workdir)
+    monkeypatch.setenv('FAKE_BORG_LATENCY', '30')
+    repo.cancel_event = threading.Event()
+    threading.Timer(0.2, repo.cancel_event.set).start()
+    start = time.monotonic()
+    with pytest.raises(RunCancelled):
+        repo.list_archives()
+    assert time.monotonic() - start < 5
+
+    shutil.rmtree(workdir)
@@ -0,0 +1,111 @@
+"""Tests of config validation."""
+import os
+import shutil
+from tempfile import mkdtemp
+
+import pytest
+import yaml
+
+from borgit.config import (
+    InvalidConfiguration,
+    load_config,
+    validate_config,
+    VALIDATION_PLAN,
+)
+
+
+def _valid_config(workdir):
+    """Make a valid config using directories in workdir."""
+    return {
+        'repo_passphrase': 'config_test',
+        'working_directory': workdir,
+        'local_destination_path': workdir,
+        'backup_source_paths': [workdir],
+        'remote_repositories': [{
+            'name': 'offsite',
+            'path': 'ssh://offsite_backups@backup.example.com/~/repository',
+        }],
+        'check_files': [{'path': workdir, 'minimum_size': '1KiB'}],
+    }
+
+
+def test_validation_plan():
+    """Check list_of_dicts contents follow their list in the plan."""
+    keys = [step.keys for step in VALIDATION_PLAN]
+    assert keys.index(('check_files', 'path')) > keys.index(('check_files',))
+    assert ('path',) not in keys
+
+
+def test_validate_config():
+    """Check issues are found in nested entries and defaults applied."""
+    workdir = mkdtemp(prefix='borgit-test-config-')
+
+    config = _valid_config(workdir)
+    validate_config(config)
+    assert config['max_concurrent_uploads'] == 2
+    assert config['remote_repositories'][0]['priority'] == 100
+    assert config['check_files'][0]['stream'] is None
+
+    config = _valid_config(workdir)
+    config['backup_source_paths'].append(os.path.join(workdir, 'missing'))
+    config['remote_repositories'].append({'name': 'nowhere'})
+    config['check_files'][0]['minimum_size'] = 'lots'
+    config['shard_assignments'] = 'shard1'
+    with pytest.raises(InvalidConfiguration) as err:
+        validate_config(config)
+    issues = str(err.value).splitlines()
+    assert issues[:2] == [
+        'remote_repositories[1].path was not found in configuration, but is '
+        'required.',
+        'shard_assignments is expected to be a list of mappings but was not.',
+    ]
+    assert issues[2].startswith('backup_source_paths[1] is invalid: Could not '
+                                'find local path')
+    assert issues[3].startswith('check_files[0].minimum_size is invalid')
+    assert len(issues) == 4
+
+    shutil.rmtree(workdir)
+
+
+def test_load_config_cached():
+    """Check an unchanged config which passed is not validated again."""
+    workdir = mkdtemp(prefix='borgit-test-config-cache-')
+    source = os.path.join(workdir, 'source')
+    os.mkdir(source)
+    config = _valid_config(workdir)
+    config['backup_source_paths'] = [source]
+    config['state_directory'] = workdir
+    config_path = os.path.join(workdir, 'borgit.yaml')
+    with open(config_path, 'w') as config_file:
+        yaml.safe_dump(config, config_file)
+
+    assert load_config(config_path)['max_concurrent_uploads'] == 2
+    os.rmdir(source)
+    # Defaults are still applied to the cached config.
+    assert load_config(config_path)['max_concurrent_uploads'] == 2
+
+    with open(config_path, 'a') as config_file:
+        config_file.write('compression: zstd,3\n')
+    with pytest.raises(InvalidConfiguration):
+        load_config(config_path)
+
+    shutil.rmtree(workdir)
+
+
+def test_validate_config_numbers():
+    """Check plain numbers given for sizes are reported, not raised."""
+    workdir = mkdtemp(prefix='borgit-test-config-numbers-')
+
+    config = _valid_config(workdir)
+    config['scratch_space_budget'] = 1000
+    config['check_files'][0]['minimum_size'] = 5
+    config['checkpoint_interval'] = 600
+    with pytest.raises(InvalidConfiguration) as err:
+        validate_config(config)
+    issues = str(err.value).splitlines()
+    assert [issue.split(' is invalid')[0] for issue in issues] == [
+        'scratch_space_budget', 'check_files[0].minimum_size',
+    ]
+    assert 'Could not convert 1000 to size' in issues[0]
+
+    shutil.rmtree(workdir)
@@ -0,0 +1,25 @@
+"""Fixtures shared by the tests."""
+import os
+import shutil
+from tempfile import mkdtemp
+
+import pytest
+
+FAKE_BORG = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'benchmarks', 'fake_borg',
+)
+
+
+@pytest.fixture
+def fake_borg(monkeypatch):
+    """Run benchmarks/fake_borg as borg, for tests which rely on behaviour
+    only it has, such as FAKE_BORG_LATENCY. Other tests run against
+    whichever borg is on PATH."""
+    bin_directory = mkdtemp(prefix='borgit-test-fake-borg-')
+    os.symlink(FAKE_BORG, os.path.join(bin_directory, 'borg'))
+    monkeypatch.setenv(
+        'PATH', bin_directory + os.pathsep + os.environ.get('PATH', ''),
+    )
+    yield FAKE_BORG
+    shutil.rmtree(bin_directory)
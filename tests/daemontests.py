@@ -0,0 +1,128 @@
+"""Tests of the borgit daemon."""
+import asyncio
+import json
+import os
+import shutil
+from tempfile import mkdtemp
+import time
+
+import pytest
+
+from borgit.daemon import BorgitDaemon
+from borgit.exceptions import LockTimeout
+from tests.basetests import _TestLogger
+
+
+def _make_daemon(workdir):
+    """Make a daemon for a local and a second repo, both initialised."""
+    config = {
+        'repo_passphrase': 'daemon_test',
+        'working_directory': workdir,
+        'local_destination_path': os.path.join(workdir, 'repo'),
+        'remote_repositories': [{
+            'name': 'other',
+            'path': os.path.join(workdir, 'other'),
+        }],
+        'backup_source_paths': os.path.join(
+            os.path.dirname(__file__), 'base',
+        ),
+        'ssh_multiplex': False,
+    }
+    daemon = BorgitDaemon(config, _TestLogger(),
+                          os.path.join(workdir, 'borgit.sock'))
+    for repo in daemon.repos.values():
+        repo.init()
+    return daemon
+
+
+async def _serve(daemon, scenario):
+    """Run a scenario against a serving daemon."""
+    ready = asyncio.Event()
+    serving = asyncio.ensure_future(daemon.serve(ready))
+    await ready.wait()
+    try:
+        return await scenario()
+    finally:
+        daemon.stop()
+        await serving
+
+
+def test_daemon_requests():
+    """Check jobs are run and answered over the control socket."""
+    workdir = mkdtemp(prefix='borgit-test-daemon-')
+    daemon = _make_daemon(workdir)
+
+    async def scenario():
+        reader, writer = await asyncio.open_unix_connection(
+            daemon.socket_path,
+        )
+        responses = []
+        for request in (
+            {'action': 'backup', 'archive': 'first'},
+            {'action': 'list', 'repo': 'other'},
+            {'action': 'check', 'repo': 'local', 'archive': 'first'},
+            {'action': 'list', 'repo': 'nowhere'},
+            {'action': 'status'},
+        ):
+            writer.write(json.dumps(request).encode('UTF-8') + b'\n')
+            responses.append(json.loads(await reader.readline()))
+        writer.write(b'not json\n')
+        responses.append(json.loads(await reader.readline()))
+        writer.close()
+        return responses
+
+    backup, listing, check, unknown, status, invalid = asyncio.run(
+        _serve(daemon, scenario),
+    )
+    assert backup['ok'] and backup['result']['succeeded']
+    assert [archive['name'] for archive in listing['result']] == ['first']
+    assert check == {'ok': True, 'result': None}
+    assert not unknown['ok'] and 'Unknown repo nowhere' in unknown['error']
+    assert not invalid['ok']
+    assert status['result']['repos']['local'] == {
+        'waiting': 0, 'running': None,
+    }
+    assert status['result']['jobs']['backup']['completed'] == 1
+    assert not os.path.exists(daemon.socket_path)
+
+    daemon.scratch.cleanup()
+    shutil.rmtree(workdir)
+
+
+def test_daemon_queues_per_repo():
+    """Check jobs on a repo run in turn, and on different repos at once."""
+    workdir = mkdtemp(prefix='borgit-test-daemon-queue-')
+    daemon = _make_daemon(workdir)
+    daemon._actions['check'] = lambda request: time.sleep(0.3)
+
+    async def scenario():
+        start = time.monotonic()
+        first = asyncio.ensure_future(
+            daemon.submit({'action': 'check', 'repo': 'local'}),
+        )
+        other = asyncio.ensure_future(
+            daemon.submit({'action': 'check', 'repo': 'other'}),
+        )
+        await asyncio.sleep(0.1)
+        assert daemon.status()['repos']['local']['running'] == 'check'
+        with pytest.raises(LockTimeout):
+            await daemon.submit({
+                'action': 'check', 'repo': 'local', 'lock_wait': 0.05,
+            })
+        queued = asyncio.ensure_future(
+            daemon.submit({'action': 'check', 'repo': 'local'}),
+        )
+        await asyncio.sleep(0.05)
+        assert daemon.status()['repos']['local']['waiting'] == 1
+        await asyncio.gather(first, other, queued)
+        return time.monotonic() - start
+
+    elapsed = asyncio.run(scenario())
+    # The two local jobs ran in turn, alongside the other repo's.
+    assert 0.6 <= elapsed < 0.9
+    jobs = daemon.status()['jobs']['check']
+    assert jobs['completed'] == 3
+    assert jobs['wait']['max'] >= 0.1
+
+    daemon.scratch.cleanup()
+    shutil.rmtree(workdir)
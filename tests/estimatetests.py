@@ -0,0 +1,135 @@
+"""Tests of forecasting runs."""
+from datetime import datetime
+import os
+import shutil
+from tempfile import mkdtemp
+
+import pytest
+
+from borgit.estimate import (
+    enforce_window,
+    estimate_run,
+    fit_throughput,
+    Forecast,
+)
+from borgit.exceptions import OutsideBackupWindow
+from borgit.metrics import RunMetrics
+from borgit.repo import BorgRepo
+from tests.basetests import _TestLogger
+
+
+def _forecast(total_seconds):
+    """Make a Forecast of a run taking total_seconds."""
+    return Forecast(
+        target='local', repo='repo', changes=None, upload_bytes=0,
+        backup_seconds=total_seconds, total_seconds=total_seconds,
+        history_runs=1,
+    )
+
+
+def test_fit_throughput():
+    """Check a fixed overhead is separated from the transfer rate."""
+    overhead, rate = fit_throughput([(0, 10), (1000, 20), (3000, 40)])
+    assert overhead == pytest.approx(10)
+    assert rate == pytest.approx(100)
+    # One run can't show an overhead.
+    assert fit_throughput([(1000, 20)]) == (0, 50)
+    assert fit_throughput([]) == (0, None)
+
+
+def test_estimate_run():
+    """Check new and changed files are found, and timed from history."""
+    workdir = mkdtemp(prefix='borgit-test-estimate-')
+    source = os.path.join(workdir, 'source')
+    os.mkdir(source)
+    for name in ('unchanged', 'changed'):
+        with open(os.path.join(source, name), 'w') as content:
+            content.write('x' * 100)
+    repo_workdir = os.path.join(workdir, 'work')
+    os.mkdir(repo_workdir)
+    state_directory = os.path.join(workdir, 'state')
+    os.mkdir(state_directory)
+    repo = BorgRepo(
+        repo=os.path.join(workdir, 'repo'),
+        repo_key='estimate_test',
+        working_directory=repo_workdir,
+    )
+    repo.init()
+    config = {
+        'backup_source_paths': [source],
+        'state_directory': state_directory,
+    }
+
+    forecast, = estimate_run({'local': repo}, config)
+    assert forecast.changes.new_files == 2
+    assert forecast.total_seconds is None
+
+    repo.backup('first', [source])
+    with open(os.path.join(source, 'changed'), 'a') as content:
+        content.write('y')
+    with open(os.path.join(source, 'new'), 'w') as content:
+        content.write('z' * 50)
+    metrics = RunMetrics('first')
+    metrics.record_backup(repo.repo, {
+        'original_size': 2000, 'compressed_size': 1000,
+        'deduplicated_size': 1000, 'nfiles': 2, 'duration': 10,
+    })
+    metrics.phases.append({
+        'repo': repo.repo, 'phase': 'pre-check', 'duration': 5,
+        'succeeded': True, 'started': 100,
+    })
+    # Checks run concurrently only take the time they overlap for.
+    for path, started in (('a', 110), ('b', 112)):
+        metrics.phases.append({
+            'repo': repo.repo, 'phase': 'check ' + path, 'duration': 4,
+            'succeeded': True, 'started': started,
+        })
+    metrics.finish(True)
+    metrics.append_history(os.path.join(state_directory, 'history.sqlite'))
+
+    forecast, = estimate_run({'local': repo}, config)
+    assert forecast.changes.new_files == 1
+    assert forecast.changes.new_bytes == 50
+    assert forecast.changes.changed_files == 1
+    assert forecast.changes.changed_bytes == 101
+    assert forecast.changes.unchanged_files == 1
+    # Half the size after compression, stored at 100 bytes per second.
+    assert forecast.upload_bytes == 75
+    assert forecast.total_seconds == pytest.approx(11.75)
+    assert forecast.history_runs == 1
+
+    shutil.rmtree(workdir)
+
+
+def test_enforce_window():
+    """Check runs which won't fit the window are refused or deferred."""
+    config = {'backup_window': '22:00-06:00'}
+    logger = _TestLogger()
+    slept = []
+    now = datetime(2024, 3, 20, 23)
+
+    # Sequential runs take the sum of their repos' times.
+    enforce_window([_forecast(3600), _forecast(3600)], config, logger,
+                   now=now, sleep=slept.append)
+    with pytest.raises(OutsideBackupWindow):
+        enforce_window([_forecast(4 * 3600), _forecast(4 * 3600)], config,
+                       logger, now=now, sleep=slept.append)
+    enforce_window([_forecast(4 * 3600), _forecast(4 * 3600)], config,
+                   logger, concurrent=True, now=now, sleep=slept.append)
+    assert slept == []
+
+    config['backup_window_action'] = 'defer'
+    enforce_window([_forecast(4 * 3600)], config, logger,
+                   now=datetime(2024, 3, 20, 12), sleep=slept.append)
+    assert slept == [10 * 3600]
+    assert logger.has_log_entry(['Waiting until 2024-03-20 22:00'],
+                                'warning')
+    # Runs longer than the whole window are refused even when deferring.
+    with pytest.raises(OutsideBackupWindow):
+        enforce_window([_forecast(9 * 3600)], config, logger, now=now,
+                       sleep=slept.append)
+
+    # Without history the run goes ahead.
+    enforce_window([_forecast(None)], config, logger,
+                   now=datetime(2024, 3, 20, 12), sleep=slept.append)
+    assert len(slept) == 1
@@ -0,0 +1,49 @@
+"""Tests of the journal used to resume interrupted runs."""
+import os
+import shutil
+from tempfile import mkdtemp
+
+from borgit.journal import RunJournal
+from borgit.state import StateFile
+from tests.basetests import _TestLogger
+
+
+def test_resume_interrupted_run():
+    """Check an unfinished run is resumed with its completed phases."""
+    workdir = mkdtemp(prefix='borgit-test-journal-')
+    state_file = StateFile(os.path.join(workdir, 'journal.json'))
+    logger = _TestLogger()
+
+    journal = RunJournal(state_file)
+    assert journal.begin('first', logger) == 'first'
+    assert not journal.resumed
+    journal.mark_done('/repo', 'backup')
+
+    journal = RunJournal(state_file)
+    assert journal.begin('second', logger) == 'first'
+    assert journal.resumed
+    assert journal.is_done('/repo', 'backup')
+    assert not journal.is_done('/repo', 'post-check')
+    assert not journal.is_done('/other', 'backup')
+
+    journal.finish()
+    journal = RunJournal(state_file)
+    assert journal.begin('third', logger) == 'third'
+    assert not journal.is_done('/repo', 'backup')
+
+    shutil.rmtree(workdir)
+
+
+def test_stale_run_not_resumed():
+    """Check a run interrupted too long ago is abandoned."""
+    workdir = mkdtemp(prefix='borgit-test-journal-')
+    state_file = StateFile(os.path.join(workdir, 'journal.json'))
+    logger = _TestLogger()
+
+    RunJournal(state_file).begin('first', logger)
+    journal = RunJournal(state_file, resume_window=-1)
+    assert journal.begin('second', logger) == 'second'
+    assert not journal.resumed
+    assert logger.has_log_entry(['not resuming', 'first'], 'warning')
+
+    shutil.rmtree(workdir)
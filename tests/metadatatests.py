@@ -0,0 +1,105 @@
+"""Tests of check_files metadata checks, run from archive listings."""
+from datetime import datetime, timedelta
+
+from borgit.checks import run_metadata_checks
+from borgit.repo import FileRecord
+from tests.basetests import _TestLogger
+
+
+class _ListingRepo:
+    """Stand-in for BorgRepo with fixed archive listings."""
+    repo = '/backups/repo'
+
+    def __init__(self, records, archives=None):
+        """Initialise the repo with the FileRecords to list, either for
+        every archive or in a dict keyed on archive name."""
+        self.records = records
+        self.archives = archives
+
+    def iter_files_in_archive(self, archive_name, paths=None):
+        """List the fixed records."""
+        if self.archives is not None:
+            return iter(self.archives[archive_name])
+        return iter(self.records)
+
+
+class _NullLogger:
+    """Logger discarding all messages."""
+    def info(self, message):
+        """Discard an info message."""
+
+    def warning(self, message):
+        """Discard a warning message."""
+
+    def error(self, message):
+        """Discard an error message."""
+
+
+def _record(path, size, age=timedelta(0)):
+    """Make a FileRecord of a regular file modified age ago."""
+    return FileRecord(path=path, type='-', size=size,
+                      mtime=datetime.now() - age, hash=None)
+
+
+def test_directory_metadata_checks():
+    """Check sizes, counts and ages are totalled over a directory."""
+    repo = _ListingRepo([
+        FileRecord(path='srv/dumps', type='d', size=0,
+                   mtime=datetime.now(), hash=None),
+        _record('srv/dumps/a.sql', 3000, timedelta(days=3)),
+        _record('srv/dumps/b.sql', 3000, timedelta(hours=1)),
+    ])
+    passing = {'path': '/srv/dumps', 'minimum_size': '5K',
+               'expected_file_count': 2, 'maximum_age': '1d'}
+    failing = {'path': '/srv/dumps', 'minimum_size': '1M',
+               'expected_file_count': 3, 'maximum_age': '30m'}
+    missing = {'path': '/srv/gone', 'minimum_size': '1B'}
+
+    results = dict(
+        (check['minimum_size'], result) for check, result in
+        run_metadata_checks(repo, 'new', [passing, failing, missing],
+                            _NullLogger())
+    )
+
+    assert results['5K'].passed
+    assert results['5K'].metrics == {'size': 6000, 'files': 2}
+    assert not results['1M'].passed
+    assert len(results['1M'].errors) == 3
+    assert not results['1B'].passed
+
+
+def test_size_change_since_previous_archive():
+    """Check a truncated file fails against its size in the previous
+    archive, and a missing baseline is warned about."""
+    archives = {
+        'first': [_record('srv/db.kdb', 1000)],
+        'second': [_record('srv/db.kdb', 1200)],
+        'third': [_record('srv/db.kdb', 10)],
+        'fourth': [_record('srv/db.kdb', 10), _record('srv/new.kdb', 10)],
+    }
+    repo = _ListingRepo(None, archives)
+    check = {'path': '/srv/db.kdb', 'maximum_size_change': 50}
+    new_check = {'path': '/srv/new.kdb', 'maximum_size_change': 50}
+
+    for archive, previous, passed in (('second', 'first', True),
+                                      ('third', 'second', False),
+                                      ('fourth', 'third', True)):
+        [(_, result)] = run_metadata_checks(
+            repo, archive, [check], _NullLogger(), previous,
+        )
+        assert result.passed == passed, archive
+
+    logger = _TestLogger()
+    results = run_metadata_checks(
+        repo, 'first', [check], logger,
+    ) + run_metadata_checks(
+        repo, 'fourth', [new_check], logger, 'third',
+    )
+    assert all(result.passed for _, result in results)
+    assert logger.has_log_entry(
+        ['/srv/db.kdb', 'no earlier archive', 'not checked'], 'warning',
+    )
+    assert logger.has_log_entry(
+        ['/srv/new.kdb', 'previous archive third', 'not checked'],
+        'warning',
+    )
@@ -0,0 +1,58 @@
+"""Tests of run metrics output."""
+import json
+import os
+import shutil
+import sqlite3
+from tempfile import mkdtemp
+
+from borgit.metrics import RunMetrics
+
+
+def _sample_metrics():
+    """Get metrics for a run with one backup."""
+    metrics = RunMetrics('metrics_test')
+    with metrics.phase('/backups/repo', 'backup'):
+        metrics.record_command('/backups/repo', 'create', 1.5, 0)
+    metrics.record_backup('/backups/repo', {
+        'original_size': 2000,
+        'compressed_size': 1000,
+        'deduplicated_size': 10,
+        'nfiles': 3,
+        'duration': 1.4,
+    })
+    metrics.finish(True)
+    return metrics
+
+
+def test_metrics_outputs():
+    """Check metrics are written as JSON, Prometheus text and history."""
+    workdir = mkdtemp(prefix='borgit-test-metrics-')
+    metrics = _sample_metrics()
+
+    report_path = os.path.join(workdir, 'report.json')
+    metrics.write_json(report_path)
+    with open(report_path) as report_handle:
+        report = json.load(report_handle)
+    assert report['phases'][0]['phase'] == 'backup'
+    assert report['backups']['/backups/repo']['deduplicated_size'] == 10
+
+    textfile_path = os.path.join(workdir, 'borgit.prom')
+    metrics.write_prometheus(textfile_path)
+    with open(textfile_path) as textfile_handle:
+        textfile = textfile_handle.read()
+    assert 'borgit_run_success 1' in textfile
+    assert (
+        'borgit_backup_deduplicated_size{repo="/backups/repo"} 10'
+        in textfile
+    )
+
+    history_path = os.path.join(workdir, 'history.sqlite')
+    metrics.append_history(history_path)
+    metrics.append_history(history_path)
+    connection = sqlite3.connect(history_path)
+    assert connection.execute(
+        'SELECT COUNT(*) FROM backups WHERE repo = ?', ('/backups/repo',),
+    ).fetchone() == (2,)
+    connection.close()
+
+    shutil.rmtree(workdir)
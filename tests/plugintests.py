@@ -0,0 +1,30 @@
+"""Tests of in-process check plugins."""
+import os
+
+from borgit.plugins import get_plugin
+
+KDB_PATH = os.path.join(os.path.dirname(__file__), 'base/test.kdb')
+
+
+def test_keepass_plugin():
+    """Check the keepass plugin reports details of a healthy KDB."""
+    plugin = get_plugin({'command': 'check_keepass'})
+    result = plugin(KDB_PATH, ['--min-entries=2'])
+
+    assert result.passed
+    assert result.metrics['entries'] == 4
+
+
+def test_keepass_plugin_stream():
+    """Check the keepass plugin fails a streamed KDB with too few entries."""
+    plugin = get_plugin({'command': 'check_keepass'})
+    with open(KDB_PATH, 'rb') as kdb_file:
+        result = plugin(kdb_file, ['--min-entries=200'])
+
+    assert not result.passed
+    assert 'at least 200' in result.errors[0].lower()
+
+
+def test_external_check_has_no_plugin():
+    """Check commands without a plugin are left to run externally."""
+    assert get_plugin({'command': 'check_something_else'}) is None
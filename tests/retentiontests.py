@@ -0,0 +1,147 @@
+"""Tests of deleting old archives by retention policy."""
+from datetime import datetime, timedelta
+import os
+import shutil
+from tempfile import mkdtemp
+import time
+
+from borgit.repo import ArchiveRecord, BorgRepo
+from borgit.retention import (
+    group_archives,
+    RetentionPolicy,
+    select_archives_to_keep,
+    stale_checkpoints,
+)
+from borgit.state import StateFile
+from tests.basetests import _TestLogger
+
+
+def _archive(name, start):
+    """Make an ArchiveRecord for an archive started at a datetime."""
+    return ArchiveRecord(name=name, id=name, start=start)
+
+
+def test_select_archives_to_keep():
+    """Check the keep rules match borg prune's."""
+    now = datetime(2024, 3, 20, 12)
+    archives = [
+        # Two archives a day for 30 days.
+        _archive('{}-{}'.format(day, hour),
+                 now - timedelta(days=day, hours=hour))
+        for day in range(30)
+        for hour in (0, 6)
+    ]
+
+    assert select_archives_to_keep(archives, {'keep_last': 3}, now) == {
+        '0-0', '0-6', '1-0',
+    }
+    assert select_archives_to_keep(archives, {'keep_daily': 3}, now) == {
+        '0-0', '1-0', '2-0',
+    }
+    # Rules don't count archives kept by earlier rules.
+    assert select_archives_to_keep(
+        archives, {'keep_last': 1, 'keep_daily': 2}, now,
+    ) == {'0-0', '1-0', '2-0'}
+    assert select_archives_to_keep(
+        archives, {'keep_within': 36 * 3600, 'keep_monthly': 2}, now,
+    ) == {'0-0', '0-6', '1-0', '1-6', '20-0'}
+
+
+def test_group_archives():
+    """Check archives of source_settings are grouped separately."""
+    start = datetime(2024, 3, 20)
+    groups = group_archives(
+        [_archive(name, start) for name in (
+            'nightly', 'nightly-media', 'nightly-vms', 'nightly.checkpoint',
+        )],
+        ['media', 'vms'],
+    )
+    assert {
+        group: [archive.name for archive in archives]
+        for group, archives in groups.items()
+    } == {
+        None: ['nightly'],
+        'media': ['nightly-media'],
+        'vms': ['nightly-vms'],
+    }
+
+
+def test_stale_checkpoints():
+    """Check checkpoints are only stale once their sources are backed up."""
+    start = datetime(2024, 3, 20)
+    archives = [
+        _archive('monday.checkpoint', start),
+        _archive('monday-media.checkpoint.1', start),
+        _archive('tuesday', start + timedelta(days=1)),
+        _archive('wednesday-media.checkpoint', start + timedelta(days=2)),
+    ]
+    assert stale_checkpoints(archives, ['media']) == ['monday.checkpoint']
+    archives.append(_archive('thursday-media', start + timedelta(days=3)))
+    assert stale_checkpoints(archives, ['media']) == [
+        'monday.checkpoint', 'monday-media.checkpoint.1',
+        'wednesday-media.checkpoint',
+    ]
+
+
+def _backed_up_repo(workdir, archive_names):
+    """Make a repo with an archive of the test sources for each name.
+    Borg lists start times to the second, so each starts in a new second.
+    """
+    source = os.path.join(os.path.dirname(__file__), 'base')
+    repo_workdir = os.path.join(workdir, 'work')
+    os.mkdir(repo_workdir)
+    repo = BorgRepo(
+        repo=os.path.join(workdir, 'repo'),
+        repo_key='retention_test',
+        working_directory=repo_workdir,
+    )
+    repo.init()
+    for name in archive_names:
+        time.sleep(1 - time.time() % 1)
+        repo.backup(name, [source])
+    return repo
+
+
+def test_apply_retention():
+    """Check archives the rules don't keep are pruned."""
+    workdir = mkdtemp(prefix='borgit-test-retention-')
+    repo = _backed_up_repo(workdir, ['first', 'second', 'third'])
+
+    logger = _TestLogger()
+    retention = RetentionPolicy(
+        repo, logger, {'keep_last': 1},
+        state_file=StateFile(os.path.join(workdir, 'retention.json')),
+    )
+    retention.record_verified(['third'])
+    result = retention.apply(['third'])
+
+    assert sorted(result.deleted) == ['first', 'second']
+    assert result.archives_before == 3
+    assert result.archives_after == 1
+    assert [archive.name for archive in repo.iter_archives()] == ['third']
+    assert logger.has_log_entry(['deleted 2 of 3 archives'], 'info')
+
+    shutil.rmtree(workdir)
+
+
+def test_apply_retention_protected():
+    """Check protected archives are kept, and archives of source_settings
+    are kept separately."""
+    workdir = mkdtemp(prefix='borgit-test-retention-')
+    repo = _backed_up_repo(
+        workdir, ['first', 'first-media', 'second', 'second-media', 'third'],
+    )
+
+    retention = RetentionPolicy(
+        repo, _TestLogger(), {'keep_last': 1}, ['media'],
+        state_file=StateFile(os.path.join(workdir, 'retention.json')),
+    )
+    retention.record_verified(['first'])
+    result = retention.apply(['third'])
+
+    assert sorted(result.deleted) == ['first-media', 'second']
+    assert sorted(
+        archive.name for archive in repo.iter_archives()
+    ) == ['first', 'second-media', 'third']
+
+    shutil.rmtree(workdir)
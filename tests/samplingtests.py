@@ -0,0 +1,108 @@
+"""Tests of sampled verification of backed up files."""
+import os
+import shutil
+from tempfile import mkdtemp
+
+from borgit.repo import BorgRepo
+from borgit.sampling import SampleVerifier
+from borgit.state import StateFile
+from tests.basetests import _TestLogger
+
+
+def _backed_up_sources(workdir, file_count):
+    """Back up a directory of small files, returning the repo and sources.
+    """
+    source = os.path.join(workdir, 'source')
+    os.mkdir(source)
+    for number in range(file_count):
+        with open(os.path.join(source, 'file{}'.format(number)), 'w') as out:
+            out.write('content {}\n'.format(number) * 10)
+    repo_workdir = os.path.join(workdir, 'work')
+    os.mkdir(repo_workdir)
+    repo = BorgRepo(
+        repo=os.path.join(workdir, 'repo'),
+        repo_key='sampling_test',
+        working_directory=repo_workdir,
+    )
+    repo.init()
+    repo.backup('sampling_test', [source])
+    return repo, source
+
+
+def test_coverage_accumulates():
+    """Check each run verifies files the previous runs did not."""
+    workdir = mkdtemp(prefix='borgit-test-sampling-')
+    repo, _ = _backed_up_sources(workdir, 6)
+    state_file = StateFile(os.path.join(workdir, 'sampling.json'))
+    file_size = len('content 0\n' * 10)
+
+    covered = []
+    for run in range(3):
+        result = SampleVerifier(
+            repo, _TestLogger(), state_file,
+            byte_budget=2 * file_size, seed=run,
+        ).verify(['sampling_test'])
+        assert result.verified == 2
+        assert not result.mismatched
+        covered.append(result.covered)
+    assert covered == [2, 4, 6]
+    assert result.total == 6
+    assert os.listdir(repo.working_directory) == []
+
+    shutil.rmtree(workdir)
+
+
+def test_mismatch_and_changed_files():
+    """Check mismatched files fail, but changed sources are skipped."""
+    workdir = mkdtemp(prefix='borgit-test-sampling-')
+    repo, source = _backed_up_sources(workdir, 3)
+
+    # Change the content of one source file without changing its size or
+    # mtime, so it no longer matches the archive but looks unchanged.
+    corrupted = os.path.join(source, 'file0')
+    stat = os.stat(corrupted)
+    with open(corrupted, 'r+') as corrupted_file:
+        corrupted_file.write('X')
+    os.utime(corrupted, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    # Modify another file after it was backed up.
+    with open(os.path.join(source, 'file1'), 'a') as changed_file:
+        changed_file.write('more\n')
+
+    logger = _TestLogger()
+    result = SampleVerifier(repo, logger).verify(['sampling_test'])
+    assert result.verified == 1
+    assert result.changed == 1
+    assert result.mismatched == [os.path.join(source, 'file0')]
+    assert logger.has_log_entry(['file0', 'does not match'], 'error')
+
+    shutil.rmtree(workdir)
+
+
+def test_relative_sources():
+    """Check files of relative sources are found where borg ran, and files
+    no longer backed up are forgotten."""
+    workdir = mkdtemp(prefix='borgit-test-sampling-')
+    repo_workdir = os.path.join(workdir, 'work')
+    source = os.path.join(repo_workdir, 'relative')
+    os.makedirs(source)
+    with open(os.path.join(source, 'notes.txt'), 'w') as notes:
+        notes.write('borgit\n')
+    repo = BorgRepo(
+        repo=os.path.join(workdir, 'repo'),
+        repo_key='sampling_test',
+        working_directory=repo_workdir,
+    )
+    repo.init()
+    repo.backup('relative_test', ['relative'])
+    state_file = StateFile(os.path.join(workdir, 'sampling.json'))
+    with state_file.update() as state:
+        state[repo.repo] = {'removed/file': 1}
+
+    result = SampleVerifier(
+        repo, _TestLogger(), state_file, sources=['relative'],
+    ).verify(['relative_test'])
+    assert result.verified == 1
+    assert result.changed == 0
+    assert list(state_file.read()[repo.repo]) == ['relative/notes.txt']
+
+    shutil.rmtree(workdir)
@@ -0,0 +1,99 @@
+"""Tests of managing scratch space for restoring files."""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import subprocess
+import sys
+from tempfile import mkdtemp
+import threading
+import time
+import weakref
+
+from borgit.scratch import plan_restores, ScratchSpace, sweep_leftovers
+
+
+def test_sweep_leftovers():
+    """Check only scratch directories of finished processes are removed."""
+    workdir = mkdtemp(prefix='borgit-test-scratch-')
+    finished = subprocess.Popen([sys.executable, '-c', ''])
+    finished.wait()
+    for name, pid in (('borgit-scratch-dead', finished.pid),
+                      ('borgit-scratch-alive', os.getpid())):
+        os.mkdir(os.path.join(workdir, name))
+        with open(os.path.join(workdir, name, 'borgit.pid'), 'w') as marker:
+            marker.write(str(pid))
+    os.mkdir(os.path.join(workdir, 'borgit-scratch-unmarked'))
+
+    assert sweep_leftovers(workdir) == [
+        os.path.join(workdir, 'borgit-scratch-dead'),
+    ]
+    assert sorted(os.listdir(workdir)) == [
+        'borgit-scratch-alive', 'borgit-scratch-unmarked',
+    ]
+
+    shutil.rmtree(workdir)
+
+
+def test_plan_restores():
+    """Check restores are batched to fit the budget."""
+    sizes = [('a', 40), ('b', 50), ('c', 30), ('d', 150), ('e', 10)]
+    assert plan_restores(sizes, 100) == [
+        (['a', 'b'], 90), (['c'], 30), (['d'], 150), (['e'], 10),
+    ]
+    assert plan_restores(sizes, None) == [(['a', 'b', 'c', 'd', 'e'], 280)]
+
+
+def test_budget_and_ram_directory():
+    """Check restores stay within the budget, and small ones use RAM."""
+    workdir = mkdtemp(prefix='borgit-test-scratch-')
+    disk = os.path.join(workdir, 'disk')
+    ram = os.path.join(workdir, 'ram')
+    os.mkdir(disk)
+    os.mkdir(ram)
+    scratch = ScratchSpace(disk, budget=100, ram_directory=ram,
+                           ram_limit=10)
+
+    with scratch.restore_directory(5) as small:
+        assert small.startswith(ram)
+        with scratch.restore_directory(8) as overflow:
+            assert overflow.startswith(disk)
+
+    in_use = []
+    peak = []
+    lock = threading.Lock()
+
+    def restore(size):
+        with scratch.restore_directory(size) as path:
+            assert path.startswith(disk)
+            with lock:
+                in_use.append(size)
+                peak.append(sum(in_use))
+            time.sleep(0.05)
+            with lock:
+                in_use.remove(size)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(restore, [60, 60, 30, 150]))
+    assert max(peak) <= 150
+    assert all(total <= 100 for total in peak if total != 150)
+
+    scratch.cleanup()
+    assert os.listdir(disk) == []
+    assert os.listdir(ram) == []
+
+    shutil.rmtree(workdir)
+
+
+def test_scratch_space_context():
+    """Check scratch space is removed on exit, and not kept alive to clean
+    up when the process exits."""
+    workdir = mkdtemp(prefix='borgit-test-scratch-context-')
+
+    with ScratchSpace(workdir) as scratch:
+        assert os.path.isdir(scratch.directory_for('repo-'))
+    assert os.listdir(workdir) == []
+    finished = weakref.ref(scratch)
+    del scratch
+    assert finished() is None
+
+    shutil.rmtree(workdir)
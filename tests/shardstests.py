@@ -0,0 +1,57 @@
+"""Tests of assigning backup sources to shards."""
+import os
+import shutil
+from tempfile import mkdtemp
+
+import pytest
+
+from borgit.shards import shard_location, ShardAssigner
+from borgit.state import StateFile
+
+
+def _make_source(root, name, size):
+    """Create a source directory holding size bytes."""
+    path = os.path.join(root, name)
+    os.mkdir(path)
+    with open(os.path.join(path, 'data'), 'wb') as data:
+        data.write(b'\0' * size)
+    return path
+
+
+def test_shard_location():
+    """Check the first shard is the repository itself."""
+    assert shard_location('/backups/repo', 0) == '/backups/repo'
+    assert shard_location('/backups/repo/', 2) == '/backups/repo-shard3'
+
+
+def test_sources_balanced_and_kept():
+    """Check sources are balanced by size, then stay where they are."""
+    root = mkdtemp(prefix='borgit-test-shards-')
+    try:
+        big = _make_source(root, 'big', 3000)
+        medium = _make_source(root, 'medium', 2000)
+        small = _make_source(root, 'small', 1000)
+        pinned = _make_source(root, 'pinned', 4500)
+        state_file = StateFile(os.path.join(root, 'shards.json'))
+        assigner = ShardAssigner(
+            2,
+            explicit=[{'paths': ['*/pinned'], 'shard': 2}],
+            state_file=state_file,
+        )
+
+        assignments = assigner.assign([big, medium, small, pinned])
+        assert assignments == {pinned: 1, big: 0, medium: 0, small: 1}
+
+        # Growth must not move a source away from its deduplicated data.
+        _make_source(big, 'more', 10000)
+        assert ShardAssigner(2, state_file=state_file).assign(
+            [big, medium, small],
+        ) == {big: 0, medium: 0, small: 1}
+    finally:
+        shutil.rmtree(root)
+
+
+def test_assignment_to_missing_shard():
+    """Check assignments to shards which don't exist are rejected."""
+    with pytest.raises(ValueError):
+        ShardAssigner(2, explicit=[{'paths': ['/srv'], 'shard': 3}])
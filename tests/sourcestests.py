@@ -0,0 +1,54 @@
+"""Tests of grouping backup sources by their borg settings."""
+from borgit.sources import part_for_path, plan_backup
+
+
+def test_no_source_settings():
+    """Check all sources go in one archive with the default settings."""
+    plan = plan_backup({'backup_source_paths': '/srv/data'}, 'nightly')
+
+    assert len(plan) == 1
+    assert plan[0].archive_name == 'nightly'
+    assert plan[0].sources == ['/srv/data']
+    assert plan[0].compression == 'lz4'
+    assert plan[0].chunker_params is None
+
+
+def test_source_settings_split_archives():
+    """Check sources with their own settings get their own archive."""
+    config = {
+        'backup_source_paths': ['/srv/data', '/srv/media', '/srv/vms'],
+        'compression': 'auto,zstd,3',
+        'source_settings': [
+            {'name': 'media', 'paths': ['/srv/media'],
+             'compression': 'none'},
+            {'name': 'vms', 'paths': ['/srv/vm*'],
+             'chunker_params': 'fixed,4194304'},
+        ],
+    }
+    plan = plan_backup(config, 'nightly')
+
+    assert [(part.archive_name, part.sources) for part in plan] == [
+        ('nightly', ['/srv/data']),
+        ('nightly-media', ['/srv/media']),
+        ('nightly-vms', ['/srv/vms']),
+    ]
+    assert plan[1].compression == 'none'
+    assert plan[2].compression == 'auto,zstd,3'
+    assert plan[2].chunker_params == 'fixed,4194304'
+
+
+def test_part_for_path():
+    """Check backed up paths are found in the archive of their source."""
+    config = {
+        'backup_source_paths': ['/srv/data', '/srv/media'],
+        'source_settings': [
+            {'name': 'media', 'paths': ['/srv/media']},
+        ],
+    }
+    plan = plan_backup(config, 'nightly')
+
+    assert part_for_path(plan, '/srv/media/a.mkv').archive_name == (
+        'nightly-media'
+    )
+    assert part_for_path(plan, '/srv/data/db.kdb').archive_name == 'nightly'
+    assert part_for_path(plan, '/srv/mediaold/x').archive_name == 'nightly'
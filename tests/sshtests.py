@@ -0,0 +1,58 @@
+"""Tests of shared SSH connections for remote repos."""
+import logging
+import os
+from tempfile import mkdtemp
+
+from borgit.repo import BorgRepo
+from borgit.ssh import get_ssh_destination, multiplex_ssh, SSHMaster
+
+
+def test_ssh_destination():
+    """Check remote repos are connected to as their backup user."""
+    assert get_ssh_destination(
+        'ssh://alice_backups@backup.example.com/~/repository',
+    ) == 'alice_backups@backup.example.com'
+    assert get_ssh_destination(
+        'ssh://alice_backups@[fd00::1]/~/repository',
+    ) == 'alice_backups@fd00::1'
+
+
+def test_local_repo_has_no_ssh_destination():
+    """Check local repos are not connected to over SSH."""
+    assert get_ssh_destination('/var/backups/repository') is None
+
+
+def test_borg_uses_shared_connection():
+    """Check borg is told to reuse the master connection's socket."""
+    master = SSHMaster('alice_backups@backup.example.com')
+    master.control_directory = '/tmp/borgit-ssh-test'
+    repo = BorgRepo('ssh://alice_backups@backup.example.com/~/repository',
+                    'key', '/tmp')
+    repo.rsh = master.rsh
+
+    _, env = repo.engine._build_borg_command('list')
+
+    assert env['BORG_RSH'] == (
+        'ssh -o ControlMaster=no -o ControlPath=/tmp/borgit-ssh-test/master'
+    )
+
+
+def test_local_repos_not_multiplexed():
+    """Check no connection is made for local repos."""
+    repo = BorgRepo('/var/backups/repository', 'key', '/tmp')
+    with multiplex_ssh({'local': repo}, logging.getLogger()) as masters:
+        assert masters == {}
+        assert repo.rsh is None
+
+
+def test_reuse_not_timed_without_ssh(monkeypatch):
+    """Check a session which can't be opened isn't given a time."""
+    workdir = mkdtemp(prefix='borgit-test-ssh-')
+    monkeypatch.setenv('PATH', workdir)
+    master = SSHMaster('alice_backups@backup.example.com')
+    master.control_directory = workdir
+
+    assert master.time_reuse() is None
+    assert master.reuse_time is None
+
+    os.rmdir(workdir)
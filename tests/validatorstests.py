@@ -0,0 +1,164 @@
+"""Tests of validating file formats from limited reads."""
+import gzip
+import io
+import os
+import shutil
+import sqlite3
+import struct
+import tarfile
+from tempfile import mkdtemp
+import zipfile
+
+import pytest
+
+from borgit.plugins import get_plugin
+from borgit.validators import (
+    ByteRange,
+    FormatError,
+    read_ranges,
+    validate_format,
+)
+
+KDB_PATH = os.path.join(os.path.dirname(__file__), 'base/test.kdb')
+
+
+def _kdbx_header(major):
+    """Build a minimal KDBX header of a major version."""
+    length_format = '<I' if major >= 4 else '<H'
+    header = bytes((0x03, 0xd9, 0xa2, 0x9a, 0x67, 0xfb, 0x4b, 0xb5))
+    header += struct.pack('<HH', 1, major)
+    for field_id, value in (
+            (2, bytes.fromhex('31c1f2e6bf714350be5805216afc5aff')),
+            (4, bytes(32)),
+            (0, b'\r\n\r\n')):
+        header += bytes((field_id,)) + struct.pack(length_format, len(value))
+        header += value
+    return header
+
+
+def test_read_ranges_stream_matches_file():
+    """Check streams give the same ranges as files, reading no further than
+    needed."""
+    content = bytes(range(256)) * 40
+    ranges = [ByteRange(10, 5), ByteRange(-20, 8), ByteRange(-5, 100)]
+    workdir = mkdtemp(prefix='borgit-test-validators-')
+    path = os.path.join(workdir, 'content')
+    with open(path, 'wb') as output:
+        output.write(content)
+
+    expected = ([content[10:15], content[-20:-12], content[-5:]],
+                len(content))
+    assert read_ranges(path, ranges) == expected
+    assert read_ranges(io.BytesIO(content), ranges) == expected
+
+    stream = io.BytesIO(content)
+    assert read_ranges(stream, [ByteRange(0, 124)]) == ([content[:124]],
+                                                        None)
+    assert stream.tell() == 124
+
+    shutil.rmtree(workdir)
+
+
+def test_valid_formats():
+    """Check valid files of each format pass with their details."""
+    workdir = mkdtemp(prefix='borgit-test-validators-')
+
+    def path(name):
+        return os.path.join(workdir, name)
+
+    connection = sqlite3.connect(path('db.sqlite'))
+    with connection:
+        connection.execute('CREATE TABLE things (name TEXT)')
+        connection.executemany('INSERT INTO things VALUES (?)',
+                               [('thing',)] * 1000)
+    connection.close()
+    with zipfile.ZipFile(path('files.zip'), 'w') as archive:
+        archive.writestr('one', 'one')
+        archive.writestr('two', 'two')
+        archive.comment = b'a comment'
+    with tarfile.open(path('files.tar'), 'w') as archive:
+        archive.add(KDB_PATH, arcname='test.kdb')
+    with gzip.open(path('file.gz'), 'wb') as output:
+        output.write(b'x' * 5000)
+    with open(path('dump.pgdump'), 'wb') as output:
+        output.write(b'PGDMP' + bytes((1, 14, 0, 4, 8, 1)) + bytes(500))
+    with open(path('dump.sql'), 'wb') as output:
+        output.write(
+            b'--\n-- PostgreSQL database dump\n--\n' + b'SELECT 1;\n' * 100
+            + b'--\n-- PostgreSQL database dump complete\n--\n\n'
+        )
+    with open(path('keepass.kdbx'), 'wb') as output:
+        output.write(_kdbx_header(4) + bytes(1000))
+
+    assert validate_format(KDB_PATH, 'kdb')['entries'] == 4
+    assert validate_format(path('keepass.kdbx'), 'kdbx')['cipher'] == (
+        'AES-256'
+    )
+    assert validate_format(path('db.sqlite'), 'sqlite')['page_count'] > 1
+    assert validate_format(path('files.zip'), 'zip') == {'entries': 2}
+    assert validate_format(path('files.tar'), 'tar') == {'format': 'ustar'}
+    assert validate_format(path('file.gz'), 'gzip') == {
+        'uncompressed_size_mod_4gib': 5000,
+    }
+    assert validate_format(path('dump.pgdump'), 'pgdump')['format'] == (
+        'custom'
+    )
+    assert validate_format(path('dump.sql'), 'pgdump_sql') == {}
+
+    for name, format_name in (('files.zip', 'zip'), ('files.tar', 'tar'),
+                              ('db.sqlite', 'sqlite')):
+        with open(path(name), 'rb') as stream:
+            assert validate_format(stream, format_name) == validate_format(
+                path(name), format_name,
+            )
+
+    shutil.rmtree(workdir)
+
+
+def test_truncated_files():
+    """Check files cut short fail validation."""
+    workdir = mkdtemp(prefix='borgit-test-validators-')
+    full_path = os.path.join(workdir, 'full')
+    truncated_path = os.path.join(workdir, 'truncated')
+    # Tar files are cut at a block boundary, where only the end of archive
+    # marker shows they are incomplete.
+    for format_name, keep in (('zip', 0.5), ('tar', 1536), ('sqlite', 0.5)):
+        if format_name == 'zip':
+            with zipfile.ZipFile(full_path, 'w') as archive:
+                archive.writestr('one', 'one' * 1000)
+        elif format_name == 'tar':
+            with tarfile.open(full_path, 'w') as archive:
+                archive.add(KDB_PATH, arcname='test.kdb')
+        else:
+            connection = sqlite3.connect(full_path)
+            with connection:
+                connection.execute('CREATE TABLE things (name TEXT)')
+                connection.executemany('INSERT INTO things VALUES (?)',
+                                       [('thing' * 100,)] * 100)
+            connection.close()
+        with open(full_path, 'rb') as full, \
+                open(truncated_path, 'wb') as truncated:
+            content = full.read()
+            if isinstance(keep, float):
+                keep = int(len(content) * keep)
+            truncated.write(content[:keep])
+        with pytest.raises(FormatError):
+            validate_format(truncated_path, format_name)
+        os.remove(full_path)
+
+    with pytest.raises(FormatError):
+        validate_format(io.BytesIO(_kdbx_header(3)[:30]), 'kdbx')
+
+    shutil.rmtree(workdir)
+
+
+def test_format_plugin():
+    """Check the format plugin reports results as a check."""
+    plugin = get_plugin({'command': 'check_format'})
+    result = plugin(KDB_PATH, ['--format', 'kdb'])
+    assert result.passed
+    assert result.metrics['groups'] > 0
+
+    result = plugin(KDB_PATH, ['--format', 'zip'])
+    assert not result.passed
+    assert 'central directory' in result.errors[0]
@@ -0,0 +1,85 @@
+"""Tests of the scheduling of borg integrity checks."""
+import os
+import shutil
+from tempfile import mkdtemp
+
+from borgit.repo import ArchiveRecord
+from borgit.state import StateFile
+from borgit.verification import VerificationPolicy
+
+
+class _RecordingRepo:
+    """Stand-in for BorgRepo recording the checks requested."""
+    repo = '/backups/repo'
+
+    def __init__(self):
+        """Initialise the recording repo."""
+        self.checks = []
+
+    def latest_archive(self):
+        """Pretend there is always an existing archive."""
+        return ArchiveRecord(name='previous', id='0', start=None)
+
+    def check(self, **kwargs):
+        """Record a repository check."""
+        self.checks.append(('check', kwargs))
+
+    def check_archive(self, archive_name, **kwargs):
+        """Record an archive check."""
+        self.checks.append((archive_name, kwargs))
+
+
+class _NullLogger:
+    """Logger discarding all messages."""
+    def info(self, message):
+        """Discard an info message."""
+
+
+def test_stateless_policy_checks_everything():
+    """Without state, full checks are run before and after the backup."""
+    repo = _RecordingRepo()
+    policy = VerificationPolicy(repo, _NullLogger())
+    policy.pre_backup()
+    policy.post_backup('new')
+
+    assert repo.checks == [
+        ('check', {}),
+        ('previous', {}),
+        ('check', {}),
+        ('new', {}),
+    ]
+
+
+def test_tiered_policy():
+    """With state, partial checks are used until full checks are due."""
+    state_dir = mkdtemp(prefix='borgit-test-verification-')
+    state_file = StateFile(os.path.join(state_dir, 'verification.json'))
+
+    repo = _RecordingRepo()
+    policy = VerificationPolicy(
+        repo, _NullLogger(),
+        state_file=state_file,
+        repository_check_duration=600,
+        full_repository_check_interval=7 * 86400,
+        verify_data_interval=30 * 86400,
+    )
+    policy.pre_backup()
+    policy.post_backup('first')
+    # Nothing has been fully checked, so the full checks were all due.
+    assert repo.checks == [
+        ('check', {'repository_only': True}),
+        ('check', {'archives_only': True, 'last': 1}),
+        ('first', {'archives_only': True}),
+        ('check', {'archives_only': True, 'verify_data': True}),
+    ]
+
+    repo.checks = []
+    policy.pre_backup()
+    policy.post_backup('second')
+    assert repo.checks == [
+        ('check', {'repository_only': True, 'max_duration': 600}),
+        ('check', {'archives_only': True, 'last': 1}),
+        ('second', {'archives_only': True}),
+    ]
+
+    shutil.rmtree(state_dir)